@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Benchmark output formats of a synthetic granule: GeoTIFFs with .ovr overviews against
+Cloud-Optimized GeoTIFFs with each codec, comparing encode time, size, number of objects,
+and the HTTP requests a remote reader makes for an overview and a full resolution window
+
+    $ python bench/bench_cog.py --product MOD09GQ.006 --codecs DEFLATE LZW ZSTD --layout stacked
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from osgeo import gdal
+from modispds.convert import convert_to_geotiff, output_settings
+from modispds.products import products
+from modispds.testing import make_granule, LocalEarthdata
+
+
+def read_requests(server, url, window=256):
+    """ Number of requests made to read the coarsest overview and a window of a remote band """
+    gdal.VSICurlClearCache()
+    server.requests = {}
+    ds = gdal.Open('/vsicurl/' + url)
+    band = ds.GetRasterBand(1)
+    if band.GetOverviewCount() > 0:
+        band.GetOverview(band.GetOverviewCount() - 1).ReadRaster()
+    band.ReadRaster(0, 0, window, window)
+    ds = None
+    return sum(server.requests.values())
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark GeoTIFF and COG output of a synthetic granule')
+    parser.add_argument('--product', default='MCD43A4.006')
+    parser.add_argument('--size', default=2400, type=int, help='Size of granule (pixels)')
+    parser.add_argument('--codecs', default=['DEFLATE', 'LZW', 'ZSTD'], nargs='*', help='Codecs of COGs')
+    parser.add_argument('--level', default=None, type=int, help='Compression level (default from product)')
+    parser.add_argument('--layout', default='bands', choices=['bands', 'stacked'], help='Output layout')
+    args = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp()
+    hdf = make_granule(args.product, outdir=tmpdir, size=args.size)
+    output = products[args.product]['output']
+    settings = output_settings(args.product)
+    # a band with overviews, or the group it is in, to read remotely
+    band = products[args.product]['bandnames'][products[args.product]['overviews'].index(True)]
+    if args.layout == 'stacked':
+        band = [g for g, names in settings['groups'].items() if band in names][0]
+    modes = [('GTiff', settings['compress'])] + [('COG', codec) for codec in args.codecs]
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', 'YES')
+
+    print('%-6s %-8s %8s %8s %8s %9s' % ('format', 'codec', 'seconds', 'MB', 'objects', 'requests'))
+    with LocalEarthdata() as server:
+        for fmt, codec in modes:
+            products[args.product]['output'] = dict(output, format=fmt, compress=codec, layout=args.layout,
+                                                    level=args.level if args.level is not None else settings['level'])
+            outdir = tempfile.mkdtemp(dir=tmpdir)
+            start = time.time()
+            fnames = convert_to_geotiff(hdf, outdir=outdir, workers=1)
+            secs = time.time() - start
+            size = sum(os.path.getsize(f) for f in fnames)
+            server.files = {}
+            for f in fnames:
+                with open(f, 'rb') as fin:
+                    server.files[os.path.basename(f)] = fin.read()
+            name = [os.path.basename(f) for f in fnames if f.endswith('_%s.TIF' % band)][0]
+            requests = read_requests(server, '%s/public/%s' % (server.url, name))
+            print('%-6s %-8s %8.2f %8.2f %8s %9s' % (fmt, codec, secs, size / 1024.0 / 1024.0, len(fnames), requests))
+    products[args.product]['output'] = output
+    gdal.SetConfigOption('GDAL_DISABLE_READDIR_ON_OPEN', None)
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+"""
+Benchmark conversion of a synthetic granule to GeoTIFFs using different numbers of
+band worker processes and GDAL compression threads
+
+    $ python bench/bench_convert.py --product MOD09GA.006 --workers 1 2 4 8 --threads 1 4
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from modispds.convert import convert_to_geotiff
+from modispds.testing import make_granule
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark conversion of a synthetic granule')
+    parser.add_argument('--product', default='MCD43A4.006')
+    parser.add_argument('--size', default=2400, type=int, help='Size of granule (pixels)')
+    parser.add_argument('--workers', default=[1, 2, 4], type=int, nargs='*', help='Numbers of band workers')
+    parser.add_argument('--threads', default=[0], type=int, nargs='*', help='Numbers of GDAL threads (0 for unset)')
+    args = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp()
+    hdf = make_granule(args.product, outdir=tmpdir, size=args.size)
+    print('%s cores, %s' % (multiprocessing.cpu_count(), os.path.basename(hdf)))
+    print('%8s %8s %8s %10s' % ('workers', 'threads', 'seconds', 'bands/sec'))
+    for workers in args.workers:
+        for threads in args.threads:
+            outdir = tempfile.mkdtemp(dir=tmpdir)
+            start = time.time()
+            fnames = convert_to_geotiff(hdf, outdir=outdir, workers=workers, threads=threads or None)
+            secs = time.time() - start
+            nbands = len([f for f in fnames if f.endswith('.TIF')])
+            print('%8s %8s %8.2f %10.2f' % (workers, threads, secs, nbands / secs))
+            shutil.rmtree(outdir)
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
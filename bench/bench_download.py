@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+"""
+Benchmark downloads from a local range-capable Earthdata stand-in, comparing small
+chunks in a single stream (before) with large buffers and concurrent range segments
+
+    $ python bench/bench_download.py --size 200
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from modispds import earthdata
+from modispds.earthdata import download_file, EarthdataSession
+from modispds.testing import LocalEarthdata
+
+modes = [
+    ('before', {'chunk_size': 1024, 'segment_threshold': 2 ** 62}),
+    ('buffered', {'chunk_size': 1024 * 1024, 'segment_threshold': 2 ** 62}),
+    ('segments', {'chunk_size': 1024 * 1024}),
+]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark downloads against a local server')
+    parser.add_argument('--size', default=200.0, type=float, help='Size of file (MB)')
+    parser.add_argument('--segments', default=4, type=int, help='Number of concurrent range requests')
+    parser.add_argument('--threshold', default=32.0, type=float, help='Size above which to use segments (MB)')
+    args = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp()
+    defaults = dict(earthdata.download_config)
+    print('%-10s %8s %10s' % ('mode', 'seconds', 'MB/sec'))
+    with LocalEarthdata() as server:
+        url = server.add_file('granule.hdf', os.urandom(int(args.size * 1024 * 1024)))
+        for name, config in modes:
+            earthdata.download_config.update(defaults)
+            earthdata.download_config.update({'segments': args.segments,
+                                              'segment_threshold': int(args.threshold * 1024 * 1024)})
+            earthdata.download_config.update(config)
+            session = EarthdataSession('user', 'pass', urs=server.netloc)
+            start = time.time()
+            os.remove(download_file(url, outdir=tmpdir, session=session))
+            secs = time.time() - start
+            print('%-10s %8.2f %10.2f' % (name, secs, args.size / secs))
+    earthdata.download_config.update(defaults)
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+"""
+Benchmark ingesting synthetic granules end to end (query, download, convert, overviews,
+upload) against local stand-ins for CMR, Earthdata and S3, so no credentials or network
+are needed. Per-stage throughput and granules/hour are written to a JSON file, which can
+be compared with the results of an earlier run
+
+    $ python bench/bench_ingest.py --days 2 --tiles 4 --workers 2 --output after.json --compare before.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import tempfile
+import datetime
+import multiprocessing
+from modispds import earthdata, main as pds_main
+from modispds.earthdata import cmr_config, EarthdataSession
+from modispds.convert import convert_config
+from modispds.inventory import Inventory
+from modispds.metrics import metrics
+from modispds.testing import make_granule, LocalEarthdata, LocalCMR, LocalS3
+
+# stages reported, and the metric each is measured by
+STAGES = [
+    ('query', 'cmr_page'),
+    ('download', 'download'),
+    ('convert', 'convert_band'),
+    ('overview', 'overviews'),
+    ('upload', 's3_upload'),
+]
+
+
+def summarize(totals):
+    """ Count, seconds, bytes and rates of each stage from metric totals """
+    sums = {}
+    for (name, labels), values in totals.items():
+        s = sums.setdefault(name, {})
+        for k, v in values.items():
+            s[k] = s.get(k, 0) + v
+    stages = {}
+    for stage, name in STAGES:
+        values = sums.get(name, {})
+        secs = values.get('seconds', 0.0)
+        result = {'count': values.get('count', 0), 'seconds': round(secs, 3)}
+        # rates are per second spent in the stage, summed over concurrent workers
+        result['per_second'] = round(result['count'] / secs, 3) if secs else None
+        if 'bytes' in values:
+            result['bytes'] = values['bytes']
+            result['mb_per_second'] = round(values['bytes'] / 1024.0 / 1024.0 / secs, 3) if secs else None
+        stages[stage] = result
+    return stages
+
+
+def compare(results, baseline):
+    """ Print change in rates from a baseline results file """
+    print('\n%-10s %12s %12s %8s' % ('stage', 'before', 'after', 'change'))
+    rows = [(s, baseline['stages'].get(s, {}).get('per_second'), results['stages'][s]['per_second'])
+            for s, _ in STAGES]
+    rows.append(('end2end', baseline.get('granules_per_hour'), results['granules_per_hour']))
+    for stage, before, after in rows:
+        change = '%+7.1f%%' % (100.0 * (after - before) / before) if before and after else '%8s' % '-'
+        print('%-10s %12s %12s %s' % (stage, before, after, change))
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark ingest end to end against local services')
+    parser.add_argument('--product', default='MCD43A4.006')
+    parser.add_argument('--date', default='2016-01-01', help='First date of granules')
+    parser.add_argument('--days', default=2, type=int, help='Number of days of granules')
+    parser.add_argument('--tiles', default=4, type=int, help='Number of tiles each day')
+    parser.add_argument('--size', default=2400, type=int, help='Size of granules (pixels)')
+    parser.add_argument('--workers', default=2, type=int, help='Granules converted concurrently (0 for serial)')
+    parser.add_argument('--download-workers', default=None, type=int)
+    parser.add_argument('--upload-workers', default=None, type=int)
+    parser.add_argument('--band-workers', default=convert_config['workers'], type=int)
+    parser.add_argument('--output', default='bench_ingest.json', help='File to write results to')
+    parser.add_argument('--compare', default=None, help='Results of an earlier run to compare with')
+    args = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp()
+    srcdir, outdir = os.path.join(tmpdir, 'src'), os.path.join(tmpdir, 'out')
+    os.makedirs(srcdir)
+    os.makedirs(outdir)
+    start_date = datetime.datetime.strptime(args.date, '%Y-%m-%d')
+    dates = [start_date + datetime.timedelta(n) for n in range(args.days)]
+    tiles = ['h%02dv%02d' % (h, v) for h in range(36) for v in range(18)][:args.tiles]
+    print('Writing %s synthetic granules' % (len(dates) * len(tiles)))
+    fnames = [make_granule(args.product, outdir=srcdir, size=args.size, tile=t, date=d.strftime('%Y%j'), seed=i)
+              for i, (d, t) in enumerate([(d, t) for d in dates for t in tiles])]
+
+    config = dict(cmr_config)
+    band_workers = convert_config['workers']
+    with LocalEarthdata() as server, LocalS3(bucket=pds_main.bucket):
+        granules = [server.add_granule(f) for f in fnames]
+        shutil.rmtree(srcdir)
+        with LocalCMR(granules) as cmr:
+            cmr_config.update({'url': cmr.url, 'cache': ''})
+            convert_config['workers'] = args.band_workers
+            earthdata._sessions[os.getpid()] = EarthdataSession('user', 'pass', urs=server.netloc)
+            metrics.reset()
+            start = time.time()
+            try:
+                pds_main.ingest(dates[0].strftime('%Y-%m-%d'), dates[-1].strftime('%Y-%m-%d'), product=args.product,
+                                outdir=outdir, workers=args.workers, download_workers=args.download_workers,
+                                upload_workers=args.upload_workers, inventory=Inventory(pds_main.bucket, args.product))
+            finally:
+                secs = time.time() - start
+                cmr_config.update(config)
+                convert_config['workers'] = band_workers
+                earthdata._sessions.clear()
+    shutil.rmtree(tmpdir)
+
+    results = {
+        'config': vars(args),
+        'environment': {'python': platform.python_version(), 'platform': platform.platform(),
+                        'cpus': multiprocessing.cpu_count()},
+        'granules': len(fnames),
+        'seconds': round(secs, 3),
+        'granules_per_hour': round(len(fnames) / secs * 3600, 1),
+        'stages': summarize(metrics.totals),
+    }
+    with open(args.output, 'w') as f:
+        json.dump(results, f, sort_keys=True, indent=2)
+
+    print('%-10s %8s %10s %10s %10s' % ('stage', 'count', 'seconds', 'per sec', 'MB/sec'))
+    for stage, _ in STAGES:
+        s = results['stages'][stage]
+        print('%-10s %8s %10.2f %10s %10s' % (stage, s['count'], s['seconds'], s['per_second'],
+                                              s.get('mb_per_second', '-')))
+    print('%s granules in %.2fs, %.1f granules/hour, results written to %s' %
+          (results['granules'], secs, results['granules_per_hour'], args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+"""
+Benchmark S3 uploads against a local S3 stand-in, comparing a new client and
+single put_object per file (before) with the shared client and transfer layer (after)
+
+    $ python bench/bench_s3.py --files 40 --size 20
+"""
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+import boto3
+from modispds import pds
+from modispds.testing import LocalS3
+
+
+def put_object_new_client(filename, bucket, prefix=''):
+    """ Upload the way push_to_s3 used to: a new client and one put_object per file """
+    s3 = boto3.client('s3', endpoint_url=pds.s3_config['endpoint_url'])
+    key = os.path.join(prefix, os.path.basename(filename))
+    with open(filename, 'rb') as f:
+        s3.put_object(Bucket=bucket, Key=key, Body=f, ACL='public-read', ContentType='binary/octet-stream')
+
+
+def run(func, fnames, bucket, prefix, threads):
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(lambda f: func(f, bucket, prefix), fnames))
+    return time.time() - start
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description='Benchmark S3 uploads against a local S3')
+    parser.add_argument('--files', default=40, type=int, help='Number of files')
+    parser.add_argument('--size', default=20.0, type=float, help='Size of each file (MB)')
+    parser.add_argument('--threads', default=4, type=int, help='Number of concurrent uploads')
+    args = parser.parse_args(args)
+
+    tmpdir = tempfile.mkdtemp()
+    fnames = []
+    for i in range(args.files):
+        fname = os.path.join(tmpdir, 'band%s.TIF' % i)
+        with open(fname, 'wb') as f:
+            f.write(os.urandom(int(args.size * 1024 * 1024)))
+        fnames.append(fname)
+    mb = args.files * args.size
+
+    print('%-8s %8s %12s %10s' % ('mode', 'seconds', 'objects/sec', 'MB/sec'))
+    with LocalS3(bucket='bench') as s3:
+        for name, func in [('before', put_object_new_client), ('after', pds.push_to_s3)]:
+            secs = run(func, fnames, s3.bucket, name, args.threads)
+            print('%-8s %8.2f %12.2f %10.2f' % (name, secs, args.files / secs, mb / secs))
+    shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
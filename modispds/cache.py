@@ -0,0 +1,123 @@
+"""
+Persistent cache of CMR granule metadata
+"""
+
+import os
+import json
+import time
+import sqlite3
+import datetime
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# caches with an older schema are emptied, as they are only a cache
+SCHEMA_VERSION = 2
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS granules (
+        endpoint TEXT, product TEXT, id TEXT, time_start TEXT, time_end TEXT, updated TEXT, meta TEXT,
+        PRIMARY KEY (endpoint, product, id))""",
+    "CREATE INDEX IF NOT EXISTS granules_time ON granules (endpoint, product, time_start)",
+    """CREATE TABLE IF NOT EXISTS windows (
+        endpoint TEXT, product TEXT, start TEXT, end TEXT, fetched REAL, fetched_iso TEXT,
+        PRIMARY KEY (endpoint, product, start, end))""",
+]
+
+
+def timestamp(value):
+    """ Normalize a CMR timestamp so that timestamps compare as strings """
+    return value[:19] + 'Z'
+
+
+class GranuleCache(object):
+    """ SQLite cache of CMR granule metadata by CMR endpoint (search URL), product and
+    temporal window. Windows older than ttl seconds are refreshed with only the granules
+    updated since they were fetched, and fetched again in full if CMR has since deleted
+    or superseded any of their granules (see refresh) """
+
+    def __init__(self, filename, ttl=86400, endpoint=''):
+        self.filename = filename
+        self.ttl = ttl
+        self.endpoint = endpoint
+        dirname = os.path.dirname(filename)
+        if dirname != '' and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with self.connect() as conn:
+            if conn.execute('PRAGMA user_version').fetchone()[0] < SCHEMA_VERSION:
+                conn.execute('DROP TABLE IF EXISTS granules')
+                conn.execute('DROP TABLE IF EXISTS windows')
+                conn.execute('PRAGMA user_version=%s' % SCHEMA_VERSION)
+            for sql in SCHEMA:
+                conn.execute(sql)
+
+    @contextmanager
+    def connect(self):
+        """ Connection to the database, committing on success """
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, product, start, end, fetch, ttl=None, count=None):
+        """ Get granules for product intersecting window from start to end (ISO timestamps),
+        calling fetch(start, end, updated_since) to get granules from CMR if needed, and
+        count(start, end) to get the number CMR has when refreshing (see refresh). ttl
+        overrides the cache's, e.g. 0 to refresh the window from CMR regardless """
+        start, end = timestamp(start), timestamp(end)
+        ttl = self.ttl if ttl is None else ttl
+        with self.connect() as conn:
+            # any cached window covering this one will do
+            window = conn.execute(
+                'SELECT start, end, fetched, fetched_iso FROM windows WHERE endpoint=? AND product=? AND start<=? '
+                'AND end>=? ORDER BY fetched DESC LIMIT 1', (self.endpoint, product, start, end)).fetchone()
+        if window is None:
+            logger.debug('Fetching %s granules for %s - %s' % (product, start, end))
+            now = time.time()
+            self.update(product, start, end, fetch(start, end, None), fetched=now, replace=True)
+        elif time.time() - window[2] >= ttl:
+            self.refresh(product, window[0], window[1], window[3], fetch, count=count)
+        return self.granules(product, start, end)
+
+    def refresh(self, product, start, end, updated_since, fetch, count=None):
+        """ Refresh a cached window with the granules CMR updated since it was fetched.
+        Those do not include granules CMR deleted, or superseded with a new granule, so the
+        cache then holds every granule CMR has and possibly more: if count(start, end)
+        differs from the number cached the window is fetched again in full, replacing its
+        granules. Without count the window is always fetched in full """
+        now = time.time()
+        if count is not None:
+            logger.debug('Refreshing %s granules for %s - %s updated since %s' % (product, start, end, updated_since))
+            self.update(product, start, end, fetch(start, end, updated_since), fetched=now)
+            if count(start, end) == len(self.granules(product, start, end)):
+                return
+            logger.debug('Granules of %s for %s - %s deleted from CMR' % (product, start, end))
+        logger.debug('Fetching all %s granules for %s - %s' % (product, start, end))
+        self.update(product, start, end, fetch(start, end, None), fetched=now, replace=True)
+
+    def update(self, product, start, end, granules, fetched=None, replace=False):
+        """ Store granules fetched for a window at time fetched (default now), replacing
+        all those cached for it if replace is True """
+        now = time.time() if fetched is None else fetched
+        fetched_iso = datetime.datetime.utcfromtimestamp(now).strftime('%Y-%m-%dT%H:%M:%SZ')
+        rows = [(self.endpoint, product, g['id'], timestamp(g['time_start']),
+                 timestamp(g.get('time_end', g['time_start'])), g.get('updated'), json.dumps(g)) for g in granules]
+        with self.connect() as conn:
+            if replace:
+                conn.execute('DELETE FROM granules WHERE endpoint=? AND product=? AND time_start<=? AND time_end>=?',
+                             (self.endpoint, product, end, start))
+            conn.executemany('INSERT OR REPLACE INTO granules VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            conn.execute('INSERT OR REPLACE INTO windows VALUES (?, ?, ?, ?, ?, ?)',
+                         (self.endpoint, product, start, end, now, fetched_iso))
+        logger.debug('Cached %s granules for %s %s - %s' % (len(rows), product, start, end))
+
+    def granules(self, product, start, end):
+        """ Cached granules for product intersecting window, in order of start time """
+        with self.connect() as conn:
+            rows = conn.execute(
+                'SELECT meta FROM granules WHERE endpoint=? AND product=? AND time_start<=? AND time_end>=? '
+                'ORDER BY time_start, id', (self.endpoint, product, timestamp(end), timestamp(start))).fetchall()
+        return [json.loads(r[0]) for r in rows]
@@ -0,0 +1,233 @@
+"""
+Conversion of MODIS HDF granules to single band GeoTIFFs or Cloud-Optimized GeoTIFFs
+"""
+
+import os
+import json
+import logging
+from concurrent.futures import ProcessPoolExecutor
+from .products import products
+from .memory import vsimem_path, from_vsimem, clear_vsimem, to_memory, release
+from .metrics import metrics, collect
+
+logger = logging.getLogger(__name__)
+
+# output settings of a product, unless set in its entry in products
+OUTPUT = {'format': 'GTiff', 'compress': 'DEFLATE', 'level': None, 'blocksize': 512, 'layout': 'bands', 'groups': {}}
+FORMATS = ['GTiff', 'COG']
+LAYOUTS = ['bands', 'stacked']
+# creation option setting the level of each codec
+LEVEL_OPTIONS = {'DEFLATE': 'ZLEVEL', 'ZSTD': 'ZSTD_LEVEL', 'LZW': None}
+OVERVIEW_LEVELS = [2, 4, 8]
+
+# conversion settings
+convert_config = {
+    # number of processes writing bands concurrently
+    'workers': int(os.getenv('CONVERT_WORKERS', 1)),
+    # threads GDAL uses to compress each band (NUM_THREADS), None to not set
+    'threads': os.getenv('GDAL_NUM_THREADS'),
+    # write to memory rather than disk, see memory.budget
+    'memory': os.getenv('CONVERT_IN_MEMORY', '').lower() in ['1', 'true', 'yes'],
+    # output format of all products (GTiff or COG), None to use each product's setting
+    'format': os.getenv('OUTPUT_FORMAT'),
+    # output layout of all products (bands or stacked), None to use each product's setting
+    'layout': os.getenv('OUTPUT_LAYOUT'),
+}
+
+
+def output_settings(product):
+    """ Output format, codec, level, block size and layout of a product, see products """
+    settings = dict(OUTPUT)
+    settings.update(products[product].get('output', {}))
+    for key in ['format', 'layout']:
+        if convert_config[key]:
+            settings[key] = convert_config[key]
+    if settings['format'] not in FORMATS:
+        raise ValueError('Unknown output format %s, must be one of %s' % (settings['format'], ', '.join(FORMATS)))
+    if settings['layout'] not in LAYOUTS:
+        raise ValueError('Unknown output layout %s, must be one of %s' % (settings['layout'], ', '.join(LAYOUTS)))
+    if settings['compress'] not in LEVEL_OPTIONS:
+        raise ValueError('Unknown codec %s, must be one of %s' %
+                         (settings['compress'], ', '.join(sorted(LEVEL_OPTIONS))))
+    return settings
+
+
+def creation_options(settings):
+    """ GeoTIFF creation options for output settings """
+    opts = {'COMPRESS': settings['compress'], 'PREDICTOR': '2', 'TILED': 'YES',
+            'BLOCKXSIZE': str(settings['blocksize']), 'BLOCKYSIZE': str(settings['blocksize'])}
+    level = LEVEL_OPTIONS[settings['compress']]
+    if level is not None and settings['level'] is not None:
+        opts[level] = str(settings['level'])
+    if settings['layout'] == 'stacked':
+        # so a band of a stack can be read without reading the others
+        opts['INTERLEAVE'] = 'BAND'
+    return opts
+
+
+def output_files(product):
+    """ Files written for each granule of a product, as (band indices, name, overviews)
+    where name is the band name, or the group name if bands are stacked """
+    settings = output_settings(product)
+    bandnames = products[product]['bandnames']
+    overviews = products[product]['overviews']
+    groups = settings['groups'] if settings['layout'] == 'stacked' else {}
+    group_of = {}
+    for group, names in groups.items():
+        for name in names:
+            if name not in bandnames:
+                raise ValueError('Unknown band %s in group %s of %s' % (name, group, product))
+            group_of[name] = group
+    files = []
+    for i, name in enumerate(bandnames):
+        if name not in group_of:
+            files.append(([i], name, overviews[i]))
+        elif group_of[name] not in [f[1] for f in files]:
+            indices = [bandnames.index(n) for n in groups[group_of[name]]]
+            files.append((indices, group_of[name], any(overviews[j] for j in indices)))
+    return files
+
+
+def output_name(gid, name):
+    """ Name of the GeoTIFF of a granule's band, or group of bands """
+    return gid + '_' + name + '.TIF'
+
+
+def manifest_name(gid):
+    """ Name of the manifest of a granule's stacked files """
+    return gid + '_bands.json'
+
+
+def make_manifest(gid, product):
+    """ Manifest of a granule's stacked files, giving the file and band number of each band """
+    bandnames = products[product]['bandnames']
+    bands = {}
+    for indices, name, overview in output_files(product):
+        for n, i in enumerate(indices):
+            bands[bandnames[i]] = {'file': output_name(gid, name), 'band': n + 1}
+    return {'gid': gid, 'bands': bands}
+
+
+def convert_to_geotiff(hdf, outdir='', workers=None, threads=None, memory=None):
+    """ Convert HDF to a GeoTIFF per band, plus overviews for some bands, which are
+    inside the GeoTIFF if the product's output format is COG and in a .ovr file
+    otherwise (see output_settings). If the product's layout is stacked, groups of
+    bands are written to a GeoTIFF each, and a JSON manifest of the bands is added.
+    Files are written concurrently by a pool of worker processes, see convert_config.
+    If memory is True, MemoryFiles are returned instead of file names, except for files
+    that would exceed the memory budget """
+    workers = workers or convert_config['workers']
+    threads = threads or convert_config['threads']
+    memory = convert_config['memory'] if memory is None else memory
+    bname = os.path.basename(hdf)
+    parts = bname.split('.')
+    product = parts[0] + '.' + parts[3]
+    settings = output_settings(product)
+    cog = settings['format'] == 'COG'
+    opts = creation_options(settings)
+    if threads:
+        opts['NUM_THREADS'] = str(threads)
+    # gippy loads GDAL, which takes a while, so it is not imported until needed
+    import gippy
+    img = gippy.GeoImage(hdf, True)
+    gid = bname.replace('.hdf', '')
+    bands = [(indices, os.path.join(outdir, output_name(gid, name)), overview)
+             for indices, name, overview in output_files(product)]
+
+    # save each band, or group of bands, as a TIF
+    results = []
+    error = None
+    if workers > 1:
+        img = None
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(collect, _convert_band, hdf, band, options=opts, memory=memory, cog=cog)
+                       for band in bands]
+            # every band is waited for, so none of the memory they reserve is lost if one fails
+            for future in futures:
+                try:
+                    fnames, events = future.result()
+                    metrics.replay(events)
+                    results.append(fnames)
+                except Exception as e:
+                    error = error or e
+    else:
+        for i, f, overview in bands:
+            try:
+                results.append(save_band(img, i, f, opts, overview, memory=memory, cog=cog))
+            except Exception as e:
+                error = e
+                break
+    files = [f for fnames in results for f in fnames]
+    if error is not None:
+        release(files)
+        raise error
+    if settings['layout'] == 'stacked':
+        manifest = json.dumps(make_manifest(gid, product), sort_keys=True, indent=2).encode('utf-8')
+        if memory:
+            files.append(to_memory(manifest_name(gid), manifest, outdir=outdir))
+        else:
+            with open(os.path.join(outdir, manifest_name(gid)), 'wb') as f:
+                f.write(manifest)
+            files.append(os.path.join(outdir, manifest_name(gid)))
+    return files
+
+
+def _convert_band(hdf, band, options, memory=False, cog=False):
+    """ Open HDF and save a band or group of bands, for use in a worker process """
+    import gippy
+    img = gippy.GeoImage(hdf, True)
+    return save_band(img, band[0], band[1], options, band[2], memory=memory, cog=cog)
+
+
+def save_band(img, i, fname, options, overview=False, memory=False, cog=False):
+    """ Save band i of image, or bands if i is a list of band indices, as a GeoTIFF, or a
+    COG if cog is True, returning the file names written """
+    outname = vsimem_path(fname) if memory else fname
+    indices = i if isinstance(i, list) else [i]
+    logger.debug('Writing %s' % outname)
+    labels = {'band': os.path.splitext(fname)[0].split('_')[-1]}
+    with metrics.timer('convert_band', labels=labels):
+        if cog:
+            # overviews are added inside the file, and timed as part of the band
+            save_cog(img, i, outname, options, overview=overview, labels=labels)
+        else:
+            # the saved image is not kept, so it is closed (and flushed) right away
+            img.select([b+1 for b in indices]).save(outname, options=options)
+    file_names = [outname]
+    # add overview as separate file, averaged in memory from the bands
+    if overview and not cog:
+        from .overviews import write_overviews
+        with metrics.timer('overviews', labels=labels):
+            write_overviews(outname, [img[b].read_raw() for b in indices], levels=OVERVIEW_LEVELS,
+                            nodata=img[indices[0]].nodata())
+        file_names.append(outname + '.ovr')
+    if memory:
+        file_names = [from_vsimem(f, outdir=os.path.dirname(fname)) for f in file_names]
+        clear_vsimem(os.path.dirname(outname))
+    return file_names
+
+
+def save_cog(img, i, outname, options, overview=False, labels=None):
+    """ Save band i of image, or bands if i is a list of band indices, as a Cloud-Optimized
+    GeoTIFF: tiled, with overviews inside the file and all the directories (IFDs) ahead of
+    the image data, so a reader gets the layout of the file and any overview from its
+    first bytes """
+    from osgeo import gdal
+    # write the bands uncompressed in memory, add overviews, then copy to the final layout
+    tmpname = vsimem_path(outname)
+    indices = i if isinstance(i, list) else [i]
+    layout = ['TILED', 'BLOCKXSIZE', 'BLOCKYSIZE', 'INTERLEAVE']
+    img.select([b+1 for b in indices]).save(tmpname, options={k: v for k, v in options.items() if k in layout})
+    try:
+        ds = gdal.Open(tmpname, gdal.GA_Update)
+        if overview:
+            from .overviews import add_overviews
+            with metrics.timer('overviews', labels=labels):
+                add_overviews(ds, [img[b].read_raw() for b in indices], levels=OVERVIEW_LEVELS,
+                              nodata=img[indices[0]].nodata())
+        opts = ['%s=%s' % kv for kv in sorted(options.items())] + ['COPY_SRC_OVERVIEWS=YES']
+        gdal.GetDriverByName('GTiff').CreateCopy(outname, ds, options=opts)
+        ds = None
+    finally:
+        gdal.Unlink(tmpname)
+    return outname
@@ -3,117 +3,613 @@ Client library for using NASAs CMR API for searching and downloading from NASA d
 """
 
 import os
-import requests
+import time
+import hashlib
 import datetime
+import subprocess
 from dateutil.parser import parse as dateparser
-from json import dump
+from json import dump, load
+from xml.etree import ElementTree
 import logging
-from requests.packages.urllib3.util.retry import Retry
-from requests.adapters import HTTPAdapter
+import threading
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from appdirs import user_cache_dir
 from html.parser import HTMLParser
 from dotenv import load_dotenv, find_dotenv
-from cmr import GranuleQuery
 from .products import products
+from .cache import GranuleCache
+from .metrics import metrics
+from .ratelimit import limiter, outcome, backoff, ratelimit_config, THROTTLED, ERROR
+try:
+    from shutil import which
+except ImportError:
+    from distutils.spawn import find_executable as which
+try:
+    from urllib.parse import urljoin, urlparse
+except ImportError:
+    from urlparse import urljoin, urlparse
 
 # get environment variables
 load_dotenv(find_dotenv())
 EARTHDATA_USER = os.getenv('EARTHDATA_USER')
 EARTHDATA_PASS = os.getenv('EARTHDATA_PASS')
+EARTHDATA_URS = os.getenv('EARTHDATA_URS', 'urs.earthdata.nasa.gov')
+
+# CMR search settings, cache is a file name or empty to disable caching
+cmr_config = {
+    'url': os.getenv('CMR_URL', 'https://cmr.earthdata.nasa.gov/search/'),
+    'cache': os.getenv('CMR_CACHE', os.path.join(user_cache_dir('modispds'), 'cmr.sqlite')),
+    'ttl': int(os.getenv('CMR_CACHE_TTL', 86400)),
+    # granules per page of results (CMR maximum is 2000)
+    'page_size': int(os.getenv('CMR_PAGE_SIZE', 2000)),
+    # pages fetched concurrently
+    'workers': int(os.getenv('CMR_WORKERS', 4)),
+    # longest range of dates fetched in one query
+    'days': int(os.getenv('CMR_QUERY_DAYS', 32)),
+}
+
+# download settings
+download_config = {
+    # size of reads and writes
+    'chunk_size': int(os.getenv('DOWNLOAD_CHUNK_SIZE', 1024 * 1024)),
+    # files larger than this are downloaded as concurrent range requests
+    'segment_threshold': int(os.getenv('DOWNLOAD_SEGMENT_THRESHOLD', 32 * 1024 * 1024)),
+    'segments': int(os.getenv('DOWNLOAD_SEGMENTS', 4)),
+    # attempts to resume after a failure
+    'retries': int(os.getenv('DOWNLOAD_RETRIES', 3)),
+}
 
 # logging
 logger = logging.getLogger(__name__)
 
 
-def query(start_date, end_date, product='MCD43A4.006', provider='LPDAAC_ECS'):
+def query(start_date, end_date, product='MCD43A4.006', provider='LPDAAC_ECS', cache=None):
     """ Search CMR database for spectral MODIS tiles matching a temporal range,
     defined by a start date and end date. Returns metadata containing the URL of
-    each image.
+    each image. Results are served from the granule cache if one is configured.
     """
-    q = GranuleQuery()
-    prod, ver = product.split('.')
-    q.short_name(prod).version(ver)
-    q.temporal('%sT00:00:00Z' % str(start_date), '%sT23:59:00Z' % str(end_date))
-    _granules = q.get_all()
+    days = partition(query_range(start_date, end_date, product=product, cache=cache), product=product)
+    granules = [gran for day in sorted(days) if start_date <= day <= end_date for gran in days[day]]
+    logger.info("%s granules found within %s - %s" % (len(granules), start_date, end_date))
+    return granules
+
 
-    # filter dates
+def query_dates(dates, product='MCD43A4.006', days=None, cache=None, refresh=False):
+    """ Search CMR for granules on each of a list of dates, with one query for each range
+    of up to days dates (see cmr_config). Yields (date, granules) for each date in order.
+    If refresh is True cached granules are refreshed from CMR, however recent """
+    days = days or cmr_config['days']
+    dates = sorted(dates)
+    while len(dates) > 0:
+        chunk = [d for d in dates if (d - dates[0]).days < days]
+        dates = dates[len(chunk):]
+        granules = partition(query_range(chunk[0], chunk[-1], product=product, cache=cache, refresh=refresh),
+                             product=product)
+        for day in chunk:
+            logger.info("%s granules found for %s" % (len(granules.get(day, [])), day))
+            yield day, granules.get(day, [])
+
+
+def query_range(start_date, end_date, product='MCD43A4.006', cache=None, refresh=False):
+    """ Get all granules intersecting a range of dates, from the cache if configured. If
+    refresh is True cached granules are refreshed from CMR even if cached recently (see
+    GranuleCache.refresh) """
+    cache = cache or get_cache()
+    start, end = '%sT00:00:00Z' % str(start_date), '%sT23:59:00Z' % str(end_date)
+    if cache is not None:
+        return cache.get(product, start, end, partial(search, product=product), ttl=0 if refresh else None,
+                         count=partial(hits, product=product))
+    return search(start, end, product=product)
+
+
+def partition(granules, product='MCD43A4.006'):
+    """ Group granules by date, returning dictionary of date: granules """
     day_offset = products[product]['day_offset']
-    granules = []
-    for gran in _granules:
-        # CMR uses day 1 of window - correct this to be middle of window
-        date = (dateparser(gran['time_start'].split('T')[0]) + datetime.timedelta(days=day_offset)).date()
-        if (start_date <= date <= end_date):
-            granules.append(gran)
-    logger.info("%s granules found within %s - %s" % (len(granules), start_date, end_date))
+    days = {}
+    for gran in granules:
+        days.setdefault(granule_date(gran, day_offset), []).append(gran)
+    return days
+
+
+def granule_date(gran, day_offset=0):
+    """ Date of a granule from its metadata """
+    # CMR uses day 1 of window - correct this to be middle of window
+    return (dateparser(gran['time_start'].split('T')[0]) + datetime.timedelta(days=day_offset)).date()
+
+
+def search(start, end, updated_since=None, product='MCD43A4.006', page_size=None, workers=None):
+    """ Search CMR for all granules of product within a temporal range, optionally
+    only those updated since a given time. After the first page of results, the
+    remaining pages are fetched concurrently """
+    page_size = page_size or cmr_config['page_size']
+    workers = workers or cmr_config['workers']
+    prod, ver = product.split('.')
+    params = {'short_name': prod, 'version': ver, 'temporal[]': '%s,%s' % (start, end), 'page_size': page_size}
+    if updated_since is not None:
+        params['updated_since'] = updated_since
+    session = get_session()
+    granules, hits = _search_page(session, params, 1)
+    pages = range(2, -(-hits // page_size) + 1)
+    if len(pages) > 0:
+        logger.debug('Fetching %s granules in %s pages' % (hits, len(pages) + 1))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for page in executor.map(partial(_search_page, session, params), pages):
+                granules.extend(page[0])
     return granules
 
 
+def hits(start, end, product='MCD43A4.006'):
+    """ Number of granules of product CMR has within a temporal range, without fetching them """
+    prod, ver = product.split('.')
+    params = {'short_name': prod, 'version': ver, 'temporal[]': '%s,%s' % (start, end), 'page_size': 0}
+    return _search_page(get_session(), params, 1)[1]
+
+
+def _search_page(session, params, page_num):
+    """ Get a page of CMR search results, returning granules and total number of hits """
+    with metrics.timer('cmr_page') as m:
+        resp = limited_get(session, urljoin(cmr_config['url'], 'granules.json'), params=dict(params, page_num=page_num))
+        resp.raise_for_status()
+        m['bytes'] = len(resp.content)
+    return resp.json()['feed']['entry'], int(resp.headers['CMR-Hits'])
+
+
+_cache = {}
+
+
+def get_cache():
+    """ Get the granule cache set in cmr_config, or None if caching is disabled """
+    if not cmr_config['cache']:
+        return None
+    # granules are cached by CMR endpoint, so a stand-in CMR never answers for the real one
+    key = (cmr_config['cache'], cmr_config['ttl'], cmr_config['url'])
+    if key not in _cache:
+        _cache.clear()
+        _cache[key] = GranuleCache(cmr_config['cache'], ttl=cmr_config['ttl'], endpoint=cmr_config['url'])
+    return _cache[key]
+
+
 def download_granule(meta, outdir=''):
     """ Download granule files from metadata instance """
     # get basename
     url = str(meta['links'][0]['href'])
     bname = os.path.splitext(os.path.basename(url))[0]
 
-    # save metadata
+    links = {m['type']: m['href'] for m in meta['links'][1:] if 'type' in m}
+    # download xml metadata, which has the size and checksum of the hdf
+    fn_metaxml = download_file(links['text/xml'], outdir=outdir)
+    info = get_file_info(fn_metaxml).get(os.path.basename(url), {})
+    if 'size' not in info and 'granule_size' in meta:
+        info['size_mb'] = float(meta['granule_size'])
+
+    # save metadata, with the identity of this version of the granule (see changed)
     fn_meta = os.path.join(outdir, bname + '_meta.json')
     with open(fn_meta, 'w') as f:
         logger.debug('Writing metadata to %s' % fn_meta)
-        dump(meta, f, sort_keys=True, indent=4, ensure_ascii=False)
+        md = dict(meta, identity=granule_identity(meta, checksum=info.get('checksum')))
+        dump(md, f, sort_keys=True, indent=4, ensure_ascii=False)
 
     # download hdf
-    fn_hdf = download_file(url, outdir=outdir)
+    fn_hdf = download_file(url, outdir=outdir, **info)
 
-    links = {m['type']: m['href'] for m in meta['links'][1:] if 'type' in m}
-    # download xml metadata
-    fn_metaxml = download_file(links['text/xml'], outdir=outdir)
     # download browse image
     fn_browse = download_file(links['image/jpeg'], noauth=True, outdir=outdir)
 
     return [fn_hdf, fn_browse, fn_meta, fn_metaxml]
 
 
-def download_file(url, noauth=False, outdir=''):
-    """ Get URL and save with some name """
+def granule_identity(meta, checksum=None):
+    """ Identity of a version of a granule from its CMR metadata: the producer granule
+    ID, concept ID, revision ID (CMR JSON results may not have it), time it was last
+    updated, and the checksum of the hdf if known """
+    return {
+        'producer_granule_id': meta.get('producer_granule_id'),
+        'concept_id': meta.get('id'),
+        'revision_id': meta.get('revision_id'),
+        'updated': meta.get('updated'),
+        'checksum': checksum,
+    }
+
+
+def changed(identity, stored):
+    """ Check if a granule has changed since a stored identity, or has none stored.
+    Only fields known in both are compared, so an identity stored before CMR gave
+    revision IDs (or without a checksum) still matches """
+    if stored is None:
+        return True
+    return any(identity[k] != stored.get(k) for k in identity if identity[k] is not None and stored.get(k) is not None)
+
+
+def download_file(url, noauth=False, outdir='', session=None, size=None, size_mb=None,
+                  checksum=None, checksum_type='CKSUM'):
+    """ Get URL and save with some name. Large files are fetched in concurrent ranges,
+    and partial downloads resumed. If provided, the size (or approximate size in MB)
+    and checksum of the file are verified """
     fout = os.path.join(outdir, os.path.basename(url))
-    auth = () if noauth else (EARTHDATA_USER, EARTHDATA_PASS)
-    # download as stream
-    session = get_session(retries=5)
-    if noauth:
-        stream = session.get(url, stream=True)
-    else:
-        stream = get_stream(session, url, auth, [])
-    chunk_size = 1024
-    try:
-        with open(fout, 'wb') as f:
-            logger.debug('Saving %s' % fout)
-            for chunk in stream.iter_content(chunk_size):
-                f.write(chunk)
-    except:
-        raise RuntimeError("Problem fetching %s" % stream)
+    session = session or get_earthdata_session()
+    start_time = time.time()
+    error = None
+    hops = 0
+    for attempt in range(download_config['retries'] + 1):
+        try:
+            hops = _download(session, url, fout, noauth)
+            error = None
+            break
+        except Exception as e:
+            logger.warning('Problem fetching %s (attempt %s): %s' % (url, attempt + 1, str(e)))
+            error = e
+            if attempt < download_config['retries']:
+                time.sleep(backoff(attempt))
+    if error is not None:
+        raise RuntimeError("Problem fetching %s: %s" % (url, str(error)))
+    verify_file(fout, size=size, size_mb=size_mb, checksum=checksum, checksum_type=checksum_type)
 
+    nbytes = os.path.getsize(fout)
+    elapsed = max(time.time() - start_time, 1e-6)
+    metrics.record('download', labels={'host': urlparse(url).netloc}, bytes=nbytes, seconds=elapsed,
+                   redirect_hops=hops, retries=attempt)
+    logger.info('Downloaded %s: %.1f MB in %.2fs (%.1f MB/s)' %
+                (os.path.basename(fout), nbytes / 1e6, elapsed, nbytes / 1e6 / elapsed))
     return fout
 
 
-def get_session(retries=5):
+def _download(session, url, fout, noauth=False):
+    """ Download url to fout, via a .part file that is resumed if it exists. Returns the
+    number of redirects followed to get the file """
+    chunk_size = download_config['chunk_size']
+    part = fout + '.part'
+    progress = _read_progress(part)
+    stream = None
+    # streams hold a slot of the endpoint's limiter until closed, see limited_get
+    try:
+        if progress is None:
+            # first request is for the first segment, which is the whole file if it is small
+            first = download_config['segment_threshold']
+            stream = session.get(url, noauth=noauth, headers={'Range': 'bytes=0-%s' % (first - 1)})
+            if stream.status_code not in [200, 206]:
+                raise RuntimeError('%s returned %s' % (url, stream.status_code))
+            total = _content_range_total(stream)
+            if total is None:
+                logger.debug('Range requests not supported for %s' % url)
+                with open(part, 'wb') as f:
+                    for chunk in stream.iter_content(chunk_size):
+                        f.write(chunk)
+                _replace(part, fout)
+                return getattr(stream, 'redirect_hops', 0)
+            progress = [{'start': 0, 'end': min(first, total) - 1, 'done': 0}]
+            progress += _segments(first, total, download_config['segments'])
+            with open(part, 'wb') as f:
+                f.truncate(total)
+            _write_progress(part, progress)
+        else:
+            logger.info('Resuming download of %s' % fout)
+
+        lock = threading.Lock()
+        todo = [seg for seg in progress if seg['start'] + seg['done'] <= seg['end']]
+        if stream is not None:
+            # the first segment is read from the response already received
+            todo = todo[1:]
+        with ThreadPoolExecutor(max_workers=max(len(todo), 1)) as executor:
+            futures = [executor.submit(_download_segment, session, url, part, seg, progress, lock, noauth)
+                       for seg in todo]
+            if stream is not None:
+                _download_segment(session, url, part, progress[0], progress, lock, noauth, stream=stream)
+            for future in futures:
+                future.result()
+    finally:
+        if stream is not None:
+            stream.close()
+    os.remove(part + '.json')
+    _replace(part, fout)
+    return getattr(stream, 'redirect_hops', 0)
+
+
+def _download_segment(session, url, part, seg, progress, lock, noauth=False, stream=None):
+    """ Download remaining bytes of a segment of url into part file, recording progress """
+    chunk_size = download_config['chunk_size']
+    start = seg['start'] + seg['done']
+    if stream is None:
+        stream = session.get(url, noauth=noauth, headers={'Range': 'bytes=%s-%s' % (start, seg['end'])})
+    try:
+        if stream.status_code != 206:
+            raise RuntimeError('Range request for %s returned %s' % (url, stream.status_code))
+        with open(part, 'r+b') as f:
+            f.seek(start)
+            unsaved = 0
+            try:
+                for chunk in stream.iter_content(chunk_size):
+                    f.write(chunk)
+                    seg['done'] += len(chunk)
+                    unsaved += len(chunk)
+                    # data is flushed before progress is recorded, so progress never overstates it
+                    if unsaved >= 16 * chunk_size:
+                        f.flush()
+                        with lock:
+                            _write_progress(part, progress)
+                        unsaved = 0
+            finally:
+                f.flush()
+                with lock:
+                    _write_progress(part, progress)
+    finally:
+        stream.close()
+    if seg['start'] + seg['done'] <= seg['end']:
+        raise RuntimeError('Incomplete range %s-%s of %s' % (seg['start'], seg['end'], url))
+
+
+def _segments(start, total, n):
+    """ Split bytes from start up to total into at most n contiguous segments """
+    if start >= total:
+        return []
+    size = -(-(total - start) // n)
+    return [{'start': s, 'end': min(s + size, total) - 1, 'done': 0} for s in range(start, total, size)]
+
+
+def _content_range_total(stream):
+    """ Get total size from Content-Range header of a partial response, if there is one """
+    if stream.status_code != 206:
+        return None
+    try:
+        return int(stream.headers.get('Content-Range', '').split('/')[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _read_progress(part):
+    """ Read progress of a partial download, or None if there isn't one """
+    if not (os.path.exists(part) and os.path.exists(part + '.json')):
+        return None
+    with open(part + '.json') as f:
+        return load(f)
+
+
+def _write_progress(part, progress):
+    """ Save progress of a partial download """
+    with open(part + '.json.tmp', 'w') as f:
+        dump(progress, f)
+    _replace(part + '.json.tmp', part + '.json')
+
+
+def _replace(src, dst):
+    """ Rename src to dst, overwriting dst if it exists """
+    if os.path.exists(dst):
+        os.remove(dst)
+    os.rename(src, dst)
+
+
+def get_file_info(fname):
+    """ Get size and checksum of each data file from granule XML metadata """
+    info = {}
+    try:
+        tree = ElementTree.parse(fname)
+    except ElementTree.ParseError:
+        logger.warning('Unable to parse metadata %s' % fname)
+        return info
+    for el in tree.iter('DataFileContainer'):
+        name = el.findtext('DistributedFileName')
+        if name is None:
+            continue
+        info[name] = {}
+        if el.findtext('FileSize'):
+            info[name]['size'] = int(el.findtext('FileSize'))
+        if el.findtext('Checksum'):
+            info[name]['checksum'] = el.findtext('Checksum').strip()
+            info[name]['checksum_type'] = (el.findtext('ChecksumType') or 'CKSUM').strip()
+    return info
+
+
+def verify_file(fname, size=None, size_mb=None, checksum=None, checksum_type='CKSUM'):
+    """ Check file against expected size and checksum, removing it if they don't match """
+    nbytes = os.path.getsize(fname)
+    error = None
+    if size is not None and nbytes != size:
+        error = 'size is %s, expected %s' % (nbytes, size)
+    # approximate size, as CMR gives size in MB
+    elif size_mb and not (0.95 * size_mb * 1e6 <= nbytes <= 1.05 * size_mb * 1024 * 1024):
+        error = 'size is %s, expected about %s MB' % (nbytes, size_mb)
+    elif checksum is not None:
+        value = file_checksum(fname, checksum_type)
+        if value is not None and value != checksum:
+            error = '%s checksum is %s, expected %s' % (checksum_type, value, checksum)
+    if error is not None:
+        os.remove(fname)
+        raise RuntimeError('Downloaded file %s failed verification: %s' % (fname, error))
+
+
+def file_checksum(fname, checksum_type='CKSUM'):
+    """ Calculate checksum of a file, returns None for unsupported checksum types """
+    checksum_type = checksum_type.upper()
+    if checksum_type == 'CKSUM':
+        return cksum(fname)
+    if checksum_type.replace('-', '') in ['MD5', 'SHA1', 'SHA256', 'SHA512']:
+        h = hashlib.new(checksum_type.replace('-', '').lower())
+        with open(fname, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                h.update(block)
+        return h.hexdigest()
+    logger.warning('Unsupported checksum type %s' % checksum_type)
+    return None
+
+
+def cksum(fname):
+    """ POSIX cksum (CRC) of a file, using the cksum utility if available """
+    exe = which('cksum')
+    if exe is not None:
+        return subprocess.check_output([exe, fname]).split()[0].decode('utf-8')
+    table = _crc_table()
+    crc = 0
+    length = 0
+    with open(fname, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            length += len(block)
+            for b in bytearray(block):
+                crc = ((crc << 8) & 0xFFFFFFFF) ^ table[(crc >> 24) ^ b]
+    while length:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ table[(crc >> 24) ^ (length & 0xFF)]
+        length >>= 8
+    return str(~crc & 0xFFFFFFFF)
+
+
+_crc = []
+
+
+def _crc_table():
+    """ Lookup table for CRC used by cksum """
+    if not _crc:
+        for i in range(256):
+            c = i << 24
+            for j in range(8):
+                c = ((c << 1) ^ 0x04C11DB7) & 0xFFFFFFFF if c & 0x80000000 else (c << 1) & 0xFFFFFFFF
+            _crc.append(c)
+    return _crc
+
+
+def get_session(retries=5, pool_size=10):
+    # requests is not imported until a session is needed, to start up quickly
+    import requests
+    from requests.packages.urllib3.util.retry import Retry
+    from requests.adapters import HTTPAdapter
     s = requests.Session()
-    r = Retry(total=retries, backoff_factor=0.1, status_forcelist=[500, 502, 503, 504])
-    s.mount('http://', HTTPAdapter(max_retries=r))
-    s.mount('https://', HTTPAdapter(max_retries=r))
+    # throttling (429 and 503) is retried by limited_get, with backoff shared by all requests to the endpoint
+    r = Retry(total=retries, backoff_factor=0.1, status_forcelist=[500, 502, 504])
+    s.mount('http://', HTTPAdapter(max_retries=r, pool_connections=pool_size, pool_maxsize=pool_size))
+    s.mount('https://', HTTPAdapter(max_retries=r, pool_connections=pool_size, pool_maxsize=pool_size))
     return s
 
 
-def get_stream(session, url, auth, previous_tries):
-    """ Traverse redirects to get the final url """
-    stream = session.get(url, auth=auth, allow_redirects=False, stream=True)
-    # if we get back to the same url, it's time to download
-    if url in previous_tries:
-        return stream
-    if stream.status_code == 302:
-        previous_tries.append(url)
-        link = LinkFinder()
-        link.feed(stream.text)
-        return get_stream(session, link.download_link, auth, previous_tries)
-    else:
-        raise RuntimeError("Earthdata Authentication Error")
+def endpoint(url):
+    """ Endpoint of a url for rate control: URS, CMR, or the Earthdata data pool """
+    netloc = urlparse(url).netloc
+    if netloc == EARTHDATA_URS:
+        return 'urs'
+    if netloc == urlparse(cmr_config['url']).netloc:
+        return 'cmr'
+    return 'earthdata'
+
+
+def limited_get(session, url, **kwargs):
+    """ GET url with session, within the rate limits of its endpoint (see ratelimit),
+    retrying throttled responses (429 or 503) with jittered backoff. The last response
+    is returned if it is still throttled after all retries. A streamed response holds its
+    slot until it is closed, so its body is read within the limits too, and must be closed """
+    lim = limiter(endpoint(url))
+    retries = ratelimit_config['retries']
+    for attempt in range(retries + 1):
+        lim.acquire()
+        try:
+            resp = session.get(url, **kwargs)
+        except Exception:
+            lim.release(ERROR)
+            raise
+        result = outcome(resp.status_code)
+        if result != THROTTLED or attempt == retries:
+            if kwargs.get('stream'):
+                _release_on_close(resp, lim, result)
+            else:
+                lim.release(result)
+            return resp
+        lim.release(result)
+        delay = backoff(attempt, resp.headers.get('Retry-After'))
+        logger.info('%s returned %s, retrying in %.1fs' % (url, resp.status_code, delay))
+        resp.close()
+        time.sleep(delay)
+
+
+def _release_on_close(resp, lim, result):
+    """ Release the slot of resp in lim with result the first time resp is closed """
+    close = resp.close
+    released = []
+
+    def release():
+        try:
+            close()
+        finally:
+            if not released:
+                released.append(True)
+                lim.release(result)
+    resp.close = release
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_earthdata_session():
+    """ Get Earthdata session shared by all threads in this process """
+    pid = os.getpid()
+    session = _sessions.get(pid)
+    if session is None:
+        with _sessions_lock:
+            if pid not in _sessions:
+                _sessions.clear()
+                _sessions[pid] = EarthdataSession()
+            session = _sessions[pid]
+    return session
+
+
+class EarthdataSession(object):
+    """ HTTP session that authenticates with Earthdata Login (URS) once, then reuses the
+    URS cookies, resolved redirects, and keep-alive connections for all downloads """
+
+    max_redirects = 10
+    redirect_codes = [301, 302, 303, 307]
+
+    def __init__(self, username=None, password=None, urs=EARTHDATA_URS, pool_size=10, retries=5):
+        self.auth = (username or EARTHDATA_USER, password or EARTHDATA_PASS)
+        self.urs = urs
+        self.session = get_session(retries=retries, pool_size=pool_size)
+        # original url -> final url of the redirect chain
+        self.redirects = {}
+        self.logins = 0
+
+    def get(self, url, noauth=False, headers=None):
+        """ GET url as a stream, authenticating only if the cookies are missing or expired """
+        if noauth:
+            stream = limited_get(self.session, url, stream=True, headers=headers)
+            stream.redirect_hops = len(stream.history)
+            return stream
+        resolved = self.redirects.get(url, url)
+        stream = limited_get(self.session, resolved, allow_redirects=False, stream=True, headers=headers)
+        if stream.status_code in [200, 206]:
+            stream.redirect_hops = 0
+            return stream
+        self.redirects.pop(url, None)
+        if resolved != url or stream.status_code not in self.redirect_codes:
+            # resolved url or credentials no longer accepted, start over
+            stream.close()
+            if stream.status_code == 401:
+                self.session.cookies.clear()
+            stream = limited_get(self.session, url, allow_redirects=False, stream=True, headers=headers)
+        return self._login(url, stream, headers=headers)
+
+    def _login(self, url, stream, headers=None):
+        """ Follow redirect chain from stream through URS and back to url """
+        logger.debug('Authenticating with %s for %s' % (self.urs, url))
+        self.logins += 1
+        start_time = time.time()
+        current = url
+        for hop in range(self.max_redirects):
+            if stream.status_code in [200, 206]:
+                if current != url:
+                    self.redirects[url] = current
+                stream.redirect_hops = hop
+                metrics.record('earthdata_login', seconds=time.time() - start_time, redirect_hops=hop)
+                return stream
+            if stream.status_code not in self.redirect_codes:
+                break
+            location = stream.headers.get('Location')
+            if location is None:
+                link = LinkFinder()
+                link.feed(stream.text)
+                location = link.download_link
+            stream.close()
+            current = urljoin(current, location)
+            auth = self.auth if urlparse(current).netloc == self.urs else None
+            stream = limited_get(self.session, current, auth=auth, allow_redirects=False, stream=True,
+                                 headers=headers)
+        stream.close()
+        raise RuntimeError("Earthdata Authentication Error: %s returned %s" % (current, stream.status_code))
 
 
 class LinkFinder(HTMLParser):
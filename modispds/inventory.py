@@ -0,0 +1,131 @@
+"""
+Inventory of a product's objects already in an S3 bucket, used to decide what is left to ingest
+"""
+
+import os
+import json
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from .pds import get_client
+
+logger = logging.getLogger(__name__)
+
+
+class Inventory(object):
+    """ Index of scene lists and granule object counts for a product in a bucket """
+
+    def __init__(self, bucket, product, prefix=''):
+        self.bucket = bucket
+        self.product = product
+        self.root = os.path.join(prefix, product)
+        # granule path (e.g., MCD43A4.006/11/12/2016001) -> number of objects
+        self.granules = {}
+        # dates (e.g., 2016-01-01) with a scene list
+        self.scenes = set()
+        self.timestamp = None
+        # False if only scene lists of some dates were listed, and granules are listed when counted
+        self.complete = True
+
+    def load(self, workers=16, dates=None):
+        """ Fetch listing of the product from S3, each tile prefix in parallel. If dates
+        are given only the scene lists of their months are listed, and the objects of
+        a granule are listed when it is counted, so a run over a few days does not list
+        the whole product """
+        start_time = time.time()
+        self.granules = {}
+        self.scenes = set()
+        if dates is not None:
+            return self._load_dates(dates, workers=workers)
+        self.complete = True
+        # top level holds scene lists and a prefix per horizontal tile number
+        tiles = []
+        for page in self._pages(self.root + '/', delimiter='/'):
+            for obj in page.get('Contents', []):
+                self._add(obj['Key'])
+            # other prefixes than horizontal tile numbers (e.g., the scene index) hold no granules
+            tiles.extend([p['Prefix'] for p in page.get('CommonPrefixes', [])
+                          if p['Prefix'][len(self.root) + 1:-1].isdigit()])
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for keys in executor.map(self._list, tiles):
+                for key in keys:
+                    self._add(key)
+        self.timestamp = time.time()
+        logger.info('Inventory of s3://%s/%s: %s scene lists, %s granules in %ss' %
+                    (self.bucket, self.root, len(self.scenes), len(self.granules), time.time() - start_time))
+        return self
+
+    def _load_dates(self, dates, workers=16):
+        """ Fetch scene lists of the months of dates, each month in parallel """
+        start_time = time.time()
+        self.complete = False
+        # scene lists are named by date (e.g., 2016-01-01_scenes.txt), so a month shares a prefix
+        months = sorted(set('%s/%04d-%02d' % (self.root, d.year, d.month) for d in dates))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for keys in executor.map(self._list, months):
+                for key in keys:
+                    self._add(key)
+        self.timestamp = time.time()
+        logger.info('Inventory of s3://%s/%s for %s months: %s scene lists in %ss' %
+                    (self.bucket, self.root, len(months), len(self.scenes), time.time() - start_time))
+        return self
+
+    def _pages(self, prefix, delimiter=''):
+        """ Iterate through pages of list_objects_v2 results """
+        paginator = get_client().get_paginator('list_objects_v2')
+        return paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter=delimiter)
+
+    def _list(self, prefix):
+        """ Get all keys under prefix """
+        return [obj['Key'] for page in self._pages(prefix) for obj in page.get('Contents', [])]
+
+    def _add(self, key):
+        """ Add object key to index """
+        path, fname = os.path.split(key)
+        if path == self.root:
+            if fname.endswith('_scenes.txt'):
+                self.scenes.add(fname.replace('_scenes.txt', ''))
+        else:
+            self.granules[path] = self.granules.get(path, 0) + 1
+
+    def has_scenes(self, day):
+        """ Check if scene list exists for a date """
+        return str(day) in self.scenes
+
+    def count(self, path):
+        """ Number of objects for a granule path (see main.get_s3_path), listed from S3
+        if the inventory was loaded for some dates only """
+        if not self.complete and path not in self.granules:
+            self.granules[path] = len(self._list(path + '/'))
+        return self.granules.get(path, 0)
+
+    def save(self, filename):
+        """ Save inventory to a JSON file """
+        with open(filename, 'w') as f:
+            json.dump({
+                'bucket': self.bucket,
+                'root': self.root,
+                'timestamp': self.timestamp,
+                'scenes': sorted(self.scenes),
+                'granules': self.granules
+            }, f)
+        return filename
+
+    @classmethod
+    def cached(cls, filename, bucket, product, prefix='', max_age=None, workers=16):
+        """ Read inventory from file if it exists and is newer than max_age seconds,
+        otherwise load it from S3 and save it to the file """
+        inv = cls(bucket, product, prefix=prefix)
+        if os.path.exists(filename):
+            with open(filename) as f:
+                data = json.load(f)
+            age = time.time() - data['timestamp']
+            if data['bucket'] == bucket and data['root'] == inv.root and (max_age is None or age < max_age):
+                logger.debug('Reading inventory from %s' % filename)
+                inv.scenes = set(data['scenes'])
+                inv.granules = data['granules']
+                inv.timestamp = data['timestamp']
+                return inv
+        inv.load(workers=workers)
+        inv.save(filename)
+        return inv
@@ -0,0 +1,158 @@
+"""
+Journal of the processing state of each granule, so that work already done survives failures
+"""
+
+import os
+import json
+import time
+import sqlite3
+import logging
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# states of a granule, in order. A granule is staged once its files are in the staging
+# area (see staging), and uploaded once they are all on s3
+STATES = ['queried', 'downloaded', 'converted', 'staged', 'uploaded']
+# states of granules not processed again
+DONE = STATES[-2:]
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS granules (
+        product TEXT, gid TEXT, date TEXT, state TEXT, attempts INTEGER, error TEXT,
+        granule TEXT, files TEXT, keys TEXT, metadata TEXT, updated REAL,
+        PRIMARY KEY (product, gid))""",
+    "CREATE INDEX IF NOT EXISTS granules_date ON granules (product, date)",
+]
+
+
+class Journal(object):
+    """ SQLite journal of granules by product and date, recording the state each has
+    reached, the files produced by the last stage and the S3 keys uploaded """
+
+    def __init__(self, filename):
+        self.filename = filename
+        dirname = os.path.dirname(filename)
+        if dirname != '' and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with self.connect() as conn:
+            for sql in SCHEMA:
+                conn.execute(sql)
+
+    @contextmanager
+    def connect(self):
+        """ Connection to the database, committing on success """
+        conn = sqlite3.connect(self.filename, timeout=60)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def add(self, product, date, granules):
+        """ Record granules found by a query for a date, keeping any already recorded """
+        rows = [(product, gid, str(date), STATES[0], 0, None, json.dumps(gran), None, None, None, time.time())
+                for gid, gran in granules]
+        with self.connect() as conn:
+            conn.executemany('INSERT OR IGNORE INTO granules VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def update(self, product, gid, state, files=None, keys=None, metadata=None):
+        """ Record that a granule reached a state, with the files or keys it produced """
+        with self.connect() as conn:
+            conn.execute('UPDATE granules SET state=?, files=?, keys=?, metadata=?, error=NULL, updated=? '
+                         'WHERE product=? AND gid=?',
+                         (state, _dumps(files), _dumps(keys), _dumps(metadata), time.time(), product, gid))
+        logger.debug('Granule %s %s' % (gid, state))
+
+    def fail(self, product, gid, error):
+        """ Record a failed attempt to process a granule """
+        with self.connect() as conn:
+            conn.execute('UPDATE granules SET attempts=attempts+1, error=?, updated=? WHERE product=? AND gid=?',
+                         (str(error), time.time(), product, gid))
+
+    def get(self, product, gid):
+        """ Get journal entry for a granule as a dictionary, or None """
+        with self.connect() as conn:
+            conn.row_factory = sqlite3.Row
+            row = conn.execute('SELECT * FROM granules WHERE product=? AND gid=?', (product, gid)).fetchone()
+        if row is None:
+            return None
+        entry = dict(row)
+        for key in ['granule', 'files', 'keys', 'metadata']:
+            entry[key] = json.loads(entry[key]) if entry[key] is not None else None
+        return entry
+
+    def promote(self, product, gid):
+        """ Record that the files of a staged granule are all uploaded """
+        with self.connect() as conn:
+            conn.execute('UPDATE granules SET state=?, updated=? WHERE product=? AND gid=? AND state=?',
+                         (STATES[-1], time.time(), product, gid, 'staged'))
+        logger.debug('Granule %s %s' % (gid, STATES[-1]))
+
+    def staged(self, product, date):
+        """ IDs of granules for a date that are staged but not yet uploaded """
+        with self.connect() as conn:
+            rows = conn.execute('SELECT gid FROM granules WHERE product=? AND date=? AND state=? ORDER BY gid',
+                                (product, str(date), 'staged')).fetchall()
+        return [r[0] for r in rows]
+
+    def todo(self, product, date, retries=None):
+        """ Granules for a date not yet staged or uploaded, and with attempts left if retries is given """
+        sql = 'SELECT granule FROM granules WHERE product=? AND date=? AND state NOT IN (?, ?)'
+        args = [product, str(date)] + DONE
+        if retries is not None:
+            sql += ' AND attempts<?'
+            args.append(retries)
+        with self.connect() as conn:
+            rows = conn.execute(sql + ' ORDER BY gid', args).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def failed(self, product, date):
+        """ Granules for a date not staged or uploaded after at least one attempt, as (gid, attempts, error) """
+        with self.connect() as conn:
+            return conn.execute('SELECT gid, attempts, error FROM granules WHERE product=? AND date=? '
+                                'AND state NOT IN (?, ?) AND attempts>0 ORDER BY gid',
+                                [product, str(date)] + DONE).fetchall()
+
+    def rearm(self, product, start_date=None, end_date=None):
+        """ Give granules not staged or uploaded, of a product or only those between two dates, their
+        attempts back, so each run retries granules that failed in earlier runs. Returns
+        how many granules had failed """
+        sql = 'UPDATE granules SET attempts=0 WHERE product=? AND state NOT IN (?, ?) AND attempts>0'
+        args = [product] + DONE
+        if start_date is not None:
+            sql += ' AND date>=?'
+            args.append(str(start_date))
+        if end_date is not None:
+            sql += ' AND date<=?'
+            args.append(str(end_date))
+        with self.connect() as conn:
+            return conn.execute(sql, args).rowcount
+
+    def scenes(self, product, date):
+        """ Metadata of granules staged or uploaded for a date, for the date's scene list (which
+        the uploader publishes once staged granules are uploaded, see staging) """
+        with self.connect() as conn:
+            rows = conn.execute('SELECT metadata FROM granules WHERE product=? AND date=? AND state IN (?, ?) '
+                                'ORDER BY gid', [product, str(date)] + DONE).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def reset(self, product, date=None, gid=None):
+        """ Forget granules of a product, or only those of a date or a single granule """
+        sql = 'DELETE FROM granules WHERE product=?'
+        args = [product]
+        if date is not None:
+            sql += ' AND date=?'
+            args.append(str(date))
+        if gid is not None:
+            sql += ' AND gid=?'
+            args.append(gid)
+        with self.connect() as conn:
+            n = conn.execute(sql, args).rowcount
+        logger.debug('Removed %s granules from journal' % n)
+        return n
+
+
+def _dumps(value):
+    # dates in metadata are stored as they appear in scene lists
+    return json.dumps(value, default=str) if value is not None else None
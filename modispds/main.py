@@ -1,16 +1,35 @@
+import io
 import sys
+import csv
 import time
 import os
+import json
+import tempfile
 import datetime
 import logging
 import argparse
-import subprocess
+from functools import partial
+from contextlib import contextmanager
 from dateutil.parser import parse
-from modispds.earthdata import query, download_granule
-from modispds.pds import push_to_s3, s3_list, make_index, make_scene_list, exists
-import gippy
+from appdirs import user_cache_dir
+from concurrent.futures import ThreadPoolExecutor
+from modispds.earthdata import query_dates, download_granule, cmr_config, granule_identity, changed
+from modispds.pds import push_to_s3, s3_list, read_from_s3, make_index, render_index, make_scene_list
+from modispds.pds import get_client, iter_objects, delete_keys, delete_prefix
+from modispds.memory import MemoryFile, budget, to_memory, filename, release
+from modispds.scratch import scratch, scratch_config, estimate
+from modispds.staging import Uploader, get_staging, staging_config
+from modispds.convert import convert_to_geotiff, convert_config, output_settings, output_files, FORMATS, LAYOUTS
 from modispds.version import __version__
 from modispds.products import products
+from modispds.pipeline import Pipeline, Stage
+from modispds.scheduler import Scheduler, order_jobs, ORDERS
+from modispds.inventory import Inventory
+from modispds.journal import Journal
+from modispds.workqueue import open_queue, Heartbeat
+from modispds.metrics import metrics, metrics_config, serve
+from modispds.sceneindex import SceneIndex, index_config
+from modispds.profiling import profile_stage, profile_summary, profile_config
 
 # quiet these loggers
 logging.getLogger('boto3').setLevel(logging.CRITICAL)
@@ -29,107 +48,747 @@ _PRODUCT = 'MCD43A4.006'
 bucket = os.getenv('BUCKET', 'modis-pds')
 
 
-def ingest(start_date, end_date, product=_PRODUCT, outdir='', overwrite=False):
-    """ Ingest all granules between two dates """
+def ingest(start_date, end_date, product=_PRODUCT, outdir='', overwrite=False,
+           workers=0, download_workers=None, upload_workers=None, inventory=None, journal=None, retries=3,
+           refresh=False):
+    """ Ingest all granules between two dates. If workers is nonzero granules are
+    processed concurrently in a pipeline, otherwise one at a time. Dates already
+    processed are determined from the inventory, which is loaded for the months of
+    the dates if not provided (see Inventory.load).
+    overwrite is True to reprocess everything, or a list of dates and granule IDs
+    to reprocess. If refresh is True dates already processed are checked too, and
+    only granules that changed in CMR since they were processed are reprocessed (see
+    refresh_granules). If a journal is given each granule's progress is recorded in it,
+    and granules that fail are retried up to retries times without redoing the rest """
     d1 = parse(start_date)
     d2 = parse(end_date)
     dates = [d1 + datetime.timedelta(n) for n in range((d2 - d1).days + 1)]
+    dates_overwrite, gids_overwrite = parse_overwrite(overwrite)
+    pipeline = None
+    if workers:
+        pipeline = make_pipeline(outdir=outdir, workers=workers, download_workers=download_workers,
+                                 upload_workers=upload_workers, journal=journal)
+    if inventory is None and overwrite is not True:
+        inventory = Inventory(bucket, product).load(dates=dates)
+    days = []
     for day in [d.date() for d in dates]:
-        start = datetime.datetime.now()
-        index_fname = str(day) + '_scenes.txt'
-        if exists(os.path.join('s3://%s' % bucket, os.path.join(product, index_fname))) and not overwrite:
+        if overwrite is not True and not refresh and day not in dates_overwrite and inventory.has_scenes(day):
             logger.info("Scenes for %s already processed" % day)
-            continue
+        else:
+            days.append(day)
+    days.extend([get_date(gid).date() for gid in gids_overwrite if get_date(gid).date() not in days])
+    if journal is not None:
+        for day in days:
+            if overwrite is True or day in dates_overwrite:
+                journal.reset(product, date=day)
+        for gid in gids_overwrite:
+            journal.reset(product, gid=gid)
+
+    # granules for a range of days are fetched with one query
+    for day, granules in query_dates(days, product=product, refresh=refresh):
+        start = datetime.datetime.now()
         logger.info('Processing date %s' % day)
-        granules = query(day, day, product=product)
 
-        metadata = []
+        todo, unchanged = granules, []
+        if refresh and overwrite is not True and day not in dates_overwrite:
+            todo, unchanged = refresh_granules(granules, inventory=inventory)
+            if len(todo) == 0 and inventory.has_scenes(day):
+                logger.info('No granules changed for %s' % day)
+                continue
         try:
-            for gran in granules:
-                metadata.append(ingest_granule(gran, outdir=outdir))
+            if journal is not None:
+                # granules on s3 are only reused if the date is not being overwritten
+                inv = None if overwrite is True or day in dates_overwrite else inventory
+                gids = [get_gid(gran) for gran in todo] if refresh else []
+                for gid in gids:
+                    journal.reset(product, gid=gid)
+                metadata = ingest_journal(day, granules, journal, product=product, outdir=outdir, pipeline=pipeline,
+                                          retries=retries, inventory=inv, overwrite=list(gids_overwrite) + gids)
+            elif pipeline is not None:
+                metadata = ingest_granules(todo, pipeline)
+            else:
+                metadata = []
+                for gran in todo:
+                    metadata.append(ingest_granule(gran, outdir=outdir))
+            if journal is None and len(unchanged) > 0:
+                metadata = sorted(metadata + [granule_metadata(get_gid(g)) for g in unchanged],
+                                  key=lambda md: md['gid'])
         except RuntimeError as e:
             logger.error('Error processing %s: %s' % (day, str(e)))
             # skip this entire date for now
             continue
         # upload index file
         if len(granules) > 0:
-            fname = make_scene_list(metadata, fout=index_fname)
-            push_to_s3(fname, bucket, prefix=product)
+            publish_scenes(product, day, metadata, outdir=outdir)
         logger.info('Completed processing %s: %s' % (day, datetime.datetime.now() - start))
+        metrics.flush()
+
+
+def parse_overwrite(overwrite):
+    """ Split list of dates and granule IDs to overwrite, returning (dates, gids) """
+    if overwrite in [True, False, None]:
+        return [], []
+    dates = [parse(o).date() for o in overwrite if '.' not in o]
+    gids = [o.replace('.hdf', '') for o in overwrite if '.' in o]
+    return dates, gids
+
+
+def ingest_journal(day, granules, journal, product=_PRODUCT, outdir='', pipeline=None, retries=3,
+                   inventory=None, overwrite=()):
+    """ Ingest granules for a day that the journal does not have as uploaded, retrying
+    failed granules until each has used up its retries in this run. Granules complete in
+    the inventory, other than those to overwrite, are recorded as uploaded without being
+    processed again. Returns metadata of all the day's uploaded granules """
+    journal_granules(day, granules, journal, product=product, inventory=inventory, overwrite=overwrite)
+    n = journal.rearm(product, day, day)
+    if n > 0:
+        logger.info('Retrying %s granules for %s that failed in an earlier run' % (n, day))
+    for attempt in range(retries):
+        todo = journal.todo(product, day, retries=retries)
+        if len(todo) == 0:
+            break
+        logger.info('Processing %s of %s granules for %s' % (len(todo), len(granules), day))
+        if pipeline is not None:
+            for task in pipeline.run(todo):
+                if task.error is not None:
+                    journal.fail(product, get_gid(task.item), '%s: %s' % (task.stage, str(task.error)))
+        else:
+            for gran in todo:
+                try:
+                    ingest_granule(gran, outdir=outdir, journal=journal)
+                except Exception as e:
+                    logger.error('Error processing granule %s: %s' % (get_gid(gran), str(e)))
+                    journal.fail(product, get_gid(gran), str(e))
+    failed = journal.failed(product, day)
+    if len(failed) > 0:
+        raise RuntimeError('%s of %s granules failed, %s after %s attempts: %s' %
+                           (len(failed), len(granules), failed[0][0], failed[0][1], failed[0][2]))
+    return journal.scenes(product, day)
+
+
+def journal_granules(day, granules, journal, product=_PRODUCT, retries=None, inventory=None, overwrite=()):
+    """ Add a day's granules to the journal, recording those complete in the inventory
+    (other than those to overwrite) as uploaded, and checking those staged in an earlier
+    run against the staging area (see resume_staged). Returns granules left to process """
+    journal.add(product, day, [(get_gid(gran), gran) for gran in granules])
+    resume_staged(day, journal, product=product)
+    for gran in journal.todo(product, day):
+        gid = get_gid(gran)
+        if inventory is not None and gid not in overwrite and granule_exists(gid, inventory=inventory):
+            logger.debug('Granule %s already on s3' % gid)
+            journal.update(product, gid, 'uploaded', metadata=granule_metadata(gid))
+    return journal.todo(product, day, retries=retries)
+
+
+def resume_staged(day, journal, product=_PRODUCT):
+    """ Record granules of a day staged in an earlier run as uploaded if the staging area
+    has uploaded all their files, leave those still waiting there to the uploader, and
+    process again those it does not have (e.g., staging was disabled or the area removed) """
+    staging = get_staging()
+    for gid in journal.staged(product, day):
+        waiting = staging.waiting(gid) if staging is not None else None
+        if waiting is None:
+            logger.warning('Granule %s was staged but is not in the staging area, processing it again' % gid)
+            journal.update(product, gid, 'queried')
+        elif waiting == 0:
+            journal.promote(product, gid)
+
+
+def backfill(products, start_date, end_date, order='newest', outdir='', overwrite=False, workers=1,
+             download_workers=None, upload_workers=None, inventories=None, journal=None, retries=3, interval=60,
+             refresh=False):
+    """ Ingest several products between two dates, with the granules of all products
+    going through one pipeline in the given order (see scheduler.order_jobs). If
+    refresh is True days already processed are checked for granules that changed in
+    CMR, and only those are reprocessed (see refresh_granules). If a journal is given,
+    days with failed granules are run again until the granules use up their retries,
+    which granules that failed in earlier runs are given again """
+    d1 = parse(start_date)
+    d2 = parse(end_date)
+    dates = [(d1 + datetime.timedelta(n)).date() for n in range((d2 - d1).days + 1)]
+    inventories = inventories or {}
+    days = {}
+    for product in products:
+        if overwrite:
+            days[product] = dates
+            if journal is not None:
+                for day in dates:
+                    journal.reset(product, date=day)
+            continue
+        if product not in inventories:
+            inventories[product] = Inventory(bucket, product).load(dates=dates)
+        days[product] = [d for d in dates if refresh or not inventories[product].has_scenes(d)]
+        logger.info('%s: %s of %s days to process' % (product, len(days[product]), len(dates)))
+    if journal is not None and not overwrite and len(dates) > 0:
+        for product in products:
+            n = journal.rearm(product, dates[0], dates[-1])
+            if n > 0:
+                logger.info('Retrying %s granules of %s that failed in an earlier run' % (n, product))
+    jobs = order_jobs(products, days, order=order)
+    pipeline = make_pipeline(outdir=outdir, workers=workers, download_workers=download_workers,
+                             upload_workers=upload_workers, journal=journal)
+    # days with granules left to retry
+    retry = []
+    # metadata of granules that have not changed, by (product, day), when refreshing
+    unchanged = {}
+
+    def query(product, days):
+        for day, granules in query_dates(days, product=product, refresh=refresh):
+            if refresh and not overwrite:
+                todo, same = refresh_granules(granules, inventory=inventories[product])
+                if len(todo) == 0 and inventories[product].has_scenes(day):
+                    logger.info('No granules of %s changed for %s' % (product, day))
+                    yield day, []
+                    continue
+                if journal is not None:
+                    for gran in todo:
+                        journal.reset(product, gid=get_gid(gran))
+                unchanged[(product, day)] = [granule_metadata(get_gid(g)) for g in same]
+                granules = todo if journal is None else granules
+            if journal is not None:
+                granules = journal_granules(day, granules, journal, product=product, retries=retries,
+                                            inventory=None if overwrite else inventories[product])
+            yield day, granules
+
+    def finalize(product, day, tasks):
+        failed = [t for t in tasks if t.error is not None]
+        for t in failed:
+            logger.error('Error processing granule %s: %s' % (get_gid(t.item), str(t.error)))
+            if journal is not None:
+                journal.fail(product, get_gid(t.item), '%s: %s' % (t.stage, str(t.error)))
+        if journal is not None:
+            if len(journal.todo(product, day, retries=retries)) > 0:
+                retry.append((product, day))
+                return
+            if len(journal.failed(product, day)) > 0:
+                logger.error('Granules failed for %s %s, skipping scene list' % (product, day))
+                return
+            metadata = journal.scenes(product, day)
+        elif len(failed) > 0:
+            logger.error('%s of %s granules failed for %s %s, skipping scene list' %
+                         (len(failed), len(tasks), product, day))
+            return
+        else:
+            metadata = sorted([t.value for t in tasks] + unchanged.pop((product, day), []), key=lambda md: md['gid'])
+        if len(metadata) > 0:
+            publish_scenes(product, day, metadata, outdir=outdir)
+        metrics.flush()
+
+    scheduler = Scheduler(pipeline, query, finalize, days=cmr_config['days'], interval=interval)
+    progress = scheduler.run(jobs)
+    for attempt in range(1, retries):
+        if len(retry) == 0:
+            break
+        jobs = sorted(retry, key=jobs.index)
+        logger.info('Retrying failed granules for %s days' % len(jobs))
+        retry[:] = []
+        scheduler.run(jobs)
+    return progress
+
+
+def enqueue(products, start_date, end_date, queue, overwrite=False, inventories=None, refresh=False):
+    """ Add a task to the work queue for each granule of the products between two dates.
+    Granules already complete in the inventory are added as done. If refresh is True
+    days already processed are checked too, and granules that changed in CMR since
+    they were processed are queued to run again (see refresh_granules) """
+    d1 = parse(start_date)
+    d2 = parse(end_date)
+    dates = [(d1 + datetime.timedelta(n)).date() for n in range((d2 - d1).days + 1)]
+    inventories = inventories or {}
+    count = 0
+    for product in products:
+        inventory = None
+        if not overwrite:
+            if product not in inventories:
+                inventories[product] = Inventory(bucket, product).load(dates=dates)
+            inventory = inventories[product]
+        days = [d for d in dates if inventory is None or refresh or not inventory.has_scenes(d)]
+        for day, granules in query_dates(days, product=product, refresh=refresh):
+            todo = None
+            if refresh and inventory is not None:
+                todo = set(get_gid(g) for g in refresh_granules(granules, inventory=inventory)[0])
+                if len(todo) == 0 and inventory.has_scenes(day):
+                    continue
+            tasks = []
+            for gran in granules:
+                gid = get_gid(gran)
+                result = None
+                if todo is not None:
+                    result = None if gid in todo else granule_metadata(gid)
+                elif inventory is not None and granule_exists(gid, inventory=inventory):
+                    result = granule_metadata(gid)
+                tasks.append({'product': product, 'date': day, 'gid': gid, 'granule': gran, 'result': result})
+            if todo is not None:
+                # changed granules run again even if already queued
+                n = queue.put([t for t in tasks if t['gid'] in todo], overwrite=True)
+                n += queue.put([t for t in tasks if t['gid'] not in todo])
+            else:
+                n = queue.put(tasks, overwrite=overwrite)
+            logger.info('Queued %s of %s granules for %s %s' % (n, len(tasks), product, day))
+            count += n
+            # no worker will finish a day that is already complete
+            if len(tasks) > 0 and all(t['result'] is not None for t in tasks):
+                publish_scenes(product, day, [t['result'] for t in tasks])
+    logger.info('Queued %s granules, queue has %s' % (count, queue.counts()))
+    return count
+
+
+def work(queue, outdir='', workers=0, download_workers=None, upload_workers=None, visibility=1800, wait=0,
+         limit=None):
+    """ Process tasks from the work queue until it is empty, or if wait is nonzero poll
+    for more every wait seconds. Leases on tasks are kept alive while they are being
+    processed, and the worker finishing the last task of a day publishes its scene list.
+    If workers is nonzero tasks are processed concurrently in a pipeline """
+    heartbeat = Heartbeat(queue, visibility=visibility).start()
+    leases = []
+
+    def tasks():
+        while limit is None or len(leases) < limit:
+            lease = queue.get(visibility=visibility)
+            if lease is None:
+                if wait == 0:
+                    return
+                time.sleep(wait)
+                continue
+            heartbeat.add(lease)
+            leases.append(lease)
+            yield lease.granule
+
+    def done(lease, result, error=None):
+        heartbeat.remove(lease)
+        if error is not None:
+            logger.error('Error processing granule %s: %s' % (lease.gid, str(error)))
+            queue.nack(lease, error)
+        elif queue.ack(lease, result):
+            publish_scenes(lease.product, lease.date, queue.results(lease.product, lease.date), outdir=outdir)
+            for state, count in queue.counts().items():
+                metrics.gauge('work_queue_tasks', count, labels={'state': state})
+            metrics.flush()
+
+    try:
+        if workers:
+            pipeline = make_pipeline(outdir=outdir, workers=workers, download_workers=download_workers,
+                                     upload_workers=upload_workers)
+            pipeline.run(tasks(), callback=lambda t: done(leases[t.index], t.value, t.error))
+        else:
+            for gran in tasks():
+                try:
+                    result = ingest_granule(gran, outdir=outdir)
+                except Exception as e:
+                    done(leases[-1], None, e)
+                else:
+                    done(leases[-1], result)
+    finally:
+        heartbeat.stop()
+        metrics.flush()
+    logger.info('Worker processed %s granules, queue has %s' % (len(leases), queue.counts()))
+    return len(leases)
+
+
+def plan(products, start_date, end_date, inventories=None, granules=True):
+    """ Work left to ingest products between two dates, from CMR queries and S3 listings
+    alone: the days with granules but no scene list, the granules of those days not on
+    S3, and estimates of the bytes to download and objects to upload. If granules is
+    False the granules of each day are counted rather than listed """
+    d1 = parse(start_date)
+    d2 = parse(end_date)
+    dates = [(d1 + datetime.timedelta(n)).date() for n in range((d2 - d1).days + 1)]
+    inventories = inventories or {}
+    result = {'start_date': str(dates[0]), 'end_date': str(dates[-1]), 'products': {}}
+    for product in products:
+        if product not in inventories:
+            inventories[product] = Inventory(bucket, product).load(dates=dates)
+        inventory = inventories[product]
+        days = {}
+        nbytes = 0.0
+        for day, grans in query_dates([d for d in dates if not inventory.has_scenes(d)], product=product):
+            if len(grans) == 0:
+                continue
+            missing = [g for g in grans if not granule_exists(get_gid(g), inventory=inventory)]
+            nbytes += sum(float(g.get('granule_size', 0)) for g in missing) * 1024 * 1024
+            days[str(day)] = [get_gid(g) for g in missing] if granules else len(missing)
+        count = sum(len(g) for g in days.values()) if granules else sum(days.values())
+        result['products'][product] = {
+            'days': days,
+            'granules': count,
+            'bytes': int(nbytes),
+            # a scene list for each day
+            'objects': count * expected_objects(product) + len(days),
+        }
+    for key in ['granules', 'bytes', 'objects']:
+        result[key] = sum(p[key] for p in result['products'].values())
+    result['days'] = sum(len(p['days']) for p in result['products'].values())
+    return result
+
+
+def purge(product, start_date=None, end_date=None, tiles=None, prefix='', dry_run=False, workers=8):
+    """ Delete the granules of a product whose scene list dates are between two dates
+    (all dates if not given), of all tiles or only the given tiles (e.g., h11v12). The
+    granules are first removed from their scene lists and the scene index, so no scene
+    list refers to deleted granules, and scene lists left empty are deleted. Objects
+    are then deleted in batches (see pds.delete_keys). If dry_run is True nothing is
+    changed. Returns counts of granules, objects and bytes, and the number of granules
+    removed from the scene list of each date """
+    root = os.path.join(prefix, product)
+    offset = products[product]['day_offset']
+    start = parse(start_date).date() if start_date else datetime.date.min
+    end = parse(end_date).date() if end_date else datetime.date.max
+    tiles = set(t.lower() for t in tiles) if tiles else None
+    result = {'granules': 0, 'objects': 0, 'bytes': 0, 'scene_lists': {}, 'dry_run': dry_run}
+
+    # scene lists in the top level of the product
+    client = get_client()
+    for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=root + '/', Delimiter='/'):
+        for obj in page.get('Contents', []):
+            fname = os.path.basename(obj['Key'])
+            if not fname.endswith('_scenes.txt') or not start <= parse(fname[:10]).date() <= end:
+                continue
+            day = fname[:10]
+            rows = list(csv.DictReader(io.StringIO(read_from_s3('s3://%s/%s' % (bucket, obj['Key'])).decode('utf-8'))))
+            keep = [r for r in rows if tiles is not None and r['gid'].split('.')[2] not in tiles]
+            if len(keep) == len(rows):
+                continue
+            result['scene_lists'][day] = len(rows) - len(keep)
+            if dry_run:
+                continue
+            removed = set(r['gid'].split('.')[2] for r in rows) - set(r['gid'].split('.')[2] for r in keep)
+            update_index(product, day, keep, prefix=prefix, tiles=sorted(removed))
+            if len(keep) > 0:
+                tmpdir = tempfile.mkdtemp()
+                fname = make_scene_list(keep, fout=os.path.join(tmpdir, fname))
+                push_to_s3(fname, bucket, prefix=root)
+                os.remove(fname)
+                os.rmdir(tmpdir)
+            else:
+                client.delete_object(Bucket=bucket, Key=obj['Key'])
+            logger.info('Removed %s granules from scene list of %s %s' % (len(rows) - len(keep), product, day))
+
+    # granule objects, under <product>/<h>/<v>/<YYYYDDD>/
+    if tiles is not None:
+        # e.g., h08v05 is under 08/05/ (see get_s3_path)
+        prefixes = ['%s/%s/%s/' % (root, t[1:3], t[4:6]) for t in sorted(tiles)]
+    else:
+        prefixes = []
+        for page in client.get_paginator('list_objects_v2').paginate(Bucket=bucket, Prefix=root + '/', Delimiter='/'):
+            prefixes.extend(p['Prefix'] for p in page.get('CommonPrefixes', [])
+                            if p['Prefix'][len(root) + 1:-1].isdigit())
+    granules = set()
 
+    def matches(key):
+        parts = key[len(root) + 1:].split('/')
+        if len(parts) < 4 or not (len(parts[2]) == 7 and parts[2].isdigit()):
+            return False
+        day = (datetime.datetime.strptime(parts[2], '%Y%j') + datetime.timedelta(offset)).date()
+        return start <= day <= end
 
-def ingest_granule(gran, outdir='', prefix=''):
+    def list_prefix(prefix):
+        return [obj for obj in iter_objects(bucket, prefix) if matches(obj['Key'])]
+
+    def keys():
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for objs in executor.map(list_prefix, prefixes):
+                for obj in objs:
+                    granules.add(os.path.dirname(obj['Key']))
+                    result['objects'] += 1
+                    result['bytes'] += obj.get('Size', 0)
+                    yield obj['Key']
+
+    if dry_run:
+        for key in keys():
+            pass
+    else:
+        delete_keys(bucket, keys(), workers=workers)
+    result['granules'] = len(granules)
+    logger.info('%s %s granules (%s objects, %.1f MB) of %s and %s scene lists' %
+                ('Would delete' if dry_run else 'Deleted', result['granules'], result['objects'],
+                 result['bytes'] / 1024.0 / 1024.0, product, len(result['scene_lists'])))
+    return result
+
+
+def refresh_granules(granules, prefix='', inventory=None, workers=16):
+    """ Split granules into those that changed in CMR since they were processed, or were
+    never (completely) processed, and those unchanged, comparing the identity of each
+    (see earthdata.granule_identity) with the one stored in its _meta.json on S3 """
+    def check(gran):
+        gid = get_gid(gran)
+        if not granule_exists(gid, prefix=prefix, inventory=inventory):
+            return True
+        return changed(granule_identity(gran), stored_identity(gid, prefix=prefix))
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        flags = list(executor.map(check, granules))
+    todo = [g for g, f in zip(granules, flags) if f]
+    logger.info('%s of %s granules changed since they were processed' % (len(todo), len(granules)))
+    return todo, [g for g, f in zip(granules, flags) if not f]
+
+
+def stored_identity(gid, prefix=''):
+    """ Identity of a granule stored in its _meta.json on S3, or None if it has none. Metadata
+    stored before identities were added has the identity of the CMR metadata it holds """
+    data = read_from_s3(os.path.join('s3://%s' % bucket, get_s3_path(gid, prefix=prefix), gid + '_meta.json'))
+    if data is None:
+        return None
+    meta = json.loads(data.decode('utf-8'))
+    return meta.get('identity') or granule_identity(meta)
+
+
+def publish_scenes(product, day, metadata, outdir=''):
+    """ Publish scene list for a day of a product. If granules are staged (see staging)
+    the scene list is recorded in the staging area, and published by the uploader once
+    all of the day's files are uploaded """
+    staging = get_staging()
+    if staging is not None:
+        staging.add_day(product, day, metadata)
+        logger.info('Scene list of %s granules for %s %s waiting on staged uploads' % (len(metadata), product, day))
+        return None
+    return push_scenes(product, day, metadata, outdir=outdir)
+
+
+def push_scenes(product, day, metadata, outdir=''):
+    """ Write scene list for a day of a product and push it to s3, after merging the
+    day's scenes into the product's scene index if enabled (see sceneindex) """
+    # scene lists of each product written to a directory of their own
+    scenedir = os.path.join(outdir, product)
+    if not os.path.exists(scenedir):
+        os.makedirs(scenedir)
+    fname = make_scene_list(metadata, fout=os.path.join(scenedir, str(day) + '_scenes.txt'))
+    # the scene list marks the day as done, so it is pushed once the index has the day
+    update_index(product, day, metadata)
+    push_to_s3(fname, bucket, prefix=product)
+    logger.info('Published scene list of %s granules for %s %s' % (len(metadata), product, day))
+    return fname
+
+
+def update_index(product, day, metadata, prefix='', tiles=()):
+    """ Merge a day's scenes into the product's scene index, if enabled. A failure is
+    logged rather than raised, so the day's scene list is still published """
+    if not index_config['enabled']:
+        return []
+    try:
+        return SceneIndex(bucket, product, prefix=prefix).update(day, metadata, tiles=tiles)
+    except Exception as e:
+        logger.error('Error updating scene index of %s for %s: %s' % (product, day, str(e)))
+        metrics.record('index_error', labels={'product': product})
+        return []
+
+
+@contextmanager
+def uploading(sync=True, journal=None):
+    """ Upload staged granules in the background while the block runs, and wait for all
+    of them to be uploaded after, recording each in the journal as uploaded once all its
+    files are. Does nothing if staging is not enabled, or sync is False (leaving staged
+    granules for modis-pds sync, and the next run to record them uploaded) """
+    staging = get_staging()
+    if staging is None or not sync:
+        yield None
+        return
+    promoted = partial(promote_granule, journal=journal) if journal is not None else None
+    uploader = Uploader(staging, partial(push_scenes, outdir=staging.root), promoted=promoted).start()
+    try:
+        yield uploader
+    finally:
+        uploader.stop()
+
+
+def promote_granule(gid, journal):
+    """ Record a staged granule as uploaded in the journal """
+    journal.promote(get_product(gid), gid)
+
+
+def make_pipeline(outdir='', prefix='', workers=1, download_workers=None, upload_workers=None, maxsize=None,
+                  journal=None):
+    """ Create pipeline of download (threads), convert (processes), and upload (threads) stages """
+    return Pipeline([
+        Stage('download', partial(fetch_granule, outdir=outdir, journal=journal), workers=download_workers or workers),
+        Stage('convert', partial(convert_granule, journal=journal), workers=workers, processes=True),
+        Stage('upload', partial(upload_granule, prefix=prefix, journal=journal), workers=upload_workers or workers),
+    ], maxsize=maxsize, cleanup=cleanup_granule)
+
+
+def cleanup_granule(task):
+    """ Release the scratch space of a granule leaving the pipeline, keeping the files of
+    a failed granule for its next attempt (upload_granule removes those of a granule
+    that is done), and release the memory of any MemoryFiles a failed upload left """
+    scratch.release(get_gid(task.item))
+    if isinstance(task.value, tuple):
+        release(task.value[1])
+
+
+def ingest_granules(granules, pipeline):
+    """ Ingest granules concurrently, returning metadata in the same order as granules """
+    start_time = time.time()
+    tasks = pipeline.run(granules)
+    failed = [t for t in tasks if t.error is not None]
+    if len(failed) > 0:
+        raise RuntimeError('%s of %s granules failed, first error in %s stage: %s' %
+                           (len(failed), len(tasks), failed[0].stage, str(failed[0].error)))
+    logger.info('Completed processing %s granules in : %ss' % (len(tasks), time.time() - start_time))
+    return [t.value for t in tasks]
+
+
+def ingest_granule(gran, outdir='', prefix='', journal=None):
     """ Fetch granule, process, and push to s3 """
-    bname = os.path.basename(gran['links'][0]['href'])
-    gid = os.path.splitext(bname)[0]
+    gid = get_gid(gran)
     start_time = time.time()
     logger.debug('Processing granule %s' % gid)
 
-    # create geotiffs
+    try:
+        fnames = fetch_granule(gran, outdir=outdir, journal=journal)
+        bname, files = convert_granule(fnames, journal=journal)
+        metadata = upload_granule((bname, files), prefix=prefix, journal=journal)
+    finally:
+        # files of a failed granule are kept for its next attempt
+        scratch.release(gid)
+        metrics.flush_events()
+
+    logger.info('Completed processing granule %s in : %ss' % (gid, time.time() - start_time))
+    return metadata
+
+
+@profile_stage('download', lambda gran: get_gid(gran))
+def fetch_granule(gran, outdir='', journal=None):
+    """ Download granule into a working directory of its own in the scratch space (see
+    scratch), waiting for disk space to be free if it is limited, and resuming any
+    partial download an earlier attempt left there. If the journal has the granule as
+    downloaded, and its files still exist, those are returned instead. If it has the
+    granule as converted the converted files are returned, which convert_granule passes
+    on unchanged. The working directory is removed by upload_granule, and kept with its
+    space released by the caller if the granule fails """
+    gid = get_gid(gran)
+    if journal is not None:
+        entry = journal.get(get_product(gid), gid)
+        if entry is not None and entry['state'] in ['downloaded', 'converted'] and _exists(entry['files']):
+            logger.debug('Granule %s already %s' % (gid, entry['state']))
+            # left by an earlier attempt, and already taking up space
+            scratch.add(gid, os.path.dirname(entry['files'][0]), sum(os.path.getsize(f) for f in entry['files']))
+            if entry['state'] == 'converted':
+                return gid + '.hdf', entry['files']
+            return entry['files']
+    workdir = scratch.create(gid, nbytes=estimate(gran), root=outdir)
     logger.debug('Downloading granule %s' % gid)
-    fnames = download_granule(gran, outdir=outdir)
+    fnames = download_granule(gran, outdir=workdir)
+    if journal is not None:
+        journal.update(get_product(gid), gid, 'downloaded', files=fnames)
+    return fnames
+
+
+@profile_stage('convert', lambda fnames: _basename(fnames[0]))
+def convert_granule(fnames, journal=None):
+    """ Create GeoTIFFs and index.html from downloaded granule files, returning the
+    granule basename and list of files (or MemoryFiles) to upload """
+    # already converted (see fetch_granule)
+    if isinstance(fnames, tuple):
+        return fnames
+    hdf = fnames[0]
+    bname = os.path.basename(hdf)
+    gid = os.path.splitext(bname)[0]
+    workdir = os.path.dirname(hdf)
 
     logger.debug('Converting granule to GeoTIFFs')
-    files = convert_to_geotiff(fnames[0])
+    files = convert_to_geotiff(hdf, outdir=workdir)
 
     # create index.html
-    files.extend(fnames[2:])
-    index_fname = make_index(fnames[1], bname, files)
-    files.append(index_fname)
-    files.append(fnames[1])
+    try:
+        files.extend(fnames[2:])
+        names = [filename(f) for f in files]
+        if convert_config['memory']:
+            html = render_index(os.path.basename(fnames[1]), bname, names)
+            files.append(to_memory('index.html', html.encode('utf-8'), outdir=workdir))
+        else:
+            files.append(make_index(os.path.basename(fnames[1]), bname, names, outdir=workdir))
+        files.append(fnames[1])
+    except Exception:
+        release(files)
+        raise
 
-    # upload files to s3
+    # cleanup original download
+    os.remove(hdf)
+    if journal is not None:
+        # files held in memory do not outlive this run
+        on_disk = not any(isinstance(f, MemoryFile) for f in files)
+        journal.update(get_product(gid), gid, 'converted', files=files if on_disk else None)
+    return bname, files
+
+
+@profile_stage('upload', lambda converted: _basename(converted[0]))
+def upload_granule(converted, prefix='', journal=None):
+    """ Push converted granule files to s3, or move them to the staging area if enabled,
+    and return granule metadata. The journal has a staged granule as staged, until the
+    uploader has uploaded its files (see uploading) """
+    bname, files = converted
+    gid = os.path.splitext(bname)[0]
     path = get_s3_path(bname, prefix=prefix)
-    logger.debug('Uploading files to s3://%s/%s' % (bucket, path))
+    staging = get_staging()
     s3fnames = []
-    for f in files:
-        s3fnames.append(push_to_s3(f, bucket, path))
-        # cleanup
-        os.remove(f)
+    if staging is not None:
+        logger.debug('Staging files for s3://%s/%s' % (bucket, path))
+        s3fnames = staging.stage(bucket, path, gid, files)
+        files = []
+    else:
+        logger.debug('Uploading files to s3://%s/%s' % (bucket, path))
+    try:
+        for f in files:
+            if isinstance(f, MemoryFile):
+                s3fnames.append(push_to_s3(f.name, bucket, path, data=f.data))
+                release([f])
+            else:
+                s3fnames.append(push_to_s3(f, bucket, path))
+    finally:
+        # MemoryFiles not uploaded because of an error
+        release(converted[1])
+    # remove granule working directory
+    scratch.remove(gid)
 
-    # cleanup original download
-    os.remove(fnames[0])
+    metadata = granule_metadata(gid, prefix=prefix)
+    if journal is not None:
+        state = 'staged' if staging is not None else 'uploaded'
+        journal.update(get_product(gid), gid, state, keys=s3fnames, metadata=metadata)
+    return metadata
 
-    logger.info('Completed processing granule %s in : %ss' % (gid, time.time() - start_time))
+
+def granule_metadata(gid, prefix=''):
+    """ Metadata of an uploaded granule, for the scene list """
     return {
         'gid': gid,
         'date': get_date(gid),
-        'download_url': os.path.join('https://%s.s3.amazonaws.com' % bucket, path, 'index.html')
+        'download_url': os.path.join('https://%s.s3.amazonaws.com' % bucket, get_s3_path(gid, prefix=prefix),
+                                     'index.html')
     }
 
 
-def convert_to_geotiff(hdf, outdir=''):
-    bname = os.path.basename(hdf)
-    parts = bname.split('.')
-    product = parts[0] + '.' + parts[3]
-    bandnames = products[product]['bandnames']
-    overviews = products[product]['overviews']
-    file_names = []
-    img = gippy.GeoImage(hdf, True)
-    opts = {'COMPRESS': 'DEFLATE', 'PREDICTOR': '2', 'TILED': 'YES', 'BLOCKXSIZE': '512', 'BLOCKYSIZE': '512'}
-    # save each band as a TIF
-    for i, band in enumerate(img):
-        fname = os.path.join(outdir, bname.replace('.hdf', '') + '_' + bandnames[i] + '.TIF')
-        logger.debug('Writing %s' % fname)
-        imgout = img.select([i+1]).save(fname, options=opts)
-        imgout = None
-        file_names.append(fname)
-        # add overview as separate file
-        if overviews[i]:
-            cmd = 'gdaladdo -ro -r average --config COMPRESS_OVERVIEW DEFLATE %s 2 4 8' % fname
-            logger.debug('Creating overviews: %s' % cmd)
-            out = subprocess.check_output(cmd.split(' '))
-            logger.debug(out)
-            file_names.append(fname + '.ovr')
-
-    return file_names
-
-
-def granule_exists(granule, prefix=''):
-    """ Check if the granule exists already on AWS """
-    s3path = os.path.join('s3://%s' % bucket, get_s3_path(granule, prefix=prefix))
-    urls = s3_list(s3path)
-    return True if len(urls) == 18 else False
+def _basename(fname):
+    """ File name without directory or extension, e.g. the granule ID of an hdf """
+    return os.path.splitext(os.path.basename(fname))[0]
+
+
+def _exists(fnames):
+    """ Check that all files in a list exist """
+    return fnames is not None and all(os.path.exists(f) for f in fnames)
+
+
+def granule_exists(granule, prefix='', inventory=None):
+    """ Check if all the granule's files exist already on AWS, using inventory if provided """
+    path = get_s3_path(granule, prefix=prefix)
+    if inventory is not None:
+        count = inventory.count(path)
+    else:
+        count = len(s3_list(os.path.join('s3://%s' % bucket, path, '')))
+    parts = granule.split('.')
+    return count >= expected_objects(parts[0] + '.' + parts[3])
+
+
+def expected_objects(product):
+    """ Number of objects stored for each granule of a product: a GeoTIFF per band (or
+    group of bands, with a manifest, if stacked), an overview for some of them unless
+    they are inside COGs, and the metadata, xml, browse image, and index.html """
+    settings = output_settings(product)
+    files = output_files(product)
+    count = len(files) + 4
+    if settings['layout'] == 'stacked':
+        count += 1
+    if settings['format'] != 'COG':
+        count += sum(overview for _, _, overview in files)
+    return count
 
 
 def get_s3_path(gid, prefix=''):
@@ -144,6 +803,17 @@ def get_s3_path(gid, prefix=''):
     return path
 
 
+def get_gid(gran):
+    """ Get granule ID from granule metadata """
+    return os.path.splitext(os.path.basename(gran['links'][0]['href']))[0]
+
+
+def get_product(gid):
+    """ Get product (e.g., MCD43A4.006) from granule ID """
+    parts = gid.split('.')
+    return '%s.%s' % (parts[0], parts[3])
+
+
 def get_date(gid):
     """ Get date from granule ID """
     d = gid.split('.')[1].replace('A', '')
@@ -154,21 +824,372 @@ def parse_args(args):
     """ Parse arguments for the NDWI algorithm """
     desc = 'MODIS Public Dataset Utility (v%s)' % __version__
     dhf = argparse.ArgumentDefaultsHelpFormatter
-    parser = argparse.ArgumentParser(description=desc, formatter_class=dhf)
+    parser = argparse.ArgumentParser(description=desc, formatter_class=dhf,
+                                     epilog='Other commands: %s' % ', '.join(sorted(commands)))
     parser.add_argument('--version', help='Print version and exit', action='version', version=__version__)
 
     parser.add_argument('start_date', help='First date')
     parser.add_argument('end_date', help='End date')
     parser.add_argument('-p', '--product', default=_PRODUCT)
+    parser.add_argument('--overwrite', default=None, nargs='*',
+                        help='Reprocess everything, or only the given dates and granule IDs')
+    add_refresh_option(parser)
+    add_options(parser)
+
+    return parser.parse_args(args)
+
+
+def parse_backfill_args(args):
+    """ Parse arguments for the backfill command """
+    desc = 'Ingest several products through a shared pool of workers (v%s)' % __version__
+    dhf = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog='modis-pds backfill', description=desc, formatter_class=dhf)
+    parser.add_argument('start_date', help='First date')
+    parser.add_argument('end_date', help='End date')
+    parser.add_argument('-p', '--products', nargs='+', default=sorted(products.keys()),
+                        help='Products to ingest, in order of priority')
+    parser.add_argument('--order', default='newest', choices=ORDERS,
+                        help='Order of days, or product to run all days of each product in turn')
     parser.add_argument('--overwrite', default=False, action='store_true')
+    add_refresh_option(parser)
+    parser.add_argument('--report-interval', default=60, type=int, help='Seconds between progress reports')
+    add_options(parser, workers=4)
+
+    return parser.parse_args(args)
+
+
+def add_refresh_option(parser):
+    parser.add_argument('--refresh', default=False, action='store_true',
+                        help='Check processed dates too, reprocessing only granules that changed in CMR since')
+
+
+def add_options(parser, workers=0):
+    """ Add options for workers and caches common to all commands """
+    parser.add_argument('-w', '--workers', default=workers, type=int,
+                        help='Number of workers per stage, conversion uses processes (0 to process granules serially)')
+    parser.add_argument('--download-workers', default=None, type=int,
+                        help='Number of download threads (default: workers)')
+    parser.add_argument('--upload-workers', default=None, type=int, help='Number of upload threads (default: workers)')
+    parser.add_argument('--band-workers', default=None, type=int,
+                        help='Number of processes converting bands of each granule (default: 1)')
+    parser.add_argument('--gdal-threads', default=None, help='Threads GDAL uses to compress each band (NUM_THREADS)')
+    add_output_options(parser)
+    parser.add_argument('--in-memory', default=False, action='store_true',
+                        help='Convert to GeoTIFFs in memory and upload from memory, not disk')
+    parser.add_argument('--memory-limit', default=None, type=float,
+                        help='Maximum memory (MB) for in-memory files, beyond which they are written to disk')
+    parser.add_argument('--scratch-dir', default=None,
+                        help='Directory for working files of granules (default: SCRATCH_DIR, or the current directory)')
+    parser.add_argument('--scratch-limit', default=None, type=float,
+                        help='Maximum disk space (MB) for working files, downloads wait while it is in use '
+                             '(0 for no limit)')
+    parser.add_argument('--staging-dir', default=None,
+                        help='Stage converted granules here and upload them in the background (default: STAGING_DIR)')
+    parser.add_argument('--stage-only', default=False, action='store_true',
+                        help='Leave staged granules to be uploaded by modis-pds sync')
+    journal = os.getenv('JOURNAL', os.path.join(user_cache_dir('modispds'), 'journal.sqlite'))
+    parser.add_argument('--journal', default=journal, help='File for journal of granule progress, empty to disable')
+    parser.add_argument('--retries', default=3, type=int,
+                        help='Attempts to process each granule in a run '
+                             '(granules that failed are retried by the next run)')
+    add_query_options(parser)
+    parser.add_argument('--profile', default=None,
+                        help='Directory to write a cProfile pstats file for each stage of each granule to, '
+                             'and a summary of all of them at the end (use a new directory for each run)')
+    parser.add_argument('--profile-memory', default=False, action='store_true',
+                        help='Record peak memory of each stage with tracemalloc when profiling (slower)')
+    parser.add_argument('--profile-top', default=None, type=int, help='Functions listed in the profile summary')
+    parser.add_argument('--metrics', default=None, help='File to append metrics to as JSON lines')
+    parser.add_argument('--prometheus', default=None, help='File to write metrics to in Prometheus text format')
+    parser.add_argument('--metrics-port', default=None, type=int, help='Port to serve Prometheus metrics on')
     parser.add_argument('--loglevel', default=2, type=int)
 
+
+def add_output_options(parser):
+    """ Add options for the format and layout of GeoTIFFs """
+    parser.add_argument('--output-format', default=None, choices=FORMATS,
+                        help='Format of all products, COG for overviews inside each GeoTIFF (default: from products)')
+    parser.add_argument('--output-layout', default=None, choices=LAYOUTS,
+                        help='Layout of all products, stacked for a GeoTIFF per group of bands '
+                             '(default: from products)')
+
+
+def add_query_options(parser):
+    """ Add options for the inventory and CMR queries """
+    parser.add_argument('--inventory', default=None,
+                        help='File for caching a listing of the whole product (default: list only the dates processed)')
+    parser.add_argument('--inventory-age', default=3600, type=int, help='Maximum age of cached inventory (seconds)')
+    parser.add_argument('--cmr-cache', default=None, help='File for caching CMR query results, empty to disable')
+    parser.add_argument('--cmr-ttl', default=None, type=int,
+                        help='Age after which cached CMR results are refreshed (seconds)')
+    parser.add_argument('--cmr-page-size', default=None, type=int, help='Granules per page of CMR results')
+    parser.add_argument('--cmr-workers', default=None, type=int, help='Pages of CMR results fetched concurrently')
+    parser.add_argument('--cmr-days', default=None, type=int, help='Longest range of dates fetched in one CMR query')
+
+
+def configure(args):
+    """ Apply settings from command line options common to all commands """
+    if args.band_workers is not None:
+        convert_config['workers'] = args.band_workers
+    if args.gdal_threads is not None:
+        convert_config['threads'] = args.gdal_threads
+    configure_output(args)
+    if args.in_memory:
+        convert_config['memory'] = True
+    if args.memory_limit is not None:
+        budget.limit = int(args.memory_limit * 1024 * 1024)
+    if args.scratch_dir is not None:
+        scratch_config['dir'] = args.scratch_dir
+    if args.scratch_limit is not None:
+        scratch.budget.limit = int(args.scratch_limit * 1024 * 1024)
+    if args.staging_dir is not None:
+        staging_config['dir'] = args.staging_dir
+    if args.profile is not None:
+        profile_config['dir'] = args.profile
+    if args.profile_memory:
+        profile_config['memory'] = True
+    if args.profile_top is not None:
+        profile_config['top'] = args.profile_top
+    configure_query(args)
+    if args.metrics is not None:
+        metrics_config['file'] = args.metrics
+    if args.prometheus is not None:
+        metrics_config['prometheus_file'] = args.prometheus
+    if args.metrics_port is not None:
+        serve(args.metrics_port)
+
+
+def configure_output(args):
+    """ Apply settings from output options """
+    if args.output_format is not None:
+        convert_config['format'] = args.output_format
+    if args.output_layout is not None:
+        convert_config['layout'] = args.output_layout
+
+
+def configure_query(args):
+    """ Apply settings from CMR query options """
+    if args.cmr_cache is not None:
+        cmr_config['cache'] = args.cmr_cache
+    if args.cmr_ttl is not None:
+        cmr_config['ttl'] = args.cmr_ttl
+    for key in ['page_size', 'workers', 'days']:
+        if getattr(args, 'cmr_' + key) is not None:
+            cmr_config[key] = getattr(args, 'cmr_' + key)
+
+
+def backfill_cli(args):
+    args = parse_backfill_args(args)
+    configure(args)
+    inventories = {}
+    if args.inventory is not None and not args.overwrite:
+        for product in args.products:
+            # one inventory file per product
+            fname = '%s.%s' % (args.inventory, product)
+            inventories[product] = Inventory.cached(fname, bucket, product, max_age=args.inventory_age)
+    journal = Journal(args.journal) if args.journal else None
+    with profile_summary(), uploading(sync=not args.stage_only, journal=journal):
+        backfill(args.products, args.start_date, args.end_date, order=args.order, overwrite=args.overwrite,
+                 workers=args.workers, download_workers=args.download_workers, upload_workers=args.upload_workers,
+                 inventories=inventories, journal=journal, retries=args.retries, interval=args.report_interval,
+                 refresh=args.refresh)
+
+
+def parse_enqueue_args(args):
+    """ Parse arguments for the enqueue command """
+    desc = 'Add granules between two dates to the work queue (v%s)' % __version__
+    dhf = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog='modis-pds enqueue', description=desc, formatter_class=dhf)
+    parser.add_argument('start_date', help='First date')
+    parser.add_argument('end_date', help='End date')
+    parser.add_argument('-p', '--products', nargs='+', default=[_PRODUCT], help='Products to queue')
+    parser.add_argument('--overwrite', default=False, action='store_true')
+    add_refresh_option(parser)
+    add_queue_options(parser)
+    add_options(parser)
+    return parser.parse_args(args)
+
+
+def parse_worker_args(args):
+    """ Parse arguments for the worker command """
+    desc = 'Process granules from the work queue (v%s)' % __version__
+    dhf = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog='modis-pds worker', description=desc, formatter_class=dhf)
+    parser.add_argument('--visibility', default=1800, type=int,
+                        help='Seconds before a task leased by a worker that stopped responding is run again')
+    parser.add_argument('--wait', default=0, type=int,
+                        help='Seconds between polls of an empty queue (0 to exit when the queue is empty)')
+    parser.add_argument('--limit', default=None, type=int, help='Exit after this many granules')
+    add_queue_options(parser)
+    add_options(parser)
     return parser.parse_args(args)
 
 
+def add_queue_options(parser):
+    queue = os.getenv('WORK_QUEUE', os.path.join(user_cache_dir('modispds'), 'queue.sqlite'))
+    parser.add_argument('--queue', default=queue, help='Work queue URL (e.g., sqlite:///path/queue.sqlite)')
+    parser.add_argument('--max-attempts', default=3, type=int, help='Attempts at each task before it fails')
+
+
+def enqueue_cli(args):
+    args = parse_enqueue_args(args)
+    configure(args)
+    inventories = {}
+    if args.inventory is not None and not args.overwrite:
+        for product in args.products:
+            fname = '%s.%s' % (args.inventory, product)
+            inventories[product] = Inventory.cached(fname, bucket, product, max_age=args.inventory_age)
+    queue = open_queue(args.queue, max_attempts=args.max_attempts)
+    with uploading(sync=not args.stage_only):
+        enqueue(args.products, args.start_date, args.end_date, queue, overwrite=args.overwrite, inventories=inventories,
+                refresh=args.refresh)
+
+
+def worker_cli(args):
+    args = parse_worker_args(args)
+    configure(args)
+    queue = open_queue(args.queue, max_attempts=args.max_attempts)
+    with profile_summary(), uploading(sync=not args.stage_only):
+        work(queue, workers=args.workers, download_workers=args.download_workers, upload_workers=args.upload_workers,
+             visibility=args.visibility, wait=args.wait, limit=args.limit)
+
+
+def parse_plan_args(args):
+    """ Parse arguments for the plan command """
+    desc = 'Print JSON of the days and granules left to ingest, with estimated bytes and objects (v%s)' % __version__
+    dhf = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog='modis-pds plan', description=desc, formatter_class=dhf)
+    parser.add_argument('start_date', help='First date')
+    parser.add_argument('end_date', help='End date')
+    parser.add_argument('-p', '--products', nargs='+', default=sorted(products.keys()), help='Products to plan')
+    parser.add_argument('--summary', default=False, action='store_true',
+                        help='Count the granules of each day rather than listing them')
+    parser.add_argument('--output', default=None, help='File to write JSON to (default: standard output)')
+    add_output_options(parser)
+    add_query_options(parser)
+    return parser.parse_args(args)
+
+
+def plan_cli(args):
+    args = parse_plan_args(args)
+    configure_output(args)
+    configure_query(args)
+    inventories = {}
+    if args.inventory is not None:
+        for product in args.products:
+            fname = '%s.%s' % (args.inventory, product)
+            inventories[product] = Inventory.cached(fname, bucket, product, max_age=args.inventory_age)
+    result = plan(args.products, args.start_date, args.end_date, inventories=inventories, granules=not args.summary)
+    text = json.dumps(result, sort_keys=True, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+
+
+def parse_sync_args(args):
+    """ Parse arguments for the sync command """
+    desc = 'Upload granules from the staging area and publish scene lists of completed days (v%s)' % __version__
+    dhf = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog='modis-pds sync', description=desc, formatter_class=dhf)
+    parser.add_argument('--staging-dir', default=staging_config['dir'] or None, help='Staging area to upload from')
+    parser.add_argument('-w', '--workers', default=staging_config['workers'], type=int, help='Number of upload threads')
+    parser.add_argument('--attempts', default=staging_config['attempts'], type=int,
+                        help='Attempts to upload each object before leaving it for the next sync')
+    parser.add_argument('--wait', default=0, type=int,
+                        help='Seconds between syncs of the staging area (0 to exit once it is empty)')
+    parser.add_argument('--prometheus', default=None, help='File to write metrics to in Prometheus text format')
+    return parser.parse_args(args)
+
+
+def sync_cli(args):
+    args = parse_sync_args(args)
+    if args.staging_dir is None:
+        raise SystemExit('No staging area, set --staging-dir or STAGING_DIR')
+    if args.prometheus is not None:
+        metrics_config['prometheus_file'] = args.prometheus
+    staging_config['dir'] = args.staging_dir
+    staging = get_staging()
+    # objects that failed in an earlier sync are tried again
+    staging.reset()
+    uploader = Uploader(staging, partial(push_scenes, outdir=staging.root), workers=args.workers,
+                        attempts=args.attempts)
+    while True:
+        n = uploader.sync()
+        counts = staging.counts()
+        logger.info('Uploaded %s objects, staging area has %s' % (n, counts))
+        metrics.flush()
+        if args.wait == 0:
+            break
+        time.sleep(args.wait)
+    if counts.get('failed', 0) > 0:
+        raise SystemExit('%s objects failed to upload' % counts['failed'])
+
+
+def parse_purge_args(args):
+    """ Parse arguments for the purge command """
+    desc = 'Delete granules of a product by date and tile, removing them from scene lists, everything under ' \
+           'an S3 prefix, or working files left by failed granules (v%s)' % __version__
+    dhf = argparse.ArgumentDefaultsHelpFormatter
+    parser = argparse.ArgumentParser(prog='modis-pds purge', description=desc, formatter_class=dhf)
+    parser.add_argument('-p', '--product', default=_PRODUCT)
+    parser.add_argument('--start-date', default=None, help='First date of scene lists (default: all dates)')
+    parser.add_argument('--end-date', default=None, help='Last date of scene lists (default: all dates)')
+    parser.add_argument('--tiles', nargs='+', default=None, help='Tiles to delete, e.g. h11v12 (default: all tiles)')
+    parser.add_argument('--url', default=None,
+                        help='Delete everything under this S3 URL (e.g., s3://bucket/testing/) instead of granules')
+    parser.add_argument('--scratch', default=False, action='store_true',
+                        help='Delete working files left by granules that failed, instead of granules')
+    parser.add_argument('--scratch-dir', default=None,
+                        help='Directory for working files of granules (default: SCRATCH_DIR, or the current directory)')
+    parser.add_argument('--dry-run', default=False, action='store_true', help='Count what would be deleted')
+    parser.add_argument('-w', '--workers', default=8, type=int, help='Number of threads listing and deleting')
+    return parser.parse_args(args)
+
+
+def purge_cli(args):
+    args = parse_purge_args(args)
+    if args.scratch:
+        if args.scratch_dir is not None:
+            scratch_config['dir'] = args.scratch_dir
+        removed = scratch.purge(dry_run=args.dry_run)
+        result = {'directories': len(removed), 'dry_run': args.dry_run}
+    elif args.url is not None:
+        objects, nbytes = delete_prefix(args.url, workers=args.workers, dry_run=args.dry_run)
+        result = {'objects': objects, 'bytes': nbytes, 'dry_run': args.dry_run}
+    else:
+        result = purge(args.product, start_date=args.start_date, end_date=args.end_date, tiles=args.tiles,
+                       dry_run=args.dry_run, workers=args.workers)
+    print(json.dumps(result, sort_keys=True, indent=2))
+
+
+# commands other than ingesting a product, e.g. modis-pds backfill
+commands = {
+    'backfill': backfill_cli,
+    'enqueue': enqueue_cli,
+    'plan': plan_cli,
+    'purge': purge_cli,
+    'sync': sync_cli,
+    'worker': worker_cli,
+}
+
+
 def cli():
+    if len(sys.argv) > 1 and sys.argv[1] in commands:
+        return commands[sys.argv[1]](sys.argv[2:])
     args = parse_args(sys.argv[1:])
-    ingest(args.start_date, args.end_date, product=args.product, overwrite=args.overwrite)
+    configure(args)
+    # --overwrite alone overwrites everything
+    overwrite = True if args.overwrite == [] else (args.overwrite or False)
+    inventory = None
+    if args.inventory is not None and overwrite is not True:
+        inventory = Inventory.cached(args.inventory, bucket, args.product, max_age=args.inventory_age)
+    journal = Journal(args.journal) if args.journal else None
+    with profile_summary(), uploading(sync=not args.stage_only, journal=journal):
+        ingest(args.start_date, args.end_date, product=args.product, overwrite=overwrite, workers=args.workers,
+               download_workers=args.download_workers, upload_workers=args.upload_workers, inventory=inventory,
+               journal=journal, retries=args.retries, refresh=args.refresh)
 
 
 if __name__ == "__main__":
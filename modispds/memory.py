@@ -0,0 +1,97 @@
+"""
+In-memory output files, with a ceiling on the memory they use across all processes
+"""
+
+import os
+import uuid
+import logging
+import multiprocessing
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryFile(object):
+    """ Contents of a file held in memory rather than written to disk """
+
+    def __init__(self, name, data):
+        self.name = name
+        self.data = data
+
+    def __len__(self):
+        return len(self.data)
+
+
+class MemoryBudget(object):
+    """ Bytes of memory files in use, shared with forked worker processes """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.used = multiprocessing.Value('l', 0)
+
+    def reserve(self, nbytes):
+        """ Reserve nbytes if it would not exceed the limit, returning True if reserved """
+        with self.used.get_lock():
+            if self.used.value + nbytes > self.limit:
+                return False
+            self.used.value += nbytes
+            return True
+
+    def release(self, nbytes):
+        with self.used.get_lock():
+            self.used.value -= nbytes
+
+
+# created on import so processes forked later share it
+budget = MemoryBudget(int(os.getenv('MEMORY_LIMIT', 1024 * 1024 * 1024)))
+
+
+def vsimem_path(fname):
+    """ Unique GDAL in-memory path for a file name """
+    return '/vsimem/%s/%s' % (uuid.uuid4().hex, os.path.basename(fname))
+
+
+def from_vsimem(vsiname, outdir=''):
+    """ Move a GDAL in-memory file into a MemoryFile, or to a file in outdir if the
+    memory budget is exhausted """
+    from osgeo import gdal
+    f = gdal.VSIFOpenL(vsiname, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    data = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(vsiname)
+    return to_memory(os.path.basename(vsiname), data, outdir=outdir)
+
+
+def to_memory(name, data, outdir=''):
+    """ Keep data as a MemoryFile, or write it to a file in outdir if the memory
+    budget is exhausted """
+    if budget.reserve(len(data)):
+        return MemoryFile(name, data)
+    fname = os.path.join(outdir, name)
+    logger.debug('Memory limit reached, writing %s to disk' % fname)
+    with open(fname, 'wb') as f:
+        f.write(data)
+    return fname
+
+
+def release(files):
+    """ Release the memory budget of the MemoryFiles in a list of files, dropping their
+    data, so releasing them again (e.g., when cleaning up after a failure) does nothing """
+    for f in files:
+        if isinstance(f, MemoryFile) and f.data is not None:
+            budget.release(len(f.data))
+            f.data = None
+
+
+def filename(f):
+    """ Base name of a file name or MemoryFile """
+    return f.name if isinstance(f, MemoryFile) else os.path.basename(f)
+
+
+def clear_vsimem(path):
+    """ Remove any GDAL in-memory files left in a directory """
+    from osgeo import gdal
+    for f in gdal.ReadDir(path) or []:
+        gdal.Unlink('%s/%s' % (path, f))
@@ -0,0 +1,202 @@
+"""
+Performance metrics of each stage, as JSON lines and in Prometheus text format
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# metric names are prefixed with this in Prometheus output
+PREFIX = 'modispds'
+# fields of events named with this prefix (e.g., peak_bytes) keep their maximum rather than a sum
+PEAK = 'peak_'
+
+# metrics settings
+metrics_config = {
+    # file to append a JSON line to for each event, None to not write events. Lines are
+    # buffered, and written when flushed (see Metrics.flush_events)
+    'file': os.getenv('METRICS_FILE'),
+    # file to write Prometheus text format to when flushed, None to not write it
+    'prometheus_file': os.getenv('METRICS_PROMETHEUS_FILE'),
+}
+
+
+class Metrics(object):
+    """ Registry of events (e.g., a download with its bytes and seconds), summed by
+    name and labels except for peaks (fields named peak_*), which keep their maximum,
+    and gauges (e.g., the depth of a queue). Events recorded in a worker process are
+    held until returned to the parent (see collect and replay) """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # hold events rather than recording them, see collect
+        self.buffering = False
+        # (name, labels) -> {'count': n, field: sum, peak field: maximum}
+        self.totals = {}
+        # (name, labels) -> value
+        self.gauges = {}
+        # events held in a worker process, waiting to be collected
+        self.pending = []
+        self.file = None
+
+    def record(self, name, labels=None, **values):
+        """ Record an event with numeric values, e.g. record('download', seconds=1.2, bytes=1000) """
+        event = {'time': time.time(), 'name': name, 'labels': labels or {}, 'values': values}
+        if self.buffering:
+            self.pending.append(event)
+        else:
+            self._add(event)
+
+    def gauge(self, name, value, labels=None):
+        """ Set the current value of a gauge """
+        key = (name, tuple(sorted((labels or {}).items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    @contextmanager
+    def timer(self, name, labels=None, **values):
+        """ Time a block of code, recording an event with its seconds. The yielded dictionary
+        of values can be added to within the block, e.g. with bytes transferred """
+        values = dict(values)
+        start = time.time()
+        try:
+            yield values
+        finally:
+            self.record(name, labels=labels, seconds=time.time() - start, **values)
+
+    def _add(self, event):
+        key = (event['name'], tuple(sorted(event['labels'].items())))
+        with self.lock:
+            totals = self.totals.setdefault(key, {'count': 0})
+            totals['count'] += 1
+            for k, v in event['values'].items():
+                if k.startswith(PEAK):
+                    totals[k] = max(totals.get(k, v), v)
+                else:
+                    totals[k] = totals.get(k, 0) + v
+            if metrics_config['file']:
+                self._write(event)
+
+    def _write(self, event):
+        """ Append event to the JSON lines file, buffered until flush_events """
+        if self.file is None or self.file.name != metrics_config['file']:
+            self.file = open(metrics_config['file'], 'a')
+        line = dict(event['labels'])
+        line.update(event['values'])
+        line.update({'time': round(event['time'], 3), 'name': event['name']})
+        self.file.write(json.dumps(line, sort_keys=True) + '\n')
+
+    def flush_events(self):
+        """ Write buffered events to the JSON lines file, e.g. when a granule is done """
+        with self.lock:
+            if self.file is not None:
+                self.file.flush()
+
+    def drain(self):
+        """ Remove and return events held in a worker process """
+        events, self.pending = self.pending, []
+        return events
+
+    def replay(self, events):
+        """ Record events collected from a worker process """
+        if self.buffering:
+            # a worker process of a worker process
+            self.pending.extend(events)
+            return
+        for event in events:
+            self._add(event)
+
+    def reset(self):
+        with self.lock:
+            self.totals = {}
+            self.gauges = {}
+
+    def prometheus(self):
+        """ Metrics in Prometheus text exposition format """
+        lines = []
+        with self.lock:
+            names = {}
+            gauges = {}
+            for (name, labels), totals in self.totals.items():
+                for field, value in totals.items():
+                    if field.startswith(PEAK):
+                        gauges.setdefault('%s_%s_%s' % (PREFIX, name, field), []).append((labels, value))
+                        continue
+                    metric = '%s_%s_%s' % (PREFIX, name, field if field == 'count' else field + '_total')
+                    names.setdefault(metric, []).append((labels, value))
+            for (name, labels), value in self.gauges.items():
+                gauges.setdefault('%s_%s' % (PREFIX, name), []).append((labels, value))
+        for kind, metrics in [('counter', names), ('gauge', gauges)]:
+            for metric in sorted(metrics):
+                lines.append('# TYPE %s %s' % (metric, kind))
+                for labels, value in sorted(metrics[metric]):
+                    lines.append('%s%s %s' % (metric, _labels(labels), _number(value)))
+        return '\n'.join(lines) + '\n'
+
+    def flush(self):
+        """ Write buffered events to the JSON lines file, and the Prometheus text file, if configured """
+        self.flush_events()
+        fname = metrics_config['prometheus_file']
+        if not fname:
+            return None
+        # write then rename, so a collector never reads a partial file
+        with open(fname + '.tmp', 'w') as f:
+            f.write(self.prometheus())
+        os.rename(fname + '.tmp', fname)
+        return fname
+
+
+def _labels(labels):
+    if len(labels) == 0:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"')) for k, v in labels)
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+# shared by all threads of a process
+metrics = Metrics()
+
+
+def collect(func, *args, **kwargs):
+    """ Call func in a worker process, returning its result and the events it recorded,
+    which the parent passes to metrics.replay """
+    metrics.buffering = True
+    metrics.drain()
+    try:
+        result = func(*args, **kwargs)
+    finally:
+        metrics.buffering = False
+    return result, metrics.drain()
+
+
+def serve(port, host=''):
+    """ Serve metrics in Prometheus text format over HTTP from a background thread """
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            body = metrics.prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = HTTPServer((host, port), Handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    logger.info('Serving metrics on port %s' % server.server_port)
+    return server
@@ -0,0 +1,84 @@
+"""
+Overviews computed in memory, equal to gdaladdo average resampling for integer bands
+whose sides are multiples of the overview levels, as those of MODIS tiles are
+"""
+
+import logging
+import numpy
+
+logger = logging.getLogger(__name__)
+
+
+def average_pyramid(arr, levels=(2, 4, 8), nodata=None):
+    """ Average array down to each overview level, ignoring nodata pixels. Each level is
+    computed from the one before it, as GDAL does for average resampling, and is the
+    same as GDAL's for the arrays in_memory accepts """
+    pyramid = []
+    src = arr
+    previous = 1
+    for level in levels:
+        src = block_average(src, level // previous, nodata=nodata)
+        pyramid.append(src)
+        previous = level
+    return pyramid
+
+
+def in_memory(arr, levels=(2, 4, 8)):
+    """ Whether overviews of an array computed in memory are the same as GDAL's: those of
+    integer arrays whose sides are multiples of every level. GDAL averages floats in their
+    own precision, and the partial blocks at the edges of other arrays with fractional
+    weights, in ways that differ between versions """
+    return numpy.issubdtype(arr.dtype, numpy.integer) and all(n % level == 0 for n in arr.shape for level in levels)
+
+
+def block_average(arr, factor, nodata=None):
+    """ Average factor x factor blocks of array, ignoring nodata pixels """
+    ny, nx = arr.shape
+    oy, ox = -(-ny // factor), -(-nx // factor)
+    data = numpy.zeros((oy * factor, ox * factor), dtype='float64')
+    data[:ny, :nx] = arr
+    valid = numpy.zeros(data.shape, dtype='bool')
+    valid[:ny, :nx] = True if nodata is None else (arr != nodata)
+    data[~valid] = 0
+    sums = data.reshape(oy, factor, ox, factor).sum(axis=(1, 3))
+    counts = valid.reshape(oy, factor, ox, factor).sum(axis=(1, 3))
+    with numpy.errstate(invalid='ignore', divide='ignore'):
+        mean = sums / counts
+    if numpy.issubdtype(arr.dtype, numpy.integer):
+        # round half away from zero, as GDAL does converting to integer types
+        mean = numpy.sign(mean) * numpy.floor(numpy.abs(mean) + 0.5)
+    mean[counts == 0] = 0 if nodata is None else nodata
+    return mean.astype(arr.dtype)
+
+
+def write_overviews(fname, arr, levels=(2, 4, 8), nodata=None, compress='DEFLATE'):
+    """ Write overviews of a band array, or a list of arrays for each band of fname, as
+    an external .ovr file for fname """
+    from osgeo import gdal
+    logger.debug('Writing overviews %s' % (fname + '.ovr'))
+    gdal.SetConfigOption('COMPRESS_OVERVIEW', compress)
+    try:
+        # opening read-only puts overviews in an external .ovr file, as gdaladdo -ro does
+        ds = gdal.Open(fname, gdal.GA_ReadOnly)
+        add_overviews(ds, arr, levels=levels, nodata=nodata)
+        ds = None
+    finally:
+        gdal.SetConfigOption('COMPRESS_OVERVIEW', None)
+    return fname + '.ovr'
+
+
+def add_overviews(ds, arr, levels=(2, 4, 8), nodata=None):
+    """ Add overviews of a band array, or a list of arrays for each band, to an open GDAL
+    dataset, inside the file if it is open for update, otherwise in an external .ovr file.
+    Overviews of other arrays than those in_memory accepts are built by GDAL from the dataset """
+    arrs = arr if isinstance(arr, list) else [arr]
+    if not all(in_memory(data, levels=levels) for data in arrs):
+        logger.debug('Building overviews with GDAL for bands of shape %s' % (arrs[0].shape,))
+        ds.BuildOverviews('AVERAGE', list(levels))
+        return
+    # create empty overviews, then fill them in
+    ds.BuildOverviews('NONE', list(levels))
+    for b, data in enumerate(arrs):
+        band = ds.GetRasterBand(b + 1)
+        for i, level in enumerate(average_pyramid(data, levels=levels, nodata=nodata)):
+            band.GetOverview(i).WriteArray(level)
@@ -2,9 +2,13 @@
 Utilities for putting data up on AWS's Public Datasets (PDS)
 """
 import os
+import re
+import time
 import logging
-import boto3
-from jinja2 import Environment, FileSystemLoader, select_autoescape
+import threading
+from io import BytesIO
+from .metrics import metrics
+from .ratelimit import limiter, outcome, ratelimit_config
 
 # environment variables
 from dotenv import load_dotenv, find_dotenv
@@ -13,20 +17,51 @@ load_dotenv(find_dotenv())
 AWS_ACCESS_KEY_ID = os.getenv('AWS_ACCESS_KEY_ID')
 AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 
-# for jinja2 templating
+# S3 client and transfer settings, see configure_s3
+s3_config = {
+    'endpoint_url': os.getenv('S3_ENDPOINT_URL'),
+    'max_pool_connections': int(os.getenv('S3_MAX_POOL_CONNECTIONS', 50)),
+    'multipart_threshold': int(os.getenv('S3_MULTIPART_THRESHOLD', 16 * 1024 * 1024)),
+    'multipart_chunksize': int(os.getenv('S3_MULTIPART_CHUNKSIZE', 8 * 1024 * 1024)),
+    'max_concurrency': int(os.getenv('S3_MAX_CONCURRENCY', 4)),
+}
+_client = {}
+_client_lock = threading.Lock()
 
-jinja_env = Environment(
-    loader=FileSystemLoader(['templates', os.path.join(os.path.dirname(__file__), 'templates')]),
-    autoescape=select_autoescape(['html', 'xml'])
-)
-template = jinja_env.get_template('index.html')
+# botocore versions with standard retry mode, and with the response-received event the
+# rate control hooks need (older botocore is pinned on older Python, see requirements.txt)
+STANDARD_RETRIES = (1, 15)
+RESPONSE_RECEIVED = (1, 12)
+
+# most keys delete_objects accepts in one request
+DELETE_BATCH = 1000
+
+# jinja2 template of index.html, compiled when first used
+_template = []
 logger = logging.getLogger(__name__)
 
 
-def make_index(thumb, product, files):
+def get_template():
+    """ Get index.html template, loading jinja2 and compiling it on first use """
+    if len(_template) == 0:
+        from jinja2 import Environment, FileSystemLoader, select_autoescape
+        jinja_env = Environment(
+            loader=FileSystemLoader(['templates', os.path.join(os.path.dirname(__file__), 'templates')]),
+            autoescape=select_autoescape(['html', 'xml'])
+        )
+        _template.append(jinja_env.get_template('index.html'))
+    return _template[0]
+
+
+def render_index(thumb, product, files):
+    """ Render html index of files """
+    return get_template().render(thumb=thumb, product=product, files=sorted(files))
+
+
+def make_index(thumb, product, files, outdir=''):
     """ Create html index of files """
-    html = template.render(thumb=thumb, product=product, files=sorted(files))
-    index_fname = 'index.html'
+    html = render_index(thumb, product, files)
+    index_fname = os.path.join(outdir, 'index.html')
     with open(index_fname, 'w') as outfile:
         outfile.write(html)
 
@@ -45,44 +80,159 @@ def make_scene_list(metadata, fout='scenes.txt'):
     return fout
 
 
-def push_to_s3(filename, bucket, prefix=''):
-    """ Copy file to S3 """
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
+def configure_s3(**kwargs):
+    """ Update S3 client and transfer settings (see s3_config), replacing the shared client """
+    for key in kwargs:
+        if key not in s3_config:
+            raise ValueError('Unknown S3 setting %s' % key)
+    with _client_lock:
+        s3_config.update(kwargs)
+        _client.clear()
+
+
+def get_client():
+    """ Get S3 client shared by all threads in this process """
+    pid = os.getpid()
+    client = _client.get(pid)
+    # a client inherited from a parent process is not reused
+    if client is None:
+        # boto3 takes a while to import, so it is not imported until needed
+        import boto3
+        from botocore.config import Config
+        with _client_lock:
+            if pid not in _client:
+                version = botocore_version()
+                options = {}
+                if 'max_pool_connections' in getattr(Config, 'OPTION_DEFAULTS', {}):
+                    options['max_pool_connections'] = s3_config['max_pool_connections']
+                # standard retries back off with jitter, and treat SlowDown as throttling
+                if version >= STANDARD_RETRIES:
+                    options['retries'] = {'mode': 'standard', 'max_attempts': ratelimit_config['retries'] + 1}
+                config = Config(**options)
+                _client.clear()
+                _client[pid] = boto3.client(
+                    's3',
+                    aws_access_key_id=AWS_ACCESS_KEY_ID,
+                    aws_secret_access_key=AWS_SECRET_ACCESS_KEY,
+                    endpoint_url=s3_config['endpoint_url'],
+                    config=config
+                )
+                # time every S3 call, including each part of multipart uploads
+                _client[pid].meta.events.register('before-call.s3', _before_call)
+                _client[pid].meta.events.register('after-call.s3', _after_call)
+                # rate control of each attempt, see ratelimit. A slot taken before sending is
+                # only released when the response is received, so both or neither are registered
+                if version >= RESPONSE_RECEIVED:
+                    _client[pid].meta.events.register('before-send.s3', _before_send)
+                    _client[pid].meta.events.register('response-received.s3', _response_received)
+                else:
+                    logger.warning('botocore %s is too old for rate control of S3' % '.'.join(map(str, version)))
+            client = _client[pid]
+    return client
+
+
+def botocore_version():
+    """ Installed version of botocore as a tuple of integers, e.g. (1, 15, 3) """
+    import botocore
+    return tuple(int(v) for v in re.findall(r'\d+', botocore.__version__)[:3])
+
+
+def _before_call(context=None, **kwargs):
+    if context is not None:
+        context['metrics_start'] = time.time()
+
+
+def _after_call(model=None, parsed=None, context=None, **kwargs):
+    if context is None or 'metrics_start' not in context:
+        return
+    retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+    metrics.record('s3_call', labels={'operation': model.name}, seconds=time.time() - context['metrics_start'],
+                   retries=retries)
+
+
+# whether the current thread holds a slot of the S3 limiter for a request being sent
+_sending = threading.local()
+
+
+def _before_send(**kwargs):
+    if getattr(_sending, 'held', False):
+        # the previous attempt raised before its response was received
+        limiter('s3').release(outcome())
+    limiter('s3').acquire()
+    _sending.held = True
+
+
+def _response_received(response_dict=None, parsed_response=None, exception=None, **kwargs):
+    if not getattr(_sending, 'held', False):
+        return
+    _sending.held = False
+    status = (response_dict or {}).get('status_code')
+    code = (parsed_response or {}).get('Error', {}).get('Code')
+    limiter('s3').release(outcome(None if exception is not None else status, code))
+
+
+def get_transfer_config():
+    """ Transfer settings for uploads, which use multipart uploads above a size threshold """
+    from boto3.s3.transfer import TransferConfig
+    return TransferConfig(
+        multipart_threshold=s3_config['multipart_threshold'],
+        multipart_chunksize=s3_config['multipart_chunksize'],
+        max_concurrency=s3_config['max_concurrency'],
+        use_threads=s3_config['max_concurrency'] > 1
     )
 
+
+def push_to_s3(filename, bucket, prefix='', data=None):
+    """ Copy file to S3, or if data is provided upload it under the name filename """
+    s3 = get_client()
+
     key = os.path.join(prefix, os.path.basename(filename))
 
     ext = os.path.splitext(filename)[1]
-    with open(filename, 'rb') as f:
-        logger.debug('Uploading %s to: %s' % (key, bucket))
-        if ext == '.html':
-            content_type = 'text/html'
-        elif ext == '.json':
-            content_type = 'application/json'
+    logger.debug('Uploading %s to: %s' % (key, bucket))
+    if ext == '.html':
+        content_type = 'text/html'
+    elif ext == '.json':
+        content_type = 'application/json'
+    else:
+        content_type = 'binary/octet-stream'
+    extra_args = {'ACL': 'public-read', 'ContentType': content_type}
+    with metrics.timer('s3_upload') as m:
+        if data is None:
+            m['bytes'] = os.path.getsize(filename)
+            s3.upload_file(filename, bucket, key, ExtraArgs=extra_args, Config=get_transfer_config())
         else:
-            content_type = 'binary/octet-stream'
-        resp = s3.put_object(Bucket=bucket, Key=key, Body=f, ACL='public-read', ContentType=content_type)
+            m['bytes'] = len(data)
+            s3.upload_fileobj(BytesIO(data), bucket, key, ExtraArgs=extra_args, Config=get_transfer_config())
     return os.path.join('s3://%s' % bucket, key)
 
 
+def read_from_s3(url):
+    """ Contents of an object on S3, or None if it does not exist """
+    s3 = get_client()
+    parts = splitall(url)
+    bucket = parts[1]
+    key = os.path.sep.join(parts[2:])
+    try:
+        return s3.get_object(Bucket=bucket, Key=key)['Body'].read()
+    except Exception as e:
+        if getattr(e, 'response', {}).get('Error', {}).get('Code') in ['404', 'NoSuchKey']:
+            return None
+        raise
+
+
 def exists(url):
     """ Check if this URL exists on S3 """
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-    )
+    s3 = get_client()
     parts = splitall(url)
     bucket = parts[1]
     key = os.path.sep.join(parts[2:])
     try:
-        obj = s3.get_object(Bucket=bucket, Key=key)
+        s3.head_object(Bucket=bucket, Key=key)
         return True
     except Exception as e:
-        if e.response['Error']['Code'] == 'NoSuchKey':
+        # HEAD responses have no body, so no NoSuchKey error code
+        if e.response['Error']['Code'] in ['404', 'NoSuchKey', 'NotFound']:
             return False
         else:
             raise
@@ -90,34 +240,22 @@ def exists(url):
 
 def s3_list(url):
     """ Get list of objects within bucket and path """
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-    )
+    s3 = get_client()
     parts = splitall(url)
     bucket = parts[1]
     prefix = os.path.sep.join(parts[2:])
 
-    response = s3.list_objects_v2(
-        Bucket=bucket,
-        Prefix=prefix
-    )
-
+    paginator = s3.get_paginator('list_objects_v2')
     filenames = []
-    if 'Contents' in response.keys():
-        for file in response['Contents']:
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for file in page.get('Contents', []):
             filenames.append(os.path.join('s3://%s' % bucket, file['Key']))
     return filenames
 
 
 def del_from_s3(url):
     """ Remove file from S3 """
-    s3 = boto3.client(
-        's3',
-        aws_access_key_id=AWS_ACCESS_KEY_ID,
-        aws_secret_access_key=AWS_SECRET_ACCESS_KEY
-    )
+    s3 = get_client()
     logger.debug('Deleting %s' % url)
     parts = splitall(url)
     bucket = parts[1]
@@ -125,6 +263,84 @@ def del_from_s3(url):
     res = s3.delete_object(Bucket=bucket, Key=key)
 
 
+def iter_objects(bucket, prefix):
+    """ Iterate through objects (dictionaries with Key and Size) under a prefix, a page at a time """
+    paginator = get_client().get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj
+
+
+def delete_keys(bucket, keys, workers=8, interval=10):
+    """ Delete keys from a bucket with delete_objects, in batches of up to 1000 keys sent
+    concurrently by workers threads. keys can be any iterable, e.g. a listing still being
+    paged through, which is read only as fast as batches are deleted. Progress is logged
+    every interval seconds. Returns the number of keys deleted, raising an error if any
+    could not be deleted """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def delete(batch):
+        with metrics.timer('s3_delete', keys=len(batch)):
+            resp = get_client().delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': k} for k in batch],
+                                                                      'Quiet': True})
+        return len(batch) - len(resp.get('Errors', [])), resp.get('Errors', [])
+
+    start = last = time.time()
+    deleted = 0
+    errors = []
+    pending = []
+
+    def collect(future):
+        n, errs = future.result()
+        errors.extend(errs)
+        return n
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        batch = []
+        for key in keys:
+            batch.append(key)
+            if len(batch) == DELETE_BATCH:
+                pending.append(executor.submit(delete, batch))
+                batch = []
+            # a bounded number of batches in flight
+            while len(pending) >= 2 * workers:
+                deleted += collect(pending.pop(0))
+            if time.time() - last >= interval:
+                last = time.time()
+                logger.info('Deleted %s objects from %s (%.0f/s)' % (deleted, bucket, deleted / (last - start)))
+        if batch:
+            pending.append(executor.submit(delete, batch))
+        for future in pending:
+            deleted += collect(future)
+    logger.info('Deleted %s objects from %s in %.1fs' % (deleted, bucket, time.time() - start))
+    if errors:
+        raise RuntimeError('%s objects could not be deleted, first %s: %s' %
+                           (len(errors), errors[0].get('Key'), errors[0].get('Message')))
+    return deleted
+
+
+def delete_prefix(url, workers=8, dry_run=False):
+    """ Delete all objects under an s3:// URL prefix, returning the number of objects
+    and their total bytes. If dry_run is True they are only counted """
+    parts = splitall(url)
+    bucket = parts[1]
+    prefix = os.path.sep.join(parts[2:])
+    total = {'objects': 0, 'bytes': 0}
+
+    def keys():
+        for obj in iter_objects(bucket, prefix):
+            total['objects'] += 1
+            total['bytes'] += obj.get('Size', 0)
+            yield obj['Key']
+
+    if dry_run:
+        for key in keys():
+            pass
+    else:
+        delete_keys(bucket, keys(), workers=workers)
+    return total['objects'], total['bytes']
+
+
 def splitall(path):
     allparts = []
     while 1:
@@ -0,0 +1,137 @@
+"""
+Concurrent pipeline for moving granules through separate processing stages
+(e.g., download, convert, upload), each with its own pool of workers
+"""
+
+import threading
+import logging
+from queue import Queue
+from concurrent.futures import ProcessPoolExecutor
+from .metrics import metrics, collect
+
+logger = logging.getLogger(__name__)
+
+# sentinel marking the end of a stage's input
+_DONE = object()
+
+
+class Task(object):
+    """ A single item moving through the pipeline """
+
+    def __init__(self, index, item):
+        self.index = index
+        self.item = item
+        self.value = item
+        self.error = None
+        self.stage = None
+
+
+class Stage(object):
+    """ A pipeline stage, a function applied by a pool of worker threads. If
+    processes is True the work itself is dispatched to a pool of processes,
+    in which case func and its input and output must be picklable """
+
+    def __init__(self, name, func, workers=1, processes=False):
+        self.name = name
+        self.func = func
+        self.workers = max(int(workers), 1)
+        self.processes = processes
+
+
+class Pipeline(object):
+    """ Run items through a sequence of stages connected by bounded queues. If given,
+    cleanup(task) is called for each task as it leaves the pipeline, whether or not it
+    failed (e.g., to remove its working files) """
+
+    def __init__(self, stages, maxsize=None, cleanup=None):
+        self.stages = stages
+        self.maxsize = maxsize
+        self.cleanup = cleanup
+
+    def queue_size(self, stage):
+        """ Size of input queue for a stage, by default twice the number of workers """
+        return self.maxsize if self.maxsize is not None else 2 * stage.workers
+
+    def run(self, items, callback=None):
+        """ Process all items, calling callback(task) as each one completes. Tasks
+        are returned in the same order as the input items """
+        queues = [Queue(maxsize=self.queue_size(s)) for s in self.stages] + [Queue()]
+        pools = [ProcessPoolExecutor(max_workers=s.workers) if s.processes else None for s in self.stages]
+        errors = []
+        threads = [threading.Thread(target=self._feed, args=(items, queues[0], errors))]
+        for i, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = threading.Lock()
+            nxt = self.stages[i+1].workers if i+1 < len(self.stages) else 1
+            for n in range(stage.workers):
+                args = (stage, pools[i], queues[i], queues[i+1], remaining, lock, nxt)
+                threads.append(threading.Thread(target=self._work, args=args))
+        for t in threads:
+            t.daemon = True
+            t.start()
+
+        tasks = []
+        try:
+            while True:
+                task = queues[-1].get()
+                if task is _DONE:
+                    break
+                if self.cleanup is not None:
+                    try:
+                        self.cleanup(task)
+                    except Exception as e:
+                        logger.error('Error cleaning up after task %s: %s' % (task.index, str(e)))
+                if callback is not None:
+                    callback(task)
+                # events are written to file as each granule is done rather than as recorded
+                metrics.flush_events()
+                tasks.append(task)
+        finally:
+            for t in threads:
+                t.join()
+            for pool in pools:
+                if pool is not None:
+                    pool.shutdown()
+        if errors:
+            raise errors[0]
+        return sorted(tasks, key=lambda t: t.index)
+
+    def _feed(self, items, queue, errors):
+        """ Put items onto the first queue, blocking while it is full """
+        try:
+            for i, item in enumerate(items):
+                queue.put(Task(i, item))
+        except Exception as e:
+            logger.error('Error reading pipeline input: %s' % str(e))
+            errors.append(e)
+        finally:
+            for n in range(self.stages[0].workers):
+                queue.put(_DONE)
+
+    def _work(self, stage, pool, inq, outq, remaining, lock, nxt):
+        """ Worker thread for a stage """
+        while True:
+            task = inq.get()
+            if task is _DONE:
+                break
+            metrics.gauge('queue_depth', inq.qsize(), labels={'stage': stage.name})
+            # failed tasks are passed through untouched
+            if task.error is None:
+                try:
+                    with metrics.timer('stage', labels={'stage': stage.name}):
+                        if pool is None:
+                            task.value = stage.func(task.value)
+                        else:
+                            task.value, events = pool.submit(collect, stage.func, task.value).result()
+                            metrics.replay(events)
+                except Exception as e:
+                    logger.error('Error in %s stage: %s' % (stage.name, str(e)))
+                    task.error = e
+                    task.stage = stage.name
+            outq.put(task)
+        # last worker out signals the next stage
+        with lock:
+            remaining[0] -= 1
+            if remaining[0] == 0:
+                for n in range(nxt):
+                    outq.put(_DONE)
@@ -1,4 +1,13 @@
 # MODIS product configuration
+#
+# output: settings of the GeoTIFFs written for each band, any not given taken from
+# convert.OUTPUT: format, GTiff (overviews in a .ovr file, the default) or COG (overviews
+# inside the file, ahead of the full resolution data), the compression codec (DEFLATE,
+# LZW or ZSTD), its level, and the tile size in pixels, and the layout: bands (a file
+# per band, the default) or stacked (a file per group of bands, with the bands in no
+# group in files of their own, and a JSON manifest of where each band is). Bands in a
+# group must have the same resolution and data type. Format and layout of all products
+# can be set with --output-format and --output-layout (or OUTPUT_FORMAT and OUTPUT_LAYOUT)
 
 products = {
     'MCD43A4.006': {
@@ -6,7 +15,9 @@ products = {
         'bandnames':
             ['B%sqa' % str(i).zfill(2) for i in range(1, 8)] +
             ['B%s' % str(i).zfill(2) for i in range(1, 8)],
-        'overviews': ([False] * 7) + ([True] * 7)
+        'overviews': ([False] * 7) + ([True] * 7),
+        'output': {'groups': {'qa': ['B%sqa' % str(i).zfill(2) for i in range(1, 8)],
+                              'refl': ['B%s' % str(i).zfill(2) for i in range(1, 8)]}}
     },
     'MOD09GA.006': {
         'day_offset': 0,
@@ -14,7 +25,9 @@ products = {
             ['numobs1km', 'state', 'senzen', 'senaz', 'range', 'solzen', 'solaz', 'geoflags', 'orbit', 'granule', 'numobs500m'] +
             ['B%s' % str(i).zfill(2) for i in range(1, 8)] +
             ['qc500m', 'obscov', 'obsnum', 'qscan'],
-        'overviews': ([False] * 11) + ([True] * 7) + ([False] * 4)
+        'overviews': ([False] * 11) + ([True] * 7) + ([False] * 4),
+        'output': {'groups': {'angles': ['senzen', 'senaz', 'solzen', 'solaz'],
+                              'refl': ['B%s' % str(i).zfill(2) for i in range(1, 8)]}}
     },
     'MYD09GA.006': {
         'day_offset': 0,
@@ -22,16 +35,20 @@ products = {
             ['numobs1km', 'state', 'senzen', 'senaz', 'range', 'solzen', 'solaz', 'geoflags', 'orbit', 'granule', 'numobs500m'] +
             ['B%s' % str(i).zfill(2) for i in range(1, 8)] +
             ['qc500m', 'obscov', 'obsnum', 'qscan'],
-        'overviews': ([False] * 11) + ([True] * 7) + ([False] * 4)
+        'overviews': ([False] * 11) + ([True] * 7) + ([False] * 4),
+        'output': {'groups': {'angles': ['senzen', 'senaz', 'solzen', 'solaz'],
+                              'refl': ['B%s' % str(i).zfill(2) for i in range(1, 8)]}}
     },
     'MOD09GQ.006': {
         'day_offset': 0,
         'bandnames': ['numobs', 'B01', 'B02', 'qc', 'obscov', 'obsnum', 'orbit', 'granule'],
-        'overviews': [False, True, True, False, False, False, False, False]
+        'overviews': [False, True, True, False, False, False, False, False],
+        'output': {'groups': {'refl': ['B01', 'B02']}}
     },
     'MYD09GQ.006': {
         'day_offset': 0,
         'bandnames': ['numobs', 'B01', 'B02', 'qc', 'obscov', 'obsnum', 'orbit', 'granule'],
-        'overviews': [False, True, True, False, False, False, False, False]
+        'overviews': [False, True, True, False, False, False, False, False],
+        'output': {'groups': {'refl': ['B01', 'B02']}}
     }
 }
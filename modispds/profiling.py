@@ -0,0 +1,137 @@
+"""
+Profiling of each granule's stages, with cProfile and optionally tracemalloc, and a
+summary of the hot spots of a run
+"""
+
+import os
+import glob
+import json
+import time
+import pstats
+import logging
+import cProfile
+from functools import wraps
+from contextlib import contextmanager
+from .metrics import metrics
+try:
+    # pstats writes native str, which io.StringIO does not accept in Python 2
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+logger = logging.getLogger(__name__)
+
+# file of peak memory and seconds of each granule's stages, in the profile directory
+PEAKS = 'peaks.jsonl'
+
+# profiling settings
+profile_config = {
+    # directory to write a pstats file per granule and stage to, empty to not profile
+    'dir': os.getenv('PROFILE_DIR', ''),
+    # trace memory allocations, recording the peak of each stage (slows processing down)
+    'memory': os.getenv('PROFILE_MEMORY', 'false').lower() in ['1', 'true', 'yes'],
+    # functions listed in the summary
+    'top': int(os.getenv('PROFILE_TOP', 30)),
+}
+
+
+@contextmanager
+def profiled(stage, gid):
+    """ Profile a stage of a granule, writing <dir>/<gid>.<stage>.pstats and appending the
+    seconds and peak memory (bytes, if tracing memory) of the stage to <dir>/peaks.jsonl.
+    Peak memory is that of the whole process, so of concurrent stages too if they share it """
+    root = profile_config['dir']
+    if not root:
+        yield
+        return
+    if not os.path.exists(root):
+        os.makedirs(root)
+    profiler = cProfile.Profile()
+    try:
+        profiler.enable()
+    except ValueError:
+        # only one profiler can be active at a time in some Python versions
+        logger.debug('Not profiling %s of %s, another profile is active' % (stage, gid))
+        profiler = None
+    tracemalloc = None
+    if profile_config['memory']:
+        # not in Python 2, so only imported when tracing memory
+        import tracemalloc
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        else:
+            # before Python 3.9 the peak is since tracing started, so only for the first stage
+            logger.debug('Peak memory of %s of %s includes earlier stages' % (stage, gid))
+    start = time.time()
+    try:
+        yield
+    finally:
+        record = {'gid': gid, 'stage': stage, 'seconds': round(time.time() - start, 3), 'pid': os.getpid()}
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(os.path.join(root, '%s.%s.pstats' % (gid, stage)))
+        if tracemalloc is not None:
+            record['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            metrics.record('profile_memory', labels={'stage': stage}, peak_bytes=record['peak_bytes'])
+        with open(os.path.join(root, PEAKS), 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+
+
+def profile_stage(stage, gid):
+    """ Decorator profiling a stage function (see profiled), with gid(arg) the granule ID of its first argument """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(arg, *args, **kwargs):
+            if not profile_config['dir']:
+                return func(arg, *args, **kwargs)
+            with profiled(stage, gid(arg)):
+                return func(arg, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summarize(root=None, top=None):
+    """ Summary of all the profiles in a directory: the top functions by cumulative and
+    by own time over all granules, and the seconds and peak memory of each stage. The
+    summary is written to <dir>/summary.txt, and the combined profile to <dir>/all.pstats """
+    root = root or profile_config['dir']
+    top = top or profile_config['top']
+    fnames = sorted(f for f in glob.glob(os.path.join(root, '*.pstats')) if os.path.basename(f) != 'all.pstats')
+    if len(fnames) == 0:
+        return None
+    out = StringIO()
+    stats = pstats.Stats(*fnames, stream=out)
+    stats.dump_stats(os.path.join(root, 'all.pstats'))
+    out.write('Profiles of %s granule stages in %s\n\n' % (len(fnames), root))
+    stages = {}
+    if os.path.exists(os.path.join(root, PEAKS)):
+        with open(os.path.join(root, PEAKS)) as f:
+            for line in f:
+                record = json.loads(line)
+                stages.setdefault(record['stage'], []).append(record)
+    out.write('%-10s %8s %12s %12s %14s\n' % ('stage', 'count', 'mean secs', 'max secs', 'max peak MB'))
+    for stage, records in sorted(stages.items()):
+        secs = [r['seconds'] for r in records]
+        peaks = [r['peak_bytes'] for r in records if 'peak_bytes' in r]
+        out.write('%-10s %8s %12.3f %12.3f %14s\n' % (stage, len(records), sum(secs) / len(secs), max(secs),
+                                                      '%.1f' % (max(peaks) / 1024.0 / 1024.0) if peaks else '-'))
+    for sort in ['cumulative', 'tottime']:
+        out.write('\nTop %s functions by %s time\n' % (top, sort))
+        stats.sort_stats(sort).print_stats(top)
+    fname = os.path.join(root, 'summary.txt')
+    with open(fname, 'w') as f:
+        f.write(out.getvalue())
+    logger.info('Profile summary written to %s\n%s' % (fname, out.getvalue()))
+    return fname
+
+
+@contextmanager
+def profile_summary():
+    """ Summarize profiles written while the block runs, if profiling """
+    try:
+        yield
+    finally:
+        if profile_config['dir']:
+            summarize()
@@ -0,0 +1,227 @@
+"""
+Rate control of requests to each endpoint (Earthdata data pool, URS, CMR and S3): a
+token bucket for requests per second, a limit on requests in flight that adapts to
+throttling, and a circuit breaker pausing requests while an endpoint keeps failing
+"""
+
+import os
+import time
+import random
+import logging
+import threading
+from contextlib import contextmanager
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# outcomes of a request
+OK = 'ok'
+THROTTLED = 'throttled'
+ERROR = 'error'
+
+# HTTP statuses and S3 error codes meaning slow down
+THROTTLED_STATUSES = [429, 503]
+THROTTLED_CODES = ['SlowDown', 'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequests',
+                   'ServiceUnavailable']
+
+# rate control settings
+ratelimit_config = {
+    # requests per second to each endpoint, 0 for no limit
+    'rates': {
+        'earthdata': float(os.getenv('RATE_LIMIT_EARTHDATA', 50)),
+        'urs': float(os.getenv('RATE_LIMIT_URS', 5)),
+        'cmr': float(os.getenv('RATE_LIMIT_CMR', 10)),
+        's3': float(os.getenv('RATE_LIMIT_S3', 0)),
+    },
+    # most requests in flight to each endpoint, halved when throttled and regained one at a time
+    'concurrency': {
+        'earthdata': int(os.getenv('CONCURRENCY_EARTHDATA', 32)),
+        'urs': int(os.getenv('CONCURRENCY_URS', 8)),
+        'cmr': int(os.getenv('CONCURRENCY_CMR', 8)),
+        's3': int(os.getenv('CONCURRENCY_S3', 64)),
+    },
+    # consecutive failed or throttled requests that open the circuit breaker of an endpoint
+    'failures': int(os.getenv('BREAKER_FAILURES', 10)),
+    # seconds requests are paused while the breaker is open, doubling each time it opens again
+    'cooldown': float(os.getenv('BREAKER_COOLDOWN', 30)),
+    'max_cooldown': float(os.getenv('BREAKER_MAX_COOLDOWN', 600)),
+    # retries of throttled requests, with jittered backoff of up to max_backoff seconds
+    'retries': int(os.getenv('RATE_LIMIT_RETRIES', 5)),
+    'backoff': 1.0,
+    'max_backoff': 60.0,
+}
+
+
+class TokenBucket(object):
+    """ Requests per second, with bursts of up to burst requests. Tokens are taken in
+    turn, so concurrent callers are spaced out rather than all waking at once """
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = rate
+        self.burst = burst or max(rate, 1)
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Take a token, waiting until there is one. Returns seconds waited """
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+
+class Limiter(object):
+    """ Rate control of an endpoint. Requests take a token from the bucket and a slot
+    within the concurrency limit, which is adjusted AIMD style: halved (at most once a
+    second) when a request is throttled, and increased by one over each limit's worth of
+    successful requests. After failures consecutive failed or throttled requests the
+    circuit breaker opens, pausing requests for the cooldown, then lets one request
+    through at a time until one succeeds. Requests wait rather than fail while it is
+    open, so a stage pauses until the endpoint recovers """
+
+    def __init__(self, name, rate=0, concurrency=16, failures=10, cooldown=30, max_cooldown=600):
+        self.name = name
+        self.bucket = TokenBucket(rate)
+        self.max_concurrency = concurrency
+        self.limit = float(concurrency)
+        self.in_flight = 0
+        self.failures = failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        # consecutive failures, and times the breaker has opened since a request succeeded
+        self.consecutive = 0
+        self.opened = 0
+        self.open_until = 0
+        self.decreased = 0
+        self.cond = threading.Condition()
+
+    @property
+    def state(self):
+        """ State of the circuit breaker: closed, open or half-open """
+        if self.opened == 0:
+            return 'closed'
+        return 'open' if time.time() < self.open_until else 'half-open'
+
+    def acquire(self):
+        """ Wait for the breaker to close, a slot and a token. Returns seconds waited """
+        start = time.time()
+        with self.cond:
+            while True:
+                now = time.time()
+                if now < self.open_until:
+                    self.cond.wait(self.open_until - now)
+                    continue
+                # one request at a time while half-open
+                if self.in_flight < (1 if self.opened else max(int(self.limit), 1)):
+                    break
+                self.cond.wait(1)
+            self.in_flight += 1
+        self.bucket.take()
+        waited = time.time() - start
+        if waited > 0.01:
+            metrics.record('rate_wait', labels={'endpoint': self.name}, seconds=waited)
+        self._gauges()
+        return waited
+
+    def release(self, outcome=OK):
+        """ Release a slot with the outcome of the request, adjusting the limit and breaker """
+        now = time.time()
+        with self.cond:
+            self.in_flight -= 1
+            if outcome == OK:
+                self.consecutive = 0
+                if self.opened:
+                    logger.info('Circuit breaker for %s closed' % self.name)
+                    self.opened = 0
+                self.limit = min(self.max_concurrency, self.limit + 1.0 / self.limit)
+            else:
+                self.consecutive += 1
+                if outcome == THROTTLED and now - self.decreased >= 1 and self.limit > 1:
+                    previous, self.limit = self.limit, max(self.limit / 2, 1.0)
+                    self.decreased = now
+                    logger.warning('Throttled by %s, reducing requests in flight from %s to %s' %
+                                   (self.name, int(previous), int(self.limit)))
+                # a failed request while half-open opens the breaker again
+                if now >= self.open_until and (self.consecutive >= self.failures or self.opened):
+                    cooldown = min(self.cooldown * 2 ** self.opened, self.max_cooldown)
+                    self.opened += 1
+                    self.open_until = now + cooldown
+                    self.consecutive = 0
+                    logger.warning('Circuit breaker for %s open, pausing requests for %.0fs' % (self.name, cooldown))
+                    metrics.record('rate_breaker_open', labels={'endpoint': self.name}, seconds=cooldown)
+            self.cond.notify_all()
+        metrics.record('rate_request', labels={'endpoint': self.name, 'outcome': outcome})
+        self._gauges()
+
+    @contextmanager
+    def request(self):
+        """ Hold a slot for a request, yielding a dictionary whose outcome is set within
+        the block (an exception is an error) """
+        self.acquire()
+        result = {'outcome': OK}
+        try:
+            yield result
+        except Exception:
+            result['outcome'] = ERROR
+            raise
+        finally:
+            self.release(result['outcome'])
+
+    def _gauges(self):
+        labels = {'endpoint': self.name}
+        metrics.gauge('rate_concurrency_limit', int(self.limit), labels=labels)
+        metrics.gauge('rate_in_flight', self.in_flight, labels=labels)
+        metrics.gauge('rate_breaker_open', 0 if self.state == 'closed' else 1, labels=labels)
+
+
+def outcome(status=None, code=None):
+    """ Outcome of a request from its HTTP status and (for S3) error code """
+    if status in THROTTLED_STATUSES or code in THROTTLED_CODES:
+        return THROTTLED
+    if status is None or status >= 500:
+        return ERROR
+    return OK
+
+
+def backoff(attempt, retry_after=None):
+    """ Seconds to wait before retrying after attempt (counting from 0): Retry-After if
+    the server sent one, otherwise exponential backoff with full jitter """
+    cap = ratelimit_config['max_backoff']
+    try:
+        return min(max(float(retry_after), 0), cap)
+    except (TypeError, ValueError):
+        return random.uniform(0, min(cap, ratelimit_config['backoff'] * 2 ** attempt))
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def limiter(endpoint):
+    """ Get the limiter of an endpoint shared by all threads in this process """
+    key = (os.getpid(), endpoint)
+    with _limiters_lock:
+        if key not in _limiters:
+            # limiters inherited from a parent process are not reused
+            for k in [k for k in _limiters if k[0] != key[0]]:
+                del _limiters[k]
+            _limiters[key] = Limiter(
+                endpoint, rate=ratelimit_config['rates'].get(endpoint, 0),
+                concurrency=ratelimit_config['concurrency'].get(endpoint, 16),
+                failures=ratelimit_config['failures'], cooldown=ratelimit_config['cooldown'],
+                max_cooldown=ratelimit_config['max_cooldown'])
+        return _limiters[key]
+
+
+def reset():
+    """ Forget limiters, so they are made again with the current settings """
+    with _limiters_lock:
+        _limiters.clear()
@@ -0,0 +1,202 @@
+"""
+Scene index of a product, partitioned by month (or year) and by tile, updated as days complete
+"""
+
+import io
+import os
+import csv
+import gzip
+import bisect
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from future.utils import PY2
+from .pds import get_client
+
+logger = logging.getLogger(__name__)
+
+# name of the directory of a product holding its scene index
+INDEX_DIR = 'index'
+PERIODS = ['month', 'year']
+
+# scene index settings
+index_config = {
+    # update the scene index when a day's scene list is published
+    'enabled': os.getenv('SCENE_INDEX', 'true').lower() in ['1', 'true', 'yes'],
+    # period of each partition of a product's index, month or year
+    'period': os.getenv('SCENE_INDEX_PERIOD', 'month'),
+    # partitions updated concurrently
+    'workers': int(os.getenv('SCENE_INDEX_WORKERS', 16)),
+    # attempts to update a partition that other writers keep changing
+    'attempts': 10,
+}
+
+# partitions are merged one at a time when the S3 client cannot make conditional writes
+_merge_lock = threading.Lock()
+
+
+class SceneIndex(object):
+    """ Index of a product's scenes in gzipped CSV partitions, each sorted by date then
+    tile: one per month (or year) under <product>/index/, and one per tile and year under
+    <product>/index/tiles/<tile>/. A day's scenes are merged into the partitions they
+    belong to, with a conditional write so concurrent updates are not lost. Conditional
+    writes need botocore 1.35 or later; with an older botocore partitions are merged one
+    at a time within a process, and updates made concurrently by other processes (e.g.,
+    several workers) can be lost """
+
+    def __init__(self, bucket, product, prefix='', period=None):
+        self.bucket = bucket
+        self.product = product
+        self.root = os.path.join(prefix, product, INDEX_DIR)
+        self.period = period or index_config['period']
+        if self.period not in PERIODS:
+            raise ValueError('Unknown index period %s, must be one of %s' % (self.period, ', '.join(PERIODS)))
+
+    def period_key(self, day):
+        """ Key of the partition of all tiles holding a date """
+        name = str(day)[:7] if self.period == 'month' else str(day)[:4]
+        return os.path.join(self.root, name + '.csv.gz')
+
+    def tile_key(self, tile, day):
+        """ Key of the partition of a tile holding a date """
+        return os.path.join(self.root, 'tiles', tile, str(day)[:4] + '.csv.gz')
+
+    def update(self, day, metadata, tiles=()):
+        """ Replace the scenes of a day with scene list metadata (see main.granule_metadata).
+        tiles are those of scenes removed from the day, whose partitions are updated too.
+        Returns the keys of partitions updated """
+        conditional = conditional_writes()
+        if not conditional:
+            logger.warning('botocore is too old for conditional writes, updates of the scene index of %s by other '
+                           'processes can be lost' % self.product)
+        rows = [scene_row(day, md) for md in metadata]
+        partitions = {self.period_key(day): rows}
+        for tile in tiles:
+            partitions[self.tile_key(tile, day)] = []
+        for row in rows:
+            partitions.setdefault(self.tile_key(row['tile'], day), []).append(row)
+        with ThreadPoolExecutor(max_workers=index_config['workers']) as executor:
+            list(executor.map(lambda kv: self.merge(kv[0], str(day), kv[1], conditional=conditional),
+                              partitions.items()))
+        logger.info('Updated %s index partitions of %s with %s scenes for %s' %
+                    (len(partitions), self.product, len(rows), day))
+        return sorted(partitions)
+
+    def merge(self, key, day, rows, conditional=True):
+        """ Replace rows of a day in a partition, retrying if another writer changes it first.
+        If conditional is False the partition is read and written while holding a lock
+        instead, as the write cannot be made conditional on it being unchanged """
+        if not conditional:
+            with _merge_lock:
+                existing = self.read(key)[0]
+                merged = sorted([r for r in existing if r['date'] != day] + rows, key=sort_key)
+                self.write(key, merged, conditional=False)
+                return merged
+        for attempt in range(index_config['attempts']):
+            existing, etag = self.read(key)
+            merged = sorted([r for r in existing if r['date'] != day] + rows, key=sort_key)
+            try:
+                self.write(key, merged, etag)
+                return merged
+            except Exception as e:
+                if _error_code(e) not in ['PreconditionFailed', 'ConditionalRequestConflict']:
+                    raise
+                logger.debug('Index partition %s changed, merging again' % key)
+        raise RuntimeError('Index partition %s changed by other writers %s times' % (key, index_config['attempts']))
+
+    def read(self, key):
+        """ Rows of a partition and its ETag, or ([], None) if it does not exist """
+        try:
+            resp = get_client().get_object(Bucket=self.bucket, Key=key)
+        except Exception as e:
+            if _error_code(e) in ['404', 'NoSuchKey']:
+                return [], None
+            raise
+        return read_rows(resp['Body'].read()), resp['ETag']
+
+    def write(self, key, rows, etag=None, conditional=True):
+        """ Write rows to a public partition, if it has not changed since it was read with
+        etag (or does not exist if etag is None), or regardless if conditional is False """
+        kwargs = {}
+        if conditional:
+            kwargs = {'IfMatch': etag} if etag is not None else {'IfNoneMatch': '*'}
+        get_client().put_object(Bucket=self.bucket, Key=key, Body=write_rows(rows), ContentType='application/gzip',
+                                ACL='public-read', **kwargs)
+
+    def lookup(self, start, end, tile=None):
+        """ Scenes between two dates (inclusive), of all tiles or a single tile, reading
+        only the partitions covering the dates """
+        start, end = str(start), str(end)
+        if tile is None:
+            keys = [self.period_key(d) for d in _periods(start, end, self.period)]
+        else:
+            keys = [self.tile_key(tile, d) for d in _periods(start, end, 'year')]
+        scenes = []
+        for key in keys:
+            rows = self.read(key)[0]
+            # partitions are sorted by date
+            dates = [r['date'] for r in rows]
+            scenes.extend(rows[bisect.bisect_left(dates, start):bisect.bisect_right(dates, end)])
+        return scenes
+
+
+def conditional_writes():
+    """ Check if the S3 client supports conditional writes (IfMatch and IfNoneMatch),
+    which need botocore 1.35 or later """
+    members = get_client().meta.service_model.operation_model('PutObject').input_shape.members
+    return 'IfMatch' in members and 'IfNoneMatch' in members
+
+
+def scene_row(day, metadata):
+    """ Index row of a scene from its scene list metadata """
+    row = {k: str(v) for k, v in metadata.items()}
+    row['date'] = str(day)
+    row['tile'] = metadata['gid'].split('.')[2]
+    return row
+
+
+def sort_key(row):
+    return (row['date'], row['tile'], row['gid'])
+
+
+def read_rows(data):
+    """ Rows of a gzipped CSV partition """
+    data = gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+    # the csv module of Python 2 reads bytes
+    return list(csv.DictReader(io.BytesIO(data) if PY2 else io.StringIO(data.decode('utf-8'))))
+
+
+def write_rows(rows):
+    """ Gzipped CSV of rows, with columns date, tile, gid, then the rest in order """
+    first = ['date', 'tile', 'gid']
+    columns = first + sorted(set(k for r in rows for k in r) - set(first))
+    # the csv module of Python 2 writes bytes
+    out = io.BytesIO() if PY2 else io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=columns, restval='', lineterminator='\n')
+    writer.writeheader()
+    writer.writerows(rows)
+    data = out.getvalue()
+    buf = io.BytesIO()
+    # no timestamp, so the same rows always give the same bytes
+    with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+        f.write(data if PY2 else data.encode('utf-8'))
+    return buf.getvalue()
+
+
+def _error_code(e):
+    """ Error code of a botocore ClientError, or None for other exceptions """
+    return getattr(e, 'response', {}).get('Error', {}).get('Code')
+
+
+def _periods(start, end, period):
+    """ A date (YYYY-MM-01 or YYYY-01-01) in each month or year from start to end """
+    year = int(start[:4])
+    month = int(start[5:7]) if period == 'month' else 1
+    dates = []
+    while '%04d-%02d' % (year, month) <= end[:7]:
+        dates.append('%04d-%02d-01' % (year, month))
+        if period == 'month' and month < 12:
+            month += 1
+        else:
+            year, month = year + 1, 1
+    return dates
@@ -0,0 +1,167 @@
+"""
+Scheduling of granules from many products and days through one shared pipeline
+"""
+
+import time
+import logging
+import threading
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# orders in which (product, day) jobs are run
+ORDERS = ['newest', 'oldest', 'product']
+
+
+def order_jobs(products, days, order='newest'):
+    """ List (product, day) jobs in order. Newest and oldest interleave products for
+    each day so products share the workers fairly, product runs all days of the
+    first product first, then the next (i.e., products in order of priority) """
+    if order not in ORDERS:
+        raise ValueError('Unknown order %s, must be one of %s' % (order, ', '.join(ORDERS)))
+    jobs = [(p, d) for p in products for d in days[p]]
+    rank = {p: i for i, p in enumerate(products)}
+    if order == 'newest':
+        return sorted(jobs, key=lambda j: (-j[1].toordinal(), rank[j[0]]))
+    elif order == 'oldest':
+        return sorted(jobs, key=lambda j: (j[1], rank[j[0]]))
+    return sorted(jobs, key=lambda j: (rank[j[0]], j[1]))
+
+
+class Progress(object):
+    """ Counts of days and granules done, with the rate and an estimate of time remaining """
+
+    def __init__(self, days, interval=60):
+        self.days = days
+        self.interval = interval
+        self.start_time = time.time()
+        self.last_report = self.start_time
+        # days queried, and the granules they have
+        self.queried = 0
+        self.granules = 0
+        self.done = 0
+        self.failed = 0
+        self.days_done = 0
+
+    def add_day(self, granules):
+        """ Add a queried day with a number of granules to process """
+        self.queried += 1
+        self.granules += granules
+
+    def add_done(self, failed=False):
+        """ Count a granule as done """
+        self.done += 1
+        if failed:
+            self.failed += 1
+
+    def total(self):
+        """ Estimated total granules, assuming days not yet queried have the average seen so far """
+        if self.queried == 0:
+            return 0
+        return self.granules + (self.days - self.queried) * float(self.granules) / self.queried
+
+    def eta(self):
+        """ Estimated seconds remaining, or None if there is nothing to go on yet """
+        elapsed = time.time() - self.start_time
+        if self.done == 0 or elapsed <= 0:
+            return None
+        return (self.total() - self.done) / (self.done / elapsed)
+
+    def report(self):
+        elapsed = time.time() - self.start_time
+        eta = self.eta()
+        return '%s/%s days, %s/%s granules (%s failed), %.1f granules/hour, ETA %s' % (
+            self.days_done, self.days, self.done, int(round(self.total())), self.failed,
+            self.done / max(elapsed, 1e-6) * 3600, '?' if eta is None else '%ds' % eta)
+
+    def log(self, force=False):
+        """ Log progress, at most every interval seconds unless forced """
+        if force or time.time() - self.last_report >= self.interval:
+            self.last_report = time.time()
+            logger.info('Progress: %s' % self.report())
+            metrics.gauge('backfill_granules', self.done, labels={'state': 'done'})
+            metrics.gauge('backfill_granules', self.failed, labels={'state': 'failed'})
+            metrics.gauge('backfill_granules', int(round(self.total())), labels={'state': 'total'})
+            metrics.gauge('backfill_eta_seconds', self.eta() or 0)
+            metrics.flush()
+
+
+class Scheduler(object):
+    """ Run granules for a list of (product, day) jobs through a single pipeline, so
+    products share its workers. query(product, days) yields (day, granules) for the
+    days of a product, and finalize(product, day, tasks) is called once all of a
+    day's granules are through the pipeline """
+
+    def __init__(self, pipeline, query, finalize, days=32, interval=60):
+        self.pipeline = pipeline
+        self.query = query
+        self.finalize = finalize
+        # most days of a product queried at once
+        self.days = days
+        self.interval = interval
+
+    def run(self, jobs):
+        """ Process jobs in order, returning Progress """
+        self.progress = Progress(len(jobs), interval=self.interval)
+        # (product, day) -> [granules remaining, tasks done]
+        self.pending = {}
+        # (product, day) of each granule, by pipeline task index
+        self.index = []
+        # days without granules are finalized by the thread feeding the pipeline
+        self.lock = threading.Lock()
+        self.pipeline.run(self.granules(jobs), callback=self.complete)
+        self.progress.log(force=True)
+        return self.progress
+
+    def granules(self, jobs):
+        """ Iterate through granules of jobs in order, querying days of a product as needed """
+        queried = {}
+        for i, (product, day) in enumerate(jobs):
+            if (product, day) not in queried:
+                days = [d for p, d in jobs[i:] if p == product and (p, d) not in queried][:self.days]
+                try:
+                    for d, grans in self.query(product, days):
+                        queried[(product, d)] = grans
+                    # days left out by the query have nothing to process, and are not queried again
+                    for d in days:
+                        queried.setdefault((product, d), [])
+                except Exception as e:
+                    logger.error('Error querying %s for %s - %s: %s' % (product, min(days), max(days), str(e)))
+                    continue
+            granules = queried.pop((product, day), [])
+            with self.lock:
+                self.progress.add_day(len(granules))
+                if len(granules) == 0:
+                    self.progress.days_done += 1
+                else:
+                    self.pending[(product, day)] = [len(granules), []]
+            if len(granules) == 0:
+                self.end_day(product, day, [])
+                continue
+            for gran in granules:
+                self.index.append((product, day))
+                yield gran
+
+    def complete(self, task):
+        """ Record a task coming out of the pipeline, finalizing its day if it is the last one """
+        product, day = self.index[task.index]
+        tasks = None
+        with self.lock:
+            self.progress.add_done(failed=task.error is not None)
+            pending = self.pending[(product, day)]
+            pending[0] -= 1
+            pending[1].append(task)
+            if pending[0] == 0:
+                del self.pending[(product, day)]
+                self.progress.days_done += 1
+                tasks = sorted(pending[1], key=lambda t: t.index)
+            self.progress.log()
+        if tasks is not None:
+            self.end_day(product, day, tasks)
+
+    def end_day(self, product, day, tasks):
+        """ Finalize a day, without holding the lock as finalizing publishes to S3 """
+        try:
+            self.finalize(product, day, tasks)
+        except Exception as e:
+            logger.error('Error finalizing %s %s: %s' % (product, day, str(e)))
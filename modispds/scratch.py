@@ -0,0 +1,175 @@
+"""
+Scratch space for granules being processed: a working directory of their own for each,
+removed when the granule is done and kept if it fails, so partial downloads are resumed
+by the next attempt, and a ceiling on the disk space they use
+"""
+
+import os
+import time
+import shutil
+import logging
+import threading
+import multiprocessing
+from contextlib import contextmanager
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# scratch space settings
+scratch_config = {
+    # directory (e.g., on instance storage) working directories are made in, by default outdir
+    'dir': os.getenv('SCRATCH_DIR', ''),
+    # disk space expected to be needed for a granule, as a multiple of its download size
+    # (the hdf, GeoTIFFs and overviews of its bands)
+    'factor': float(os.getenv('SCRATCH_FACTOR', 3)),
+}
+
+
+class DiskBudget(object):
+    """ Bytes of scratch space in use, shared with forked worker processes. Reserving
+    space waits while it would exceed the limit (0 for no limit) """
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.used = multiprocessing.Value('l', 0)
+        self.cond = multiprocessing.Condition(self.used.get_lock())
+
+    def reserve(self, nbytes, wait=True):
+        """ Reserve nbytes, waiting until it is within the limit unless wait is False. One
+        reservation is always let through when nothing else is, so a granule larger than
+        the limit is processed on its own rather than waiting forever. Returns seconds waited """
+        start = time.time()
+        with self.cond:
+            while wait and self.limit and self.used.value > 0 and self.used.value + nbytes > self.limit:
+                self.cond.wait()
+            self.used.value += nbytes
+            used = self.used.value
+        metrics.gauge('scratch_bytes', used)
+        return time.time() - start
+
+    def release(self, nbytes):
+        with self.cond:
+            self.used.value -= nbytes
+            used = self.used.value
+            self.cond.notify_all()
+        metrics.gauge('scratch_bytes', used)
+
+
+class Scratch(object):
+    """ Working directories of granules, each named after its granule and made with the
+    disk space the granule is expected to use reserved from the budget. When a granule
+    is done its directory is removed with everything in it, freeing the space for
+    downloads waiting on it. When it fails the space is released but the directory kept,
+    so the next attempt (in this run or another) finds its partial downloads and files
+    the journal has, until they are purged (see purge) """
+
+    def __init__(self, limit=0):
+        self.budget = DiskBudget(limit)
+        self.lock = threading.Lock()
+        # gid -> (directory, bytes reserved)
+        self.dirs = {}
+
+    def create(self, gid, nbytes=0, root=''):
+        """ Make the working directory of a granule in the scratch directory (or root if
+        that is not set), or reuse it if an earlier attempt left it, once nbytes of disk
+        space can be reserved for it """
+        waited = self.budget.reserve(nbytes)
+        if waited > 0.01:
+            logger.info('Waited %.1fs for %.1f MB of scratch space for %s' % (waited, nbytes / 1024.0 / 1024.0, gid))
+            metrics.record('scratch_wait', seconds=waited)
+        path = workdir_path(gid, root=root)
+        try:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        except Exception:
+            self.budget.release(nbytes)
+            raise
+        self._track(gid, path, nbytes)
+        return path
+
+    def add(self, gid, path, nbytes=0):
+        """ Track an existing working directory (e.g., left by an earlier run), whose
+        space is already in use so is reserved without waiting """
+        self.budget.reserve(nbytes, wait=False)
+        self._track(gid, path, nbytes)
+
+    def _track(self, gid, path, nbytes):
+        with self.lock:
+            previous = self.dirs.get(gid)
+            self.dirs[gid] = (path, nbytes)
+        # a granule has one working directory at a time
+        if previous is not None:
+            if previous[0] != path:
+                shutil.rmtree(previous[0], ignore_errors=True)
+            self.budget.release(previous[1])
+
+    def remove(self, gid):
+        """ Remove the working directory of a granule that is done and release its space,
+        if it has one """
+        path = self.release(gid)
+        if path is None:
+            return False
+        shutil.rmtree(path, ignore_errors=True)
+        logger.debug('Removed working directory %s' % path)
+        return True
+
+    def release(self, gid):
+        """ Release the space of a granule's working directory, keeping its files for the
+        next attempt at the granule (e.g., after it failed). Returns the directory, or None
+        if the granule has none """
+        with self.lock:
+            path, nbytes = self.dirs.pop(gid, (None, 0))
+        if path is not None:
+            self.budget.release(nbytes)
+        return path
+
+    def purge(self, root='', dry_run=False):
+        """ Remove working directories left by granules that failed, other than those of
+        granules being processed. If dry_run is True nothing is removed. Returns the
+        directories removed """
+        root = scratch_config['dir'] or root or os.getcwd()
+        with self.lock:
+            active = set(path for path, _ in self.dirs.values())
+        removed = []
+        if os.path.exists(root):
+            for name in sorted(os.listdir(root)):
+                path = os.path.join(root, name)
+                if _is_gid(name) and os.path.isdir(path) and path not in active:
+                    if not dry_run:
+                        shutil.rmtree(path, ignore_errors=True)
+                    removed.append(path)
+        logger.info('%s %s working directories from %s' %
+                    ('Would remove' if dry_run else 'Removed', len(removed), root))
+        return removed
+
+    @contextmanager
+    def workdir(self, gid, nbytes=0, root=''):
+        """ Working directory of a granule, removed when the block exits, or kept with its
+        space released if the block raises an error """
+        path = self.create(gid, nbytes=nbytes, root=root)
+        try:
+            yield path
+        except BaseException:
+            self.release(gid)
+            raise
+        self.remove(gid)
+
+
+def workdir_path(gid, root=''):
+    """ Working directory of a granule in the scratch directory, or root if that is not set """
+    return os.path.join(scratch_config['dir'] or root or os.getcwd(), gid)
+
+
+def _is_gid(name):
+    """ Check if a name is a granule ID, e.g. MCD43A4.A2016001.h11v12.006.2016174075640 """
+    parts = name.split('.')
+    return len(parts) == 5 and parts[1].startswith('A') and parts[1][1:].isdigit()
+
+
+def estimate(gran):
+    """ Disk space (bytes) a granule is expected to need, from its size in CMR metadata """
+    return int(float(gran.get('granule_size', 0)) * 1024 * 1024 * scratch_config['factor'])
+
+
+# created on import so processes forked later share its budget
+scratch = Scratch(int(os.getenv('SCRATCH_LIMIT', 0)))
@@ -0,0 +1,330 @@
+"""
+Local staging area for converted granules, with a manifest of the objects to upload
+and an uploader draining it to S3 separately from conversion
+"""
+
+import os
+import json
+import time
+import uuid
+import shutil
+import sqlite3
+import logging
+import threading
+from contextlib import contextmanager
+from .pds import push_to_s3
+from .memory import MemoryFile, release
+from .metrics import metrics
+from .ratelimit import backoff
+
+logger = logging.getLogger(__name__)
+
+# name of the manifest in the staging directory
+MANIFEST = 'manifest.sqlite'
+
+# staging settings
+staging_config = {
+    # directory converted granules are staged in before upload, empty to upload them directly
+    'dir': os.getenv('STAGING_DIR', ''),
+    # threads uploading staged objects
+    'workers': int(os.getenv('STAGING_WORKERS', 8)),
+    # attempts to upload an object before it is left for a later sync
+    'attempts': int(os.getenv('STAGING_ATTEMPTS', 5)),
+    # seconds before an object claimed by an uploader that stopped is uploaded again
+    'visibility': 600,
+}
+
+
+class Staging(object):
+    """ Staging directory holding the files of each granule under <dir>/<gid>/, and a
+    SQLite manifest of the S3 object each file becomes and whether it is uploaded yet.
+    A day's scene list is recorded with it and published once the objects of all its
+    granules are uploaded. Objects are claimed before being uploaded, and marked uploaded once
+    done, so each is uploaded once even with several uploaders, and any not marked
+    uploaded when an uploader stops (e.g., a crash) are uploaded by the next one """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS objects (
+            key TEXT PRIMARY KEY, bucket TEXT, path TEXT, gid TEXT, state TEXT, attempts INTEGER,
+            lease_until REAL, token TEXT, error TEXT, updated REAL)""",
+        "CREATE INDEX IF NOT EXISTS objects_state ON objects (state, lease_until)",
+        "CREATE INDEX IF NOT EXISTS objects_gid ON objects (gid, state)",
+        """CREATE TABLE IF NOT EXISTS days (
+            product TEXT, date TEXT, metadata TEXT, published INTEGER, PRIMARY KEY (product, date))""",
+    ]
+
+    def __init__(self, root):
+        self.root = root
+        if not os.path.exists(root):
+            os.makedirs(root)
+        self.filename = os.path.join(root, MANIFEST)
+        with self.connect() as conn:
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+
+    @contextmanager
+    def connect(self):
+        """ Connection to the manifest, in a transaction taking the write lock at once """
+        conn = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+    def stage(self, bucket, path, gid, files):
+        """ Move files (or write MemoryFiles) of a granule into the staging area, to be
+        uploaded to s3://bucket/path/. Returns the S3 URLs they will have """
+        gdir = os.path.join(self.root, gid)
+        if not os.path.exists(gdir):
+            os.makedirs(gdir)
+        rows = []
+        for f in files:
+            if isinstance(f, MemoryFile):
+                fname = os.path.join(gdir, f.name)
+                with open(fname, 'wb') as fout:
+                    fout.write(f.data)
+                release([f])
+            else:
+                fname = os.path.join(gdir, os.path.basename(f))
+                # a rename if the staging area is on the same volume
+                shutil.move(f, fname)
+            rows.append((os.path.join(path, os.path.basename(fname)), bucket, fname, gid, time.time()))
+        with self.connect() as conn:
+            # staged again (e.g., reprocessed), so uploaded again
+            conn.executemany("INSERT OR REPLACE INTO objects (key, bucket, path, gid, state, attempts, updated) "
+                             "VALUES (?, ?, ?, ?, 'staged', 0, ?)", rows)
+        logger.debug('Staged %s files of %s' % (len(rows), gid))
+        return [os.path.join('s3://%s' % bucket, r[0]) for r in rows]
+
+    def add_day(self, product, date, metadata):
+        """ Record the scene list metadata of a day, to publish once the objects of its
+        granules (by the gid of each) are uploaded """
+        with self.connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO days VALUES (?, ?, ?, 0)',
+                         (product, str(date), json.dumps(metadata, default=str)))
+
+    def claim(self, visibility=None):
+        """ Claim the next object to upload, or one whose claim has expired, returning
+        a dictionary of its key, bucket, path, gid, attempts and token, or None """
+        now = time.time()
+        token = uuid.uuid4().hex
+        visibility = visibility or staging_config['visibility']
+        with self.connect() as conn:
+            row = conn.execute("SELECT key, bucket, path, gid, attempts FROM objects "
+                               "WHERE state='staged' OR (state='uploading' AND lease_until<?) "
+                               "ORDER BY updated, key LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            conn.execute("UPDATE objects SET state='uploading', lease_until=?, token=? WHERE key=?",
+                         (now + visibility, token, row[0]))
+        return {'key': row[0], 'bucket': row[1], 'path': row[2], 'gid': row[3], 'attempts': row[4], 'token': token}
+
+    def done(self, obj):
+        """ Mark a claimed object uploaded and remove its file, returning False if the
+        claim was lost (the object was staged again, or claimed by another uploader) """
+        with self.connect() as conn:
+            cur = conn.execute("UPDATE objects SET state='uploaded', error=NULL, updated=? WHERE key=? AND token=?",
+                               (time.time(), obj['key'], obj['token']))
+        if cur.rowcount == 0:
+            return False
+        _remove(obj['path'])
+        return True
+
+    def fail(self, obj, error):
+        """ Record that a claimed object could not be uploaded, leaving it for a later sync (see reset) """
+        with self.connect() as conn:
+            conn.execute("UPDATE objects SET state='failed', attempts=attempts+1, error=?, lease_until=NULL, updated=? "
+                         "WHERE key=? AND token=?", (str(error), time.time(), obj['key'], obj['token']))
+
+    def reset(self):
+        """ Make failed objects ready to upload again, returning how many there were """
+        with self.connect() as conn:
+            return conn.execute("UPDATE objects SET state='staged', attempts=0 WHERE state='failed'").rowcount
+
+    def waiting(self, gid):
+        """ Number of objects of a granule not yet uploaded, or None if it has none in the manifest """
+        with self.connect() as conn:
+            total, waiting = conn.execute("SELECT COUNT(*), SUM(state!='uploaded') FROM objects WHERE gid=?",
+                                          (gid,)).fetchone()
+        return waiting if total > 0 else None
+
+    def ready_days(self):
+        """ (product, date, metadata) of days not yet published whose objects are all uploaded """
+        days = []
+        with self.connect() as conn:
+            rows = conn.execute('SELECT product, date, metadata FROM days WHERE published=0 '
+                                'ORDER BY date, product').fetchall()
+            for product, date, metadata in rows:
+                metadata = json.loads(metadata)
+                gids = [md['gid'] for md in metadata]
+                waiting = 0
+                # in chunks, within SQLite's limit on parameters
+                for i in range(0, len(gids), 500):
+                    chunk = gids[i:i + 500]
+                    waiting += conn.execute("SELECT COUNT(*) FROM objects WHERE state!='uploaded' AND gid IN (%s)" %
+                                            ','.join('?' * len(chunk)), chunk).fetchone()[0]
+                if waiting == 0:
+                    days.append((product, date, metadata))
+        return days
+
+    def claim_day(self, product, date):
+        """ Claim publishing a day, so only one uploader publishes it """
+        with self.connect() as conn:
+            cur = conn.execute('UPDATE days SET published=1 WHERE product=? AND date=? AND published=0',
+                               (product, str(date)))
+        return cur.rowcount == 1
+
+    def unclaim_day(self, product, date):
+        with self.connect() as conn:
+            conn.execute('UPDATE days SET published=0 WHERE product=? AND date=?', (product, str(date)))
+
+    def counts(self):
+        """ Number of objects in each state, and of days waiting to be published """
+        with self.connect() as conn:
+            counts = dict(conn.execute('SELECT state, COUNT(*) FROM objects GROUP BY state').fetchall())
+            counts['days'] = conn.execute('SELECT COUNT(*) FROM days WHERE published=0').fetchone()[0]
+        return counts
+
+
+class Uploader(object):
+    """ Threads uploading staged objects, with retries, and publishing the scene list of
+    each day with publish(product, date, metadata) once all its objects are uploaded, and
+    calling promoted(gid), if given, once all the objects of a granule are uploaded (more
+    than once if uploaders finish the last objects of a granule together). Run
+    in the background while granules are converted (start and stop), or on its own to
+    drain a staging area (sync) """
+
+    def __init__(self, staging, publish, workers=None, attempts=None, interval=5, promoted=None):
+        self.staging = staging
+        self.publish = publish
+        self.promoted = promoted
+        self.workers = workers or staging_config['workers']
+        self.attempts = attempts or staging_config['attempts']
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def sync(self):
+        """ Upload all staged objects and publish days that are complete, returning the
+        number of objects uploaded """
+        counts = []
+        threads = [threading.Thread(target=self._drain, args=(counts,)) for n in range(self.workers)]
+        for t in threads:
+            t.daemon = True
+            t.start()
+        for t in threads:
+            t.join()
+        self.publish_days()
+        for state, count in self.staging.counts().items():
+            metrics.gauge('staged_objects', count, labels={'state': state})
+        return sum(counts)
+
+    def _drain(self, counts):
+        """ Claim and upload objects until there are none left """
+        n = 0
+        while True:
+            obj = self.staging.claim()
+            if obj is None:
+                break
+            if self.upload(obj):
+                n += 1
+        counts.append(n)
+
+    def upload(self, obj):
+        """ Upload a claimed object, retrying with backoff. Returns True if uploaded """
+        for attempt in range(self.attempts):
+            try:
+                if not os.path.exists(obj['path']):
+                    raise IOError('Staged file %s is missing' % obj['path'])
+                push_to_s3(obj['path'], obj['bucket'], os.path.dirname(obj['key']))
+                if self.staging.done(obj):
+                    self.promote(obj['gid'])
+                return True
+            except Exception as e:
+                logger.warning('Error uploading %s (attempt %s of %s): %s' %
+                               (obj['key'], attempt + 1, self.attempts, str(e)))
+                error = e
+                if attempt + 1 < self.attempts:
+                    time.sleep(backoff(attempt))
+        logger.error('Failed to upload %s after %s attempts: %s' % (obj['key'], self.attempts, str(error)))
+        self.staging.fail(obj, error)
+        return False
+
+    def promote(self, gid):
+        """ Call promoted with a granule if all its objects are uploaded """
+        if self.promoted is None or self.staging.waiting(gid) != 0:
+            return
+        try:
+            self.promoted(gid)
+        except Exception as e:
+            logger.error('Error promoting granule %s: %s' % (gid, str(e)))
+
+    def publish_days(self):
+        """ Publish scene lists of days whose objects are all uploaded, returning the days published """
+        days = []
+        for product, date, metadata in self.staging.ready_days():
+            if not self.staging.claim_day(product, date):
+                continue
+            try:
+                self.publish(product, date, metadata)
+                days.append((product, date))
+            except Exception as e:
+                logger.error('Error publishing scene list of %s %s: %s' % (product, date, str(e)))
+                self.staging.unclaim_day(product, date)
+        return days
+
+    def start(self):
+        """ Upload in a background thread until stopped """
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """ Stop the background thread once everything staged so far is uploaded """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.sync()
+        counts = self.staging.counts()
+        logger.info('Uploader stopped, staging area has %s' % counts)
+        return counts
+
+    def _run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.sync() == 0:
+                    self.stopped.wait(self.interval)
+            except Exception as e:
+                logger.error('Error syncing staging area: %s' % str(e))
+                self.stopped.wait(self.interval)
+
+
+def _remove(fname):
+    """ Remove an uploaded file, and its granule directory once it is empty """
+    if os.path.exists(fname):
+        os.remove(fname)
+    dirname = os.path.dirname(fname)
+    try:
+        os.rmdir(dirname)
+    except OSError:
+        pass
+
+
+_staging = {}
+
+
+def get_staging():
+    """ Staging area in the configured directory, or None if staging is not enabled """
+    root = staging_config['dir']
+    if not root:
+        return None
+    if root not in _staging:
+        _staging[root] = Staging(root)
+    return _staging[root]
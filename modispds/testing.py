@@ -0,0 +1,414 @@
+"""
+Local stand-ins for the remote services used by the ingestor, for tests and benchmarks
+"""
+
+import os
+import json
+import uuid
+import datetime
+import base64
+import socket
+import logging
+import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from future.moves.urllib.parse import urlparse, parse_qs, quote, unquote
+
+logger = logging.getLogger(__name__)
+
+
+def make_granule(product='MCD43A4.006', outdir='', size=2400, tile='h11v12', date='2016001', seed=0):
+    """ Write a synthetic granule with the band layout of product, returning its file name. It
+    is a GeoTIFF named like a MODIS HDF, which GDAL opens the same way """
+    import numpy
+    from osgeo import gdal, osr
+    from .products import products
+    prod, ver = product.split('.')
+    fname = os.path.join(outdir, '%s.A%s.%s.%s.2016174075640.hdf' % (prod, date, tile, ver))
+    nbands = len(products[product]['bandnames'])
+    ds = gdal.GetDriverByName('GTiff').Create(fname, size, size, nbands, gdal.GDT_Int16, ['INTERLEAVE=BAND'])
+    srs = osr.SpatialReference()
+    srs.ImportFromProj4('+proj=sinu +lon_0=0 +x_0=0 +y_0=0 +R=6371007.181 +units=m +no_defs')
+    ds.SetProjection(srs.ExportToWkt())
+    res = 463.312716528 * 2400 / size
+    ds.SetGeoTransform([-6671703.118, res, 0, -4447802.079, 0, -res])
+    rand = numpy.random.RandomState(seed)
+    # smooth fields with some nodata, so they compress like real imagery
+    coarse = size // 16
+    for b in range(nbands):
+        field = rand.randint(0, 10000, (coarse, coarse)).astype('int16')
+        arr = numpy.kron(field, numpy.ones((16, 16), dtype='int16'))
+        arr += rand.randint(0, 50, arr.shape).astype('int16')
+        arr[:size // 10, :] = 32767
+        band = ds.GetRasterBand(b + 1)
+        band.SetNoDataValue(32767)
+        band.WriteArray(arr)
+    ds = None
+    return fname
+
+
+def make_granule_xml(name, size, checksum):
+    """ XML metadata for a granule file, with its size and checksum """
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n<GranuleMetaDataFile><GranuleURMetaData><DataFiles>'
+            '<DataFileContainer><DistributedFileName>%s</DistributedFileName><FileSize>%s</FileSize>'
+            '<ChecksumType>CKSUM</ChecksumType><Checksum>%s</Checksum></DataFileContainer>'
+            '</DataFiles></GranuleURMetaData></GranuleMetaDataFile>\n' % (name, size, checksum)).encode('utf-8')
+
+
+def free_port():
+    """ Get an unused local port """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def requires_moto(cls):
+    """ Skip a test case using LocalS3 where moto is not installed (it needs Python 3.9+) """
+    try:
+        import moto  # noqa: F401
+    except ImportError:
+        return unittest.skip('moto is not installed')(cls)
+    return cls
+
+
+def requires_gdal(test):
+    """ Skip a test using GDAL's Python bindings where they are not installed """
+    try:
+        from osgeo import gdal  # noqa: F401
+    except ImportError:
+        return unittest.skip('GDAL is not installed')(test)
+    return test
+
+
+class LocalS3(object):
+    """ Local S3 stand-in (a moto server) with modispds.pds configured to use it """
+
+    def __init__(self, bucket='modis-pds', port=None):
+        self.bucket = bucket
+        self.port = port or free_port()
+        self.endpoint_url = 'http://127.0.0.1:%s' % self.port
+        self.server = None
+        self._config = None
+
+    def start(self):
+        from moto.server import ThreadedMotoServer
+        from modispds import pds
+        # moto accepts any credentials, but they must be present
+        for key in ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY']:
+            os.environ.setdefault(key, 'testing')
+        os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        self.server = ThreadedMotoServer(ip_address='127.0.0.1', port=self.port, verbose=False)
+        self.server.start()
+        self._config = dict(pds.s3_config)
+        pds.configure_s3(endpoint_url=self.endpoint_url)
+        pds.get_client().create_bucket(Bucket=self.bucket)
+        logger.debug('Local S3 running at %s' % self.endpoint_url)
+        return self
+
+    def stop(self):
+        from modispds import pds
+        pds.configure_s3(**self._config)
+        self.server.stop()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class _Server(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients dropping connections is expected
+        logger.debug('Error handling request from %s' % str(client_address))
+
+
+class LocalEarthdata(object):
+    """ Local HTTP server mimicking an Earthdata data pool protected by URS. Files
+    under /data/ redirect to /urs/authorize, which checks basic auth and redirects
+    to /data/oauth, which sets a session cookie and redirects back to the file """
+
+    def __init__(self, username='user', password='pass', port=None):
+        self.username = username
+        self.password = password
+        self.port = port or free_port()
+        self.netloc = '127.0.0.1:%s' % self.port
+        self.url = 'http://%s' % self.netloc
+        self.files = {}
+        # number of bytes to send before dropping the connection, by file name
+        self.failures = {}
+        # number of requests to answer with 429 Too Many Requests
+        self.throttle = 0
+        self.ranges = True
+        self.cookies = set()
+        # number of requests by route
+        self.requests = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def add_file(self, name, data):
+        """ Serve data as /data/name, returning the url """
+        self.files[name] = data
+        return '%s/data/%s' % (self.url, name)
+
+    def add_granule(self, hdf, browse=None):
+        """ Serve a granule file (see make_granule) with its XML metadata and browse image,
+        returning the granule's metadata as a CMR search would """
+        from .earthdata import cksum
+        bname = os.path.basename(hdf)
+        parts = bname.split('.')
+        with open(hdf, 'rb') as f:
+            self.add_file(bname, f.read())
+        self.add_file(bname + '.xml', make_granule_xml(bname, os.path.getsize(hdf), cksum(hdf)))
+        self.files['BROWSE.%s.1.jpg' % os.path.splitext(bname)[0]] = browse or b'\xff\xd8\xff\xe0' + os.urandom(1024)
+        return make_cmr_granule('%s.%s' % (parts[0], parts[3]), date=parts[1][1:], tile=parts[2], url=self.url,
+                                size_mb=os.path.getsize(hdf) / 1024.0 / 1024.0)
+
+    def expire(self):
+        """ Expire all session cookies """
+        self.cookies.clear()
+
+    def start(self):
+        self.server = _Server(('127.0.0.1', self.port), _earthdata_handler(self))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def _earthdata_handler(earthdata):
+    """ Create request handler class for a LocalEarthdata server """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def count(self, route):
+            with earthdata.lock:
+                earthdata.requests[route] = earthdata.requests.get(route, 0) + 1
+
+        def send(self, status, body=b'', headers=None):
+            self.send_response(status)
+            for key, val in (headers or {}).items():
+                self.send_header(key, val)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def redirect(self, location):
+            body = ('<html><body><a href="%s">redirect</a></body></html>' % location).encode('utf-8')
+            self.send(302, body, {'Location': location, 'Content-Type': 'text/html'})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = dict((k, v[0]) for k, v in parse_qs(url.query).items())
+            with earthdata.lock:
+                throttled = earthdata.throttle > 0
+                earthdata.throttle -= 1 if throttled else 0
+            if throttled:
+                self.count('throttled')
+                return self.send(429, b'Too Many Requests', {'Retry-After': '0'})
+            if url.path == '/urs/authorize':
+                self.count('authorize')
+                expected = base64.b64encode(('%s:%s' % (earthdata.username, earthdata.password)).encode('utf-8'))
+                if self.headers.get('Authorization') != 'Basic ' + expected.decode('utf-8'):
+                    return self.send(401, b'Unauthorized')
+                return self.redirect('/data/oauth?code=%s&state=%s' % (uuid.uuid4().hex, quote(query['redirect'])))
+            if url.path == '/data/oauth':
+                self.count('oauth')
+                cookie = uuid.uuid4().hex
+                earthdata.cookies.add(cookie)
+                self.send_response(302)
+                self.send_header('Location', unquote(query['state']))
+                self.send_header('Set-Cookie', 'urs_session=%s; Path=/' % cookie)
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            if url.path.startswith('/data/'):
+                name = url.path[len('/data/'):]
+                self.count('data')
+                if name not in earthdata.files:
+                    return self.send(404, b'Not Found')
+                cookies = [c.strip().split('=', 1) for c in self.headers.get('Cookie', '').split(';') if '=' in c]
+                if not any(k == 'urs_session' and v in earthdata.cookies for k, v in cookies):
+                    return self.redirect('%s/urs/authorize?redirect=%s' % (earthdata.url, quote(url.path)))
+                self.count('download')
+                return self.send_file(name)
+            # files served without authentication
+            if url.path.startswith('/public/'):
+                name = url.path[len('/public/'):]
+                self.count('public')
+                if name not in earthdata.files:
+                    return self.send(404, b'Not Found')
+                return self.send_file(name)
+            self.send(404, b'Not Found')
+
+        def do_HEAD(self):
+            """ Size of a file served without authentication, as GDAL's /vsicurl/ asks for """
+            url = urlparse(self.path)
+            name = url.path[len('/public/'):] if url.path.startswith('/public/') else None
+            self.count('head')
+            self.send_response(200 if name in earthdata.files else 404)
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('Content-Length', str(len(earthdata.files.get(name, b''))))
+            self.end_headers()
+
+        def send_file(self, name):
+            """ Send file, or the requested range of it """
+            data = earthdata.files[name]
+            status = 200
+            headers = {'Content-Type': 'application/octet-stream', 'Accept-Ranges': 'bytes'}
+            rng = self.headers.get('Range')
+            if rng is not None and earthdata.ranges:
+                start, end = rng.replace('bytes=', '').split('-')
+                start, end = int(start), min(int(end or len(data) - 1), len(data) - 1)
+                headers['Content-Range'] = 'bytes %s-%s/%s' % (start, end, len(data))
+                data = data[start:end + 1]
+                status = 206
+            failure = earthdata.failures.pop(name, None)
+            if failure is None:
+                return self.send(status, data, headers)
+            # send the full headers but only part of the body
+            self.send_response(status)
+            for key, val in headers.items():
+                self.send_header(key, val)
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data[:failure])
+            self.wfile.flush()
+            self.close_connection = True
+
+    return Handler
+
+
+def make_cmr_granule(product='MCD43A4.006', date='2016001', tile='h11v12', url='http://127.0.0.1',
+                     updated='2016-06-22T07:56:40.000Z', size_mb=10.0):
+    """ Metadata for a granule, as returned by a CMR JSON search """
+    from .products import products
+    prod, ver = product.split('.')
+    gid = '%s.A%s.%s.%s.2016174075640' % (prod, date, tile, ver)
+    offset = products[product]['day_offset']
+    day = datetime.datetime.strptime(date, '%Y%j')
+    start = day - datetime.timedelta(days=offset)
+    end = day + datetime.timedelta(days=max(offset - 1, 0), hours=23, minutes=59, seconds=59)
+    return {
+        'id': 'G%s.%s-LPDAAC_ECS' % (date, tile),
+        'title': 'LPDAAC_ECS:%s' % gid,
+        'producer_granule_id': gid + '.hdf',
+        'time_start': start.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'time_end': end.strftime('%Y-%m-%dT%H:%M:%S.000Z'),
+        'updated': updated,
+        'granule_size': str(size_mb),
+        'links': [
+            {'href': '%s/data/%s.hdf' % (url, gid), 'rel': 'http://esipfed.org/ns/fedsearch/1.1/data#'},
+            {'href': '%s/data/%s.hdf.xml' % (url, gid), 'type': 'text/xml',
+             'rel': 'http://esipfed.org/ns/fedsearch/1.1/metadata#'},
+            {'href': '%s/public/BROWSE.%s.1.jpg' % (url, gid), 'type': 'image/jpeg',
+             'rel': 'http://esipfed.org/ns/fedsearch/1.1/browse#'},
+        ]
+    }
+
+
+class LocalCMR(object):
+    """ Local HTTP server answering CMR granule searches (short_name, version, temporal,
+    updated_since) from a list of granule metadata, paged like CMR """
+
+    def __init__(self, granules=None, port=None):
+        self.granules = granules or []
+        self.port = port or free_port()
+        self.url = 'http://127.0.0.1:%s/search/' % self.port
+        # parameters of each search request
+        self.searches = []
+        self.server = None
+
+    def search(self, params):
+        """ Granules matching search parameters """
+        results = []
+        temporal = params.get('temporal[]', params.get('temporal', [None]))[0]
+        for gran in self.granules:
+            prod = gran['producer_granule_id'].split('.')
+            if 'short_name' in params and params['short_name'][0] != prod[0]:
+                continue
+            if 'version' in params and params['version'][0] != prod[3]:
+                continue
+            if temporal is not None:
+                start, end = temporal.split(',')
+                if gran['time_start'][:19] > end[:19] or gran['time_end'][:19] < start[:19]:
+                    continue
+            if 'updated_since' in params and gran['updated'][:19] < params['updated_since'][0][:19]:
+                continue
+            results.append(gran)
+        return results
+
+    def start(self):
+        self.server = _Server(('127.0.0.1', self.port), _cmr_handler(self))
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+def _cmr_handler(cmr):
+    """ Create request handler class for a LocalCMR server """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, *args):
+            pass
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != '/search/granules.json':
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            params = parse_qs(url.query)
+            page_size = int(params.get('page_size', ['10'])[0])
+            # pages are requested by page_num, or by the search-after token of the last page
+            if 'page_num' in params:
+                offset = (int(params['page_num'][0]) - 1) * page_size
+            else:
+                offset = int(self.headers.get('cmr-search-after', 0))
+            if page_size > 0:
+                cmr.searches.append(params)
+            results = cmr.search(params)
+            entries = results[offset:offset + page_size]
+            body = json.dumps({'feed': {'entry': entries}}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('CMR-Hits', str(len(results)))
+            if page_size > 0 and offset + page_size < len(results):
+                self.send_header('CMR-Search-After', str(offset + page_size))
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
@@ -0,0 +1,259 @@
+"""
+Queue of granule tasks shared by workers on any number of machines
+"""
+
+import os
+import json
+import time
+import uuid
+import socket
+import sqlite3
+import logging
+import threading
+from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
+from future.utils import with_metaclass
+
+logger = logging.getLogger(__name__)
+
+
+class Lease(object):
+    """ A task taken from a queue, hidden from other workers until the lease expires """
+
+    def __init__(self, id, product, date, gid, granule, attempts, token):
+        self.id = id
+        self.product = product
+        self.date = date
+        self.gid = gid
+        self.granule = granule
+        self.attempts = attempts
+        # identifies this lease, so an expired lease taken by another worker cannot be acked
+        self.token = token
+
+
+class WorkQueue(with_metaclass(ABCMeta, object)):
+    """ Abstract base class of queues of granule tasks. A task is a dictionary with the
+    product, date, gid and CMR metadata (granule) of a granule, and optionally the
+    result (scene list metadata) if it needs no processing """
+
+    @abstractmethod
+    def put(self, tasks, overwrite=False):
+        """ Add tasks, returning the number added. Tasks already queued are kept, other than
+        those that failed for good, which are given their attempts back. If overwrite is
+        True all tasks already queued are made ready to run again """
+
+    @abstractmethod
+    def get(self, visibility=1800):
+        """ Lease the next ready task, or a task whose lease has expired, for visibility
+        seconds. Returns a Lease or None if there are no tasks to run """
+
+    @abstractmethod
+    def extend(self, lease, visibility=1800):
+        """ Extend lease to visibility seconds from now, returning False if it was lost """
+
+    @abstractmethod
+    def ack(self, lease, result):
+        """ Mark task done with its result. Returns True if it was the last task of its
+        day, in which case the caller finalizes the day (see results) """
+
+    @abstractmethod
+    def nack(self, lease, error):
+        """ Return a failed task to the queue, or fail it for good if out of attempts """
+
+    @abstractmethod
+    def results(self, product, date):
+        """ Results of the tasks of a day """
+
+    @abstractmethod
+    def counts(self):
+        """ Number of tasks in each state """
+
+
+class SQLiteQueue(WorkQueue):
+    """ Work queue in a SQLite file, for workers on one machine or sharing a filesystem """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS tasks (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, product TEXT, date TEXT, gid TEXT, granule TEXT,
+            state TEXT, attempts INTEGER, lease_until REAL, token TEXT, worker TEXT, error TEXT, result TEXT,
+            UNIQUE (product, gid))""",
+        "CREATE INDEX IF NOT EXISTS tasks_state ON tasks (state, lease_until)",
+        "CREATE INDEX IF NOT EXISTS tasks_date ON tasks (product, date)",
+        """CREATE TABLE IF NOT EXISTS days (
+            product TEXT, date TEXT, finalized INTEGER, PRIMARY KEY (product, date))""",
+    ]
+
+    def __init__(self, filename, max_attempts=3):
+        self.filename = filename
+        self.max_attempts = max_attempts
+        self.worker = '%s:%s' % (socket.gethostname(), os.getpid())
+        dirname = os.path.dirname(filename)
+        if dirname != '' and not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with self.connect() as conn:
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+
+    @contextmanager
+    def connect(self):
+        """ Connection to the database, in a transaction taking the write lock at once """
+        conn = sqlite3.connect(self.filename, timeout=60, isolation_level=None)
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except Exception:
+                conn.execute('ROLLBACK')
+                raise
+        finally:
+            conn.close()
+
+    def put(self, tasks, overwrite=False):
+        n = 0
+        with self.connect() as conn:
+            for t in tasks:
+                result = t.get('result')
+                row = (t['product'], str(t['date']), t['gid'], json.dumps(t['granule']),
+                       'ready' if result is None else 'done', _dumps(result))
+                if overwrite:
+                    conn.execute('DELETE FROM tasks WHERE product=? AND gid=?', (t['product'], t['gid']))
+                cur = conn.execute('INSERT OR IGNORE INTO tasks (product, date, gid, granule, state, attempts, result) '
+                                   'VALUES (?, ?, ?, ?, ?, 0, ?)', row)
+                if cur.rowcount == 0:
+                    # failed in an earlier run, so tried again (or done, if it has a result now)
+                    cur = conn.execute("UPDATE tasks SET state=?, attempts=0, error=NULL, lease_until=NULL, result=? "
+                                       "WHERE product=? AND gid=? AND state='failed'",
+                                       (row[4], row[5], t['product'], t['gid']))
+                n += cur.rowcount
+                conn.execute('INSERT OR IGNORE INTO days VALUES (?, ?, 0)', (t['product'], str(t['date'])))
+                if overwrite or cur.rowcount > 0:
+                    conn.execute('UPDATE days SET finalized=0 WHERE product=? AND date=?',
+                                 (t['product'], str(t['date'])))
+        return n
+
+    def get(self, visibility=1800):
+        now = time.time()
+        token = uuid.uuid4().hex
+        with self.connect() as conn:
+            while True:
+                row = conn.execute("SELECT id, product, date, gid, granule, attempts, state FROM tasks "
+                                   "WHERE state='ready' OR (state='leased' AND lease_until<?) "
+                                   "ORDER BY date DESC, id LIMIT 1", (now,)).fetchone()
+                if row is None:
+                    return None
+                if row[6] != 'leased':
+                    break
+                # worker holding the lease is gone
+                if row[5] < self.max_attempts:
+                    logger.warning('Lease of %s expired, running it again' % row[3])
+                    break
+                logger.error('Granule %s failed after %s attempts: lease expired' % (row[3], row[5]))
+                conn.execute("UPDATE tasks SET state='failed', error='lease expired' WHERE id=?", (row[0],))
+            conn.execute("UPDATE tasks SET state='leased', attempts=attempts+1, lease_until=?, token=?, worker=? "
+                         "WHERE id=?", (now + visibility, token, self.worker, row[0]))
+        return Lease(row[0], row[1], row[2], row[3], json.loads(row[4]), row[5] + 1, token)
+
+    def extend(self, lease, visibility=1800):
+        with self.connect() as conn:
+            cur = conn.execute("UPDATE tasks SET lease_until=? WHERE id=? AND token=? AND state='leased'",
+                               (time.time() + visibility, lease.id, lease.token))
+        return cur.rowcount == 1
+
+    def ack(self, lease, result):
+        with self.connect() as conn:
+            cur = conn.execute("UPDATE tasks SET state='done', result=?, error=NULL WHERE id=? AND token=?",
+                               (_dumps(result), lease.id, lease.token))
+            if cur.rowcount == 0:
+                logger.warning('Lease of %s was lost before it completed' % lease.gid)
+                return False
+            remaining = conn.execute("SELECT COUNT(*) FROM tasks WHERE product=? AND date=? AND state!='done'",
+                                     (lease.product, lease.date)).fetchone()[0]
+            if remaining > 0:
+                return False
+            # only one worker gets to finalize the day
+            cur = conn.execute('UPDATE days SET finalized=1 WHERE product=? AND date=? AND finalized=0',
+                               (lease.product, lease.date))
+            return cur.rowcount == 1
+
+    def nack(self, lease, error):
+        state = 'failed' if lease.attempts >= self.max_attempts else 'ready'
+        with self.connect() as conn:
+            conn.execute('UPDATE tasks SET state=?, error=?, lease_until=NULL WHERE id=? AND token=?',
+                         (state, str(error), lease.id, lease.token))
+        if state == 'failed':
+            logger.error('Granule %s failed after %s attempts: %s' % (lease.gid, lease.attempts, str(error)))
+
+    def results(self, product, date):
+        with self.connect() as conn:
+            rows = conn.execute("SELECT result FROM tasks WHERE product=? AND date=? AND state='done' ORDER BY gid",
+                                (product, str(date))).fetchall()
+        return [json.loads(r[0]) for r in rows]
+
+    def counts(self):
+        with self.connect() as conn:
+            rows = conn.execute('SELECT state, COUNT(*) FROM tasks GROUP BY state').fetchall()
+        return dict(rows)
+
+
+# queue backends by URL scheme, e.g. sqlite:///path/to/queue.sqlite
+backends = {
+    'sqlite': SQLiteQueue,
+}
+
+
+def open_queue(url, **kwargs):
+    """ Open work queue from a URL (scheme://location), or a file name for a SQLite queue """
+    scheme, sep, location = url.partition('://')
+    # sqlite:///path is an absolute path, sqlite://path a relative one
+    if sep == '':
+        scheme, location = 'sqlite', url
+    if scheme not in backends:
+        raise ValueError('Unknown queue backend %s, must be one of %s' % (scheme, ', '.join(sorted(backends))))
+    return backends[scheme](location, **kwargs)
+
+
+class Heartbeat(object):
+    """ Thread extending the leases a worker holds until they are removed """
+
+    def __init__(self, queue, visibility=1800):
+        self.queue = queue
+        self.visibility = visibility
+        self.leases = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+
+    def add(self, lease):
+        with self.lock:
+            self.leases[lease.id] = lease
+
+    def remove(self, lease):
+        with self.lock:
+            self.leases.pop(lease.id, None)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def _run(self):
+        # extend leases well before they expire
+        while not self.stopped.wait(self.visibility / 3.0):
+            with self.lock:
+                leases = list(self.leases.values())
+            for lease in leases:
+                try:
+                    if not self.queue.extend(lease, self.visibility):
+                        logger.warning('Lease of %s was lost' % lease.gid)
+                except Exception as e:
+                    logger.warning('Error extending lease of %s: %s' % (lease.gid, str(e)))
+
+
+def _dumps(value):
+    # dates in results are stored as they appear in scene lists
+    return json.dumps(value, default=str) if value is not None else None
@@ -0,0 +1,126 @@
+import os
+import unittest
+from dateutil.parser import parse
+from modispds.cache import GranuleCache
+from modispds.earthdata import query, query_dates, search, cmr_config, get_cache
+from modispds.testing import LocalCMR, make_cmr_granule
+
+
+class TestGranuleCache(unittest.TestCase):
+    """ Test caching of CMR query results """
+
+    product = 'MCD43A4.006'
+    tiles = ['h11v12', 'h12v07', 'h12v08']
+
+    def setUp(self):
+        granules = [make_cmr_granule(self.product, date=d, tile=t)
+                    for d in ['2016001', '2016002', '2016003'] for t in self.tiles]
+        self.cmr = LocalCMR(granules).start()
+        self.config = dict(cmr_config)
+        # queries without a cache argument are not cached
+        cmr_config.update({'url': self.cmr.url, 'cache': ''})
+        self.fname = os.path.join(os.path.dirname(__file__), 'cmr.sqlite')
+        self.cache = GranuleCache(self.fname)
+
+    def tearDown(self):
+        cmr_config.update(self.config)
+        self.cmr.stop()
+        os.remove(self.fname)
+
+    def test_query(self):
+        """ Query CMR once, then from the cache """
+        date1, date2 = parse('2016-01-01').date(), parse('2016-01-02').date()
+        q = query(date1, date2, cache=self.cache)
+        self.assertEqual(len(q), 6)
+        self.assertEqual(len(self.cmr.searches), 1)
+        q2 = query(date1, date2, cache=self.cache)
+        self.assertEqual(q2, q)
+        self.assertEqual(len(self.cmr.searches), 1)
+        # a window inside a cached window
+        q3 = query(date2, date2, cache=self.cache)
+        self.assertEqual(len(q3), 3)
+        self.assertEqual(len(self.cmr.searches), 1)
+        # a window outside a cached window
+        q4 = query(date2, parse('2016-01-03').date(), cache=self.cache)
+        self.assertEqual(len(q4), 6)
+        self.assertEqual(len(self.cmr.searches), 2)
+
+    def test_query_pages(self):
+        """ Query CMR for more than one page of granules """
+        self.cmr.granules = [make_cmr_granule(self.product, date='2016001', tile='h%02dv%02d' % (h, v))
+                             for h in range(36) for v in range(18)]
+        q = query(parse('2016-01-01').date(), parse('2016-01-01').date(), cache=self.cache)
+        self.assertEqual(len(q), 648)
+        self.assertEqual(len(self.cache.granules(self.product, '2016-01-01T00:00:00Z', '2016-01-01T23:59:00Z')), 648)
+
+    def test_refresh(self):
+        """ Refresh expired window with granules updated since it was fetched """
+        date1 = parse('2016-01-01').date()
+        query(date1, date1, cache=self.cache)
+        gran = make_cmr_granule(self.product, date='2016001', tile='h11v12', updated='2100-01-01T00:00:00.000Z',
+                                size_mb=20.0)
+        self.cmr.granules[0] = gran
+        # not expired
+        q = query(date1, date1, cache=self.cache)
+        self.assertEqual(q[0]['granule_size'], '10.0')
+        self.cache.ttl = -1
+        q = query(date1, date1, cache=self.cache)
+        self.assertEqual(len(self.cmr.searches), 2)
+        self.assertTrue('updated_since' in self.cmr.searches[1])
+        self.assertEqual(len(q), 3)
+        self.assertEqual(q[0]['granule_size'], '20.0')
+
+    def test_refresh_deleted(self):
+        """ Fetch expired window in full if CMR deleted any of its granules """
+        date1 = parse('2016-01-01').date()
+        query(date1, date1, cache=self.cache)
+        # superseded by a new granule
+        del self.cmr.granules[0]
+        self.cmr.granules.append(make_cmr_granule(self.product, date='2016001', tile='h13v07',
+                                                  updated='2100-01-01T00:00:00.000Z'))
+        self.cache.ttl = -1
+        q = query(date1, date1, cache=self.cache)
+        self.assertEqual(len(self.cmr.searches), 3)
+        self.assertTrue('updated_since' in self.cmr.searches[1])
+        self.assertFalse('updated_since' in self.cmr.searches[2])
+        self.assertEqual([g['id'] for g in q], ['G2016001.%s-LPDAAC_ECS' % t for t in ['h12v07', 'h12v08', 'h13v07']])
+
+    def test_refresh_now(self):
+        """ Refresh a window from CMR when refreshing, however recently it was cached """
+        dates = [parse('2016-01-01').date()]
+        list(query_dates(dates, product=self.product, cache=self.cache))
+        self.cmr.granules[0] = make_cmr_granule(self.product, date='2016001', tile='h11v12', size_mb=20.0,
+                                                updated='2100-01-01T00:00:00.000Z')
+        days = list(query_dates(dates, product=self.product, cache=self.cache, refresh=True))
+        self.assertEqual(len(self.cmr.searches), 2)
+        self.assertTrue('updated_since' in self.cmr.searches[1])
+        self.assertEqual(days[0][1][0]['granule_size'], '20.0')
+
+    def test_endpoint(self):
+        """ Granules are cached for each CMR endpoint """
+        date1 = parse('2016-01-01').date()
+        self.assertEqual(len(query(date1, date1, cache=self.cache)), 3)
+        other = GranuleCache(self.fname, endpoint='https://cmr.earthdata.nasa.gov/search/')
+        self.assertEqual(other.granules(self.product, '2016-01-01T00:00:00Z', '2016-01-01T23:59:00Z'), [])
+        cmr_config['cache'] = self.fname
+        self.assertEqual(get_cache().endpoint, self.cmr.url)
+
+    def test_search_pages(self):
+        """ Fetch pages of search results concurrently """
+        granules = search('2016-01-01T00:00:00Z', '2016-01-03T23:59:00Z', product=self.product, page_size=2, workers=3)
+        self.assertEqual(len(self.cmr.searches), 5)
+        self.assertEqual([g['id'] for g in granules], [g['id'] for g in self.cmr.granules])
+
+    def test_query_dates(self):
+        """ Query a range of dates at once and partition granules by date """
+        dates = [parse(d).date() for d in ['2016-01-01', '2016-01-02', '2016-01-03']]
+        days = list(query_dates(dates, product=self.product, cache=self.cache))
+        self.assertEqual(len(self.cmr.searches), 1)
+        self.assertEqual([d for d, _ in days], dates)
+        for day, granules in days:
+            self.assertEqual(len(granules), 3)
+            self.assertTrue(all(day.strftime('A%Y%j') in g['producer_granule_id'] for g in granules))
+        # one query per range of days
+        days = list(query_dates(dates, product=self.product, days=2))
+        self.assertEqual(len(self.cmr.searches), 3)
+        self.assertEqual(sum(len(g) for _, g in days), 9)
@@ -0,0 +1,97 @@
+import os
+import json
+import shutil
+import filecmp
+import tempfile
+import unittest
+from modispds.convert import convert_to_geotiff, convert_config, output_settings, creation_options, OVERVIEW_LEVELS
+from modispds.testing import make_granule
+from modispds.products import products
+
+
+class TestConvert(unittest.TestCase):
+    """ Test conversion of a synthetic granule to GeoTIFFs """
+
+    @classmethod
+    def setUpClass(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.hdf = make_granule('MCD43A4.006', outdir=self.tmpdir, size=480)
+
+    @classmethod
+    def tearDownClass(self):
+        shutil.rmtree(self.tmpdir)
+
+    def convert(self, **kwargs):
+        outdir = tempfile.mkdtemp(dir=self.tmpdir)
+        return convert_to_geotiff(self.hdf, outdir=outdir, **kwargs)
+
+    def test_convert(self):
+        """ Convert to a GeoTIFF per band and overviews """
+        fnames = self.convert()
+        bandnames = products['MCD43A4.006']['bandnames']
+        tifs = [f for f in fnames if f.endswith('.TIF')]
+        self.assertEqual(len(tifs), len(bandnames))
+        self.assertEqual(len(fnames), len(bandnames) + sum(products['MCD43A4.006']['overviews']))
+        for f in fnames:
+            self.assertTrue(os.path.exists(f))
+
+    def test_convert_cog(self):
+        """ Convert to a COG per band, with overviews inside and ahead of the image data """
+        from osgeo import gdal
+        convert_config['format'] = 'COG'
+        try:
+            fnames = self.convert()
+        finally:
+            convert_config['format'] = None
+        overviews = products['MCD43A4.006']['overviews']
+        self.assertEqual(len(fnames), len(overviews))
+        for f, overview in zip(fnames, overviews):
+            band = gdal.Open(f).GetRasterBand(1)
+            self.assertEqual(band.GetOverviewCount(), len(OVERVIEW_LEVELS) if overview else 0)
+            if overview:
+                offset = int(band.GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF'))
+                self.assertLess(int(band.GetOverview(0).GetMetadataItem('BLOCK_OFFSET_0_0', 'TIFF')), offset)
+
+    def test_convert_stacked(self):
+        """ Convert to a GeoTIFF per group of bands, with a manifest of the bands """
+        from osgeo import gdal
+        convert_config['layout'] = 'stacked'
+        try:
+            fnames = self.convert()
+        finally:
+            convert_config['layout'] = None
+        self.assertEqual([os.path.basename(f).split('_')[-1] for f in fnames],
+                         ['qa.TIF', 'refl.TIF', 'refl.TIF.ovr', 'bands.json'])
+        with open(fnames[-1]) as f:
+            manifest = json.load(f)
+        self.assertEqual(sorted(manifest['bands']), sorted(products['MCD43A4.006']['bandnames']))
+        self.assertEqual(manifest['bands']['B03'], {'file': os.path.basename(fnames[1]), 'band': 3})
+        ds = gdal.Open(fnames[1])
+        self.assertEqual(ds.RasterCount, 7)
+        self.assertEqual(ds.GetRasterBand(3).GetOverviewCount(), len(OVERVIEW_LEVELS))
+        self.assertEqual(gdal.Open(fnames[0]).GetRasterBand(1).GetOverviewCount(), 0)
+
+    def test_output_settings(self):
+        """ Creation options from a product's output settings """
+        settings = output_settings('MCD43A4.006')
+        self.assertEqual(settings['format'], 'GTiff')
+        # the same options as before output settings were added
+        self.assertEqual(creation_options(settings), {'COMPRESS': 'DEFLATE', 'PREDICTOR': '2', 'TILED': 'YES',
+                                                      'BLOCKXSIZE': '512', 'BLOCKYSIZE': '512'})
+        convert_config['format'] = 'COG'
+        try:
+            self.assertEqual(output_settings('MCD43A4.006')['format'], 'COG')
+        finally:
+            convert_config['format'] = None
+        opts = creation_options(dict(settings, compress='ZSTD', level=9, blocksize=256))
+        self.assertEqual(opts['ZSTD_LEVEL'], '9')
+        self.assertEqual(opts['BLOCKXSIZE'], '256')
+        self.assertFalse('ZLEVEL' in creation_options(dict(settings, compress='LZW')))
+
+    def test_convert_parallel(self):
+        """ Converting bands in parallel gives identical files """
+        fnames = self.convert()
+        fnames2 = self.convert(workers=3)
+        self.assertEqual([os.path.basename(f) for f in fnames], [os.path.basename(f) for f in fnames2])
+        for f1, f2 in zip(fnames, fnames2):
+            self.assertTrue(filecmp.cmp(f1, f2, shallow=False))
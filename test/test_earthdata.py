@@ -1,7 +1,12 @@
 import os
 from dateutil.parser import parse
 import unittest
-from modispds.earthdata import query, download_granule
+import modispds.earthdata as earthdata
+from modispds.earthdata import query, download_granule, download_file, EarthdataSession
+from modispds.earthdata import get_file_info, verify_file, cksum, granule_identity, changed
+from modispds.testing import LocalEarthdata
+from modispds.metrics import metrics
+from modispds.ratelimit import limiter
 
 
 class TestCMR(unittest.TestCase):
@@ -42,3 +47,209 @@ class TestCMR(unittest.TestCase):
         for f in fnames:
             self.assertTrue(os.path.exists(f))
             os.remove(f)
+
+
+class TestEarthdataSession(unittest.TestCase):
+    """ Test authenticated downloads against a local Earthdata server """
+
+    outdir = os.path.dirname(__file__)
+
+    @classmethod
+    def setUpClass(self):
+        self.server = LocalEarthdata().start()
+        self.urls = [self.server.add_file('file%s.hdf' % i, os.urandom(1000)) for i in range(3)]
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.stop()
+
+    def setUp(self):
+        self.server.requests = {}
+        self.session = EarthdataSession('user', 'pass', urs=self.server.netloc)
+
+    def download(self, url):
+        fname = download_file(url, outdir=self.outdir, session=self.session)
+        with open(fname, 'rb') as f:
+            self.assertEqual(f.read(), self.server.files[os.path.basename(url)])
+        os.remove(fname)
+
+    def test_authenticate_once(self):
+        """ Authenticate once for many downloads """
+        for url in self.urls:
+            self.download(url)
+        self.assertEqual(self.session.logins, 1)
+        self.assertEqual(self.server.requests['authorize'], 1)
+        self.assertEqual(self.server.requests['download'], 3)
+        # one redirect to URS, then one request per file
+        self.assertEqual(self.server.requests['data'], 4)
+
+    def test_expired_cookie(self):
+        """ Authenticate again when cookie has expired """
+        self.download(self.urls[0])
+        self.server.expire()
+        self.download(self.urls[1])
+        self.download(self.urls[2])
+        self.assertEqual(self.session.logins, 2)
+        self.assertEqual(self.server.requests['authorize'], 2)
+
+    def test_bad_credentials(self):
+        """ Authentication failure raises error """
+        session = EarthdataSession('user', 'wrong', urs=self.server.netloc)
+        with self.assertRaises(RuntimeError):
+            session.get(self.urls[0])
+
+    def test_noauth(self):
+        """ Download file without authentication """
+        self.download(self.urls[0].replace('/data/', '/public/'))
+        self.assertFalse('authorize' in self.server.requests)
+
+    def test_throttled(self):
+        """ Retry requests that are throttled """
+        self.server.throttle = 2
+        self.download(self.urls[0])
+        self.assertEqual(self.server.requests['throttled'], 2)
+        self.assertEqual(self.server.requests['download'], 1)
+
+    def test_stream_slot(self):
+        """ Hold a slot of the limiter until a streamed response is closed """
+        lim = limiter('earthdata')
+        in_flight = lim.in_flight
+        self.download(self.urls[0])
+        self.assertEqual(lim.in_flight, in_flight)
+        stream = self.session.get(self.urls[1])
+        stream.content
+        self.assertEqual(lim.in_flight, in_flight + 1)
+        stream.close()
+        stream.close()
+        self.assertEqual(lim.in_flight, in_flight)
+
+
+class TestDownload(unittest.TestCase):
+    """ Test ranged, resumable downloads and verification against a local server """
+
+    outdir = os.path.dirname(__file__)
+    xml = """<GranuleURMetaData><DataFiles><DataFileContainer>
+        <DistributedFileName>big.hdf</DistributedFileName>
+        <FileSize>5000000</FileSize>
+        <ChecksumType>CKSUM</ChecksumType>
+        <Checksum>%s</Checksum>
+        </DataFileContainer></DataFiles></GranuleURMetaData>"""
+
+    @classmethod
+    def setUpClass(self):
+        self.server = LocalEarthdata().start()
+        self.data = os.urandom(5000000)
+        self.url = self.server.add_file('big.hdf', self.data)
+
+    @classmethod
+    def tearDownClass(self):
+        self.server.stop()
+
+    def setUp(self):
+        self.config = dict(earthdata.download_config)
+        earthdata.download_config.update({'chunk_size': 65536, 'segment_threshold': 1000000, 'segments': 4})
+        self.server.requests = {}
+        self.server.ranges = True
+        self.session = EarthdataSession('user', 'pass', urs=self.server.netloc)
+
+    def tearDown(self):
+        earthdata.download_config.update(self.config)
+
+    def download(self, **kwargs):
+        fname = download_file(self.url, outdir=self.outdir, session=self.session, **kwargs)
+        with open(fname, 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        self.assertFalse(os.path.exists(fname + '.part'))
+        return fname
+
+    def test_segments(self):
+        """ Download large file in concurrent ranges """
+        metrics.reset()
+        os.remove(self.download(size=len(self.data)))
+        # one request for the size, then one per segment
+        self.assertEqual(self.server.requests['download'], 5)
+        totals = [t for (name, labels), t in metrics.totals.items() if name == 'download']
+        self.assertEqual(totals[0]['bytes'], len(self.data))
+
+    def test_resume(self):
+        """ Resume download after a failure """
+        self.server.failures['big.hdf'] = 300000
+        os.remove(self.download())
+        self.assertEqual(self.server.requests['download'], 6)
+
+    def test_no_ranges(self):
+        """ Download in one request if server does not support ranges """
+        self.server.ranges = False
+        os.remove(self.download())
+        self.assertEqual(self.server.requests['download'], 1)
+
+    def test_verify(self):
+        """ Verify size and checksum of file """
+        fname = self.download()
+        verify_file(fname, size=len(self.data), size_mb=len(self.data) / 1e6)
+        with self.assertRaises(RuntimeError):
+            verify_file(fname, checksum='1234')
+        self.assertFalse(os.path.exists(fname))
+
+    def test_file_info(self):
+        """ Get file size and checksum from XML metadata """
+        fname = self.download()
+        value = cksum(fname)
+        fxml = os.path.join(self.outdir, 'big.hdf.xml')
+        with open(fxml, 'w') as f:
+            f.write(self.xml % value)
+        info = get_file_info(fxml)
+        self.assertEqual(info['big.hdf'], {'size': 5000000, 'checksum': value, 'checksum_type': 'CKSUM'})
+        verify_file(fname, **info['big.hdf'])
+        os.remove(fxml)
+        os.remove(fname)
+
+    def test_changed(self):
+        """ Granules change with their producer granule ID, revision or checksum """
+        meta = {'id': 'G1-LPDAAC_ECS', 'producer_granule_id': 'MCD43A4.A2016001.h11v12.006.2016174075640.hdf',
+                'updated': '2016-06-22T07:56:40.000Z'}
+        stored = granule_identity(meta, checksum='1234')
+        self.assertFalse(changed(granule_identity(meta), stored))
+        self.assertTrue(changed(granule_identity(dict(meta, updated='2017-01-01T00:00:00.000Z')), stored))
+        self.assertTrue(changed(granule_identity(meta, checksum='5678'), stored))
+        # revision IDs are only compared if both have one
+        self.assertFalse(changed(granule_identity(dict(meta, revision_id=2)), stored))
+        self.assertTrue(changed(granule_identity(meta), None))
+
+    def test_cksum(self):
+        """ Python cksum matches cksum utility """
+        fname = os.path.join(self.outdir, 'small.dat')
+        with open(fname, 'wb') as f:
+            f.write(self.data[:100000])
+        value = cksum(fname)
+        which = earthdata.which
+        earthdata.which = lambda exe: None
+        try:
+            self.assertEqual(cksum(fname), value)
+        finally:
+            earthdata.which = which
+        os.remove(fname)
+
+    def test_download_granule(self):
+        """ Download a granule's files from its CMR metadata and verify the hdf """
+        fname = os.path.join(self.outdir, 'MCD43A4.A2016001.h11v12.006.2016174075640.hdf')
+        with open(fname, 'wb') as f:
+            f.write(self.data)
+        meta = self.server.add_granule(fname)
+        checksum = cksum(fname)
+        os.remove(fname)
+        earthdata._sessions[os.getpid()] = self.session
+        try:
+            fnames = download_granule(meta, outdir=self.outdir)
+        finally:
+            earthdata._sessions.clear()
+        self.assertEqual(os.path.basename(fnames[0]), os.path.basename(fname))
+        with open(fnames[0], 'rb') as f:
+            self.assertEqual(f.read(), self.data)
+        # metadata has the identity of this version of the granule, with the hdf's checksum
+        with open(fnames[2]) as f:
+            identity = earthdata.load(f)['identity']
+        self.assertEqual(identity, granule_identity(meta, checksum=str(checksum)))
+        for f in fnames:
+            self.assertTrue(os.path.exists(f))
+            os.remove(f)
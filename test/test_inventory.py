@@ -0,0 +1,67 @@
+import os
+import datetime
+import unittest
+from modispds.pds import get_client
+from modispds.inventory import Inventory
+from modispds.testing import LocalS3, requires_moto
+
+
+@requires_moto
+class TestInventory(unittest.TestCase):
+    """ Test inventory of objects in bucket """
+
+    product = 'MCD43A4.006'
+
+    @classmethod
+    def setUpClass(self):
+        self.s3 = LocalS3(bucket='testing-bucket').start()
+        s3 = get_client()
+        keys = ['%s/2016-01-0%s_scenes.txt' % (self.product, d) for d in [1, 2]]
+        keys += ['%s/11/12/2016001/file%s.TIF' % (self.product, i) for i in range(25)]
+        keys += ['%s/12/07/2016001/file%s.TIF' % (self.product, i) for i in range(10)]
+        # more than one page of results
+        keys += ['%s/12/08/%s/file.TIF' % (self.product, 2000000 + d) for d in range(1005)]
+        keys += ['MOD09GA.006/11/12/2016001/file.TIF']
+        # scene index is not a granule
+        keys += ['%s/index/tiles/h11v12/2016.csv.gz' % self.product]
+        for key in keys:
+            s3.put_object(Bucket='testing-bucket', Key=key, Body=b'')
+
+    @classmethod
+    def tearDownClass(self):
+        self.s3.stop()
+
+    def test_load(self):
+        """ Load inventory from bucket """
+        inv = Inventory('testing-bucket', self.product).load(workers=2)
+        self.assertTrue(inv.has_scenes('2016-01-01'))
+        self.assertFalse(inv.has_scenes('2016-01-03'))
+        self.assertEqual(inv.count('%s/11/12/2016001' % self.product), 25)
+        self.assertEqual(inv.count('%s/12/07/2016001' % self.product), 10)
+        self.assertEqual(inv.count('%s/12/07/2016002' % self.product), 0)
+        self.assertEqual(len(inv.granules), 1007)
+
+    def test_load_dates(self):
+        """ Load scene lists of some dates, and count granules when asked """
+        inv = Inventory('testing-bucket', self.product).load(dates=[datetime.date(2016, 1, 3)])
+        self.assertFalse(inv.complete)
+        self.assertTrue(inv.has_scenes('2016-01-02'))
+        self.assertFalse(inv.has_scenes('2016-01-03'))
+        self.assertEqual(len(inv.granules), 0)
+        self.assertEqual(inv.count('%s/11/12/2016001' % self.product), 25)
+        self.assertEqual(inv.count('%s/12/07/2016002' % self.product), 0)
+        self.assertEqual(len(inv.granules), 2)
+        self.assertFalse(Inventory('testing-bucket', self.product).load(dates=[datetime.date(2016, 2, 1)]).scenes)
+
+    def test_cached(self):
+        """ Save inventory to file and read it back """
+        fname = os.path.join(os.path.dirname(__file__), 'inventory.json')
+        inv = Inventory.cached(fname, 'testing-bucket', self.product)
+        self.assertTrue(os.path.exists(fname))
+        inv2 = Inventory.cached(fname, 'testing-bucket', self.product, max_age=3600)
+        self.assertEqual(inv2.timestamp, inv.timestamp)
+        self.assertEqual(inv2.granules, inv.granules)
+        # expired inventory is reloaded
+        inv3 = Inventory.cached(fname, 'testing-bucket', self.product, max_age=0)
+        self.assertTrue(inv3.timestamp > inv.timestamp)
+        os.remove(fname)
@@ -0,0 +1,81 @@
+import os
+import datetime
+import unittest
+from modispds.journal import Journal
+from modispds.testing import make_cmr_granule
+
+
+class TestJournal(unittest.TestCase):
+    """ Test journal of granule progress """
+
+    product = 'MCD43A4.006'
+    day = datetime.date(2016, 1, 1)
+
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'journal.sqlite')
+        self.journal = Journal(self.fname)
+        grans = [make_cmr_granule(self.product, date='2016001', tile=t) for t in ['h11v12', 'h12v07', 'h12v08']]
+        self.gids = [os.path.splitext(os.path.basename(g['links'][0]['href']))[0] for g in grans]
+        self.journal.add(self.product, self.day, list(zip(self.gids, grans)))
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_add(self):
+        """ Add granules to journal """
+        self.assertEqual(len(self.journal.todo(self.product, self.day)), 3)
+        entry = self.journal.get(self.product, self.gids[0])
+        self.assertEqual(entry['state'], 'queried')
+        self.assertEqual(entry['attempts'], 0)
+        # adding again keeps state
+        self.journal.update(self.product, self.gids[0], 'downloaded', files=['a.hdf'])
+        self.journal.add(self.product, self.day, [(self.gids[0], {})])
+        entry = self.journal.get(self.product, self.gids[0])
+        self.assertEqual(entry['state'], 'downloaded')
+        self.assertEqual(entry['files'], ['a.hdf'])
+
+    def test_progress(self):
+        """ Record granules uploaded and failed """
+        metadata = {'gid': self.gids[0], 'date': datetime.datetime(2016, 1, 1)}
+        self.journal.update(self.product, self.gids[0], 'uploaded', keys=['s3://bucket/key'], metadata=metadata)
+        self.journal.fail(self.product, self.gids[1], 'error')
+        self.journal.fail(self.product, self.gids[1], 'error')
+        self.assertEqual(len(self.journal.todo(self.product, self.day)), 2)
+        self.assertEqual(len(self.journal.todo(self.product, self.day, retries=2)), 1)
+        self.assertEqual(self.journal.failed(self.product, self.day), [(self.gids[1], 2, 'error')])
+        scenes = self.journal.scenes(self.product, self.day)
+        self.assertEqual(scenes, [{'gid': self.gids[0], 'date': '2016-01-01 00:00:00'}])
+
+    def test_staged(self):
+        """ Staged granules are not processed again, and are uploaded once promoted """
+        metadata = {'gid': self.gids[0]}
+        self.journal.update(self.product, self.gids[0], 'staged', keys=['s3://bucket/key'], metadata=metadata)
+        self.assertEqual(len(self.journal.todo(self.product, self.day)), 2)
+        self.assertEqual(self.journal.staged(self.product, self.day), [self.gids[0]])
+        self.assertEqual(self.journal.scenes(self.product, self.day), [metadata])
+        self.journal.promote(self.product, self.gids[0])
+        entry = self.journal.get(self.product, self.gids[0])
+        self.assertEqual(entry['state'], 'uploaded')
+        self.assertEqual(entry['metadata'], metadata)
+        self.assertEqual(self.journal.staged(self.product, self.day), [])
+        # only staged granules are promoted
+        self.journal.promote(self.product, self.gids[1])
+        self.assertEqual(self.journal.get(self.product, self.gids[1])['state'], 'queried')
+
+    def test_rearm(self):
+        """ Give failed granules their attempts back """
+        self.journal.fail(self.product, self.gids[1], 'error')
+        self.journal.update(self.product, self.gids[2], 'uploaded')
+        self.journal.fail(self.product, self.gids[2], 'error')
+        self.assertEqual(len(self.journal.todo(self.product, self.day, retries=1)), 1)
+        self.assertEqual(self.journal.rearm(self.product, datetime.date(2016, 1, 2)), 0)
+        self.assertEqual(self.journal.rearm(self.product, self.day, self.day), 1)
+        self.assertEqual(len(self.journal.todo(self.product, self.day, retries=1)), 2)
+        self.assertEqual(self.journal.failed(self.product, self.day), [])
+
+    def test_reset(self):
+        """ Remove granules from journal """
+        self.assertEqual(self.journal.reset(self.product, gid=self.gids[0]), 1)
+        self.assertEqual(self.journal.get(self.product, self.gids[0]), None)
+        self.assertEqual(self.journal.reset(self.product, date=datetime.date(2016, 1, 2)), 0)
+        self.assertEqual(self.journal.reset(self.product, date=self.day), 2)
@@ -1,11 +1,23 @@
 import os
+import json
+import shutil
+import tempfile
 import unittest
 import datetime
 from dateutil.parser import parse
 from modispds.earthdata import query, download_granule
 import modispds.main as modis
-from modispds.pds import s3_list, del_from_s3
+from modispds.pds import s3_list, delete_prefix
 from modispds.products import products
+from modispds.convert import convert_config
+from modispds.earthdata import cmr_config, granule_identity
+from modispds.testing import LocalCMR, LocalS3, make_cmr_granule, requires_moto
+from modispds.pds import get_client
+from modispds.sceneindex import SceneIndex
+from modispds.memory import budget, to_memory
+from modispds.pipeline import Task
+from modispds.journal import Journal
+from modispds.staging import staging_config, get_staging
 
 
 class TestMain(unittest.TestCase):
@@ -42,6 +54,42 @@ class TestMain(unittest.TestCase):
         path = modis.get_s3_path(self.fname, prefix=prefix)
         self.assertEqual(path, os.path.join(prefix, truth_path))
 
+    def test_expected_objects(self):
+        """ Number of objects stored per granule """
+        self.assertEqual(modis.expected_objects('MCD43A4.006'), 25)
+        self.assertEqual(modis.expected_objects('MOD09GA.006'), 33)
+        self.assertEqual(modis.expected_objects('MOD09GQ.006'), 14)
+        # overviews are inside COGs
+        convert_config['format'] = 'COG'
+        try:
+            self.assertEqual(modis.expected_objects('MCD43A4.006'), 18)
+            self.assertEqual(modis.expected_objects('MOD09GA.006'), 26)
+            self.assertEqual(modis.expected_objects('MOD09GQ.006'), 12)
+        finally:
+            convert_config['format'] = None
+        # groups of bands stacked in a file each, with a manifest
+        convert_config['layout'] = 'stacked'
+        try:
+            self.assertEqual(modis.expected_objects('MCD43A4.006'), 8)
+            self.assertEqual(modis.expected_objects('MOD09GA.006'), 19)
+            self.assertEqual(modis.expected_objects('MOD09GQ.006'), 13)
+            convert_config['format'] = 'COG'
+            self.assertEqual(modis.expected_objects('MCD43A4.006'), 7)
+            self.assertEqual(modis.expected_objects('MOD09GA.006'), 18)
+            self.assertEqual(modis.expected_objects('MOD09GQ.006'), 12)
+        finally:
+            convert_config['format'] = None
+            convert_config['layout'] = None
+
+    def test_parse_overwrite(self):
+        """ Split dates and granule IDs to overwrite """
+        self.assertEqual(modis.parse_overwrite(True), ([], []))
+        dates, gids = modis.parse_overwrite(['2016-01-01', self.fname])
+        self.assertEqual(dates, [datetime.date(2016, 1, 1)])
+        self.assertEqual(gids, [os.path.splitext(self.fname)[0]])
+        args = modis.parse_args([self.date1, self.date1, '--overwrite'])
+        self.assertEqual(args.overwrite, [])
+
     def test_convert_to_geotiff(self):
         """ Convert hdf to individual GeoTIFF files """
         fnames = modis.convert_to_geotiff(self.fnames[0], outdir=os.path.dirname(__file__))
@@ -71,8 +119,197 @@ class TestMain(unittest.TestCase):
         self.assertTrue(len(fnames), 25)
         # test that granule exists
         # self.assertTrue(granule_exists(fname))
-        for f in fnames:
-            del_from_s3(f)
-            # once one file has been removed the granule should not qualify as existing
-            #self.assertFalse(granule_exists(fname))
-        #self.assertFalse(granule_exists(fname))
+        delete_prefix(s3path)
+
+
+class TestCleanup(unittest.TestCase):
+    """ Test cleaning up after granules leaving the pipeline """
+
+    def test_release_memory(self):
+        """ Memory held by a granule whose upload failed is released """
+        gran = make_cmr_granule('MCD43A4.006')
+        task = Task(0, gran)
+        used = budget.used.value
+        task.value = (modis.get_gid(gran) + '.hdf', [to_memory('index.html', b'test')])
+        task.error = RuntimeError('Upload failed')
+        modis.cleanup_granule(task)
+        self.assertEqual(budget.used.value, used)
+
+
+class TestResumeStaged(unittest.TestCase):
+    """ Test resuming granules staged in an earlier run """
+
+    product = 'MCD43A4.006'
+    day = datetime.date(2016, 1, 1)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = dict(staging_config)
+        staging_config['dir'] = os.path.join(self.tmpdir, 'staging')
+        self.journal = Journal(os.path.join(self.tmpdir, 'journal.sqlite'))
+        self.granules = [make_cmr_granule(self.product, date='2016001', tile=t) for t in ['h11v12', 'h12v07', 'h13v08']]
+        self.gids = [modis.get_gid(gran) for gran in self.granules]
+        self.journal.add(self.product, self.day, list(zip(self.gids, self.granules)))
+        for gid in self.gids:
+            self.journal.update(self.product, gid, 'staged', metadata={'gid': gid})
+
+    def tearDown(self):
+        staging_config.update(self.config)
+        shutil.rmtree(self.tmpdir)
+
+    def test_resume_staged(self):
+        """ Granules uploaded are promoted, those still staged left, and those lost processed again """
+        staging = get_staging()
+        for gid in self.gids[:2]:
+            fname = os.path.join(self.tmpdir, 'B01.TIF')
+            with open(fname, 'w') as f:
+                f.write(gid)
+            staging.stage(modis.bucket, 'testing/' + gid, gid, [fname])
+        staging.done(staging.claim())
+        todo = modis.journal_granules(self.day, self.granules, self.journal, product=self.product)
+        self.assertEqual([modis.get_gid(gran) for gran in todo], self.gids[2:])
+        self.assertEqual([self.journal.get(self.product, gid)['state'] for gid in self.gids],
+                         ['uploaded', 'staged', 'queried'])
+        # the day's scene list still has the granule waiting to be uploaded
+        self.assertEqual(self.journal.scenes(self.product, self.day), [{'gid': gid} for gid in self.gids[:2]])
+
+
+@requires_moto
+class TestPlan(unittest.TestCase):
+    """ Test planning work left from CMR and S3 listings """
+
+    product = 'MCD43A4.006'
+
+    def setUp(self):
+        granules = [make_cmr_granule(self.product, date=d, tile=t)
+                    for d in ['2016001', '2016002'] for t in ['h11v12', 'h12v07']]
+        self.cmr = LocalCMR(granules).start()
+        self.config = dict(cmr_config)
+        cmr_config.update({'url': self.cmr.url, 'cache': ''})
+        self.s3 = LocalS3(bucket=modis.bucket).start()
+        # first day done, and one granule of the second day
+        s3 = get_client()
+        s3.put_object(Bucket=modis.bucket, Key='%s/2016-01-01_scenes.txt' % self.product, Body=b'')
+        path = modis.get_s3_path(modis.get_gid(granules[2]))
+        for i in range(modis.expected_objects(self.product)):
+            s3.put_object(Bucket=modis.bucket, Key='%s/file%s' % (path, i), Body=b'')
+
+    def tearDown(self):
+        cmr_config.update(self.config)
+        self.cmr.stop()
+        self.s3.stop()
+
+    def test_plan(self):
+        """ Days and granules left to ingest, with estimated bytes and objects """
+        result = modis.plan([self.product], '2016-01-01', '2016-01-03')
+        self.assertEqual(result['products'][self.product]['days'],
+                         {'2016-01-02': ['MCD43A4.A2016002.h12v07.006.2016174075640']})
+        self.assertEqual(result['granules'], 1)
+        self.assertEqual(result['bytes'], 10 * 1024 * 1024)
+        self.assertEqual(result['objects'], modis.expected_objects(self.product) + 1)
+        summary = modis.plan([self.product], '2016-01-01', '2016-01-03', granules=False)
+        self.assertEqual(summary['products'][self.product]['days'], {'2016-01-02': 1})
+        self.assertEqual(summary['objects'], result['objects'])
+
+
+@requires_moto
+class TestRefresh(unittest.TestCase):
+    """ Test finding granules that changed in CMR since they were processed """
+
+    product = 'MCD43A4.006'
+
+    def setUp(self):
+        self.granules = [make_cmr_granule(self.product, date='2016001', tile=t)
+                         for t in ['h11v12', 'h12v07', 'h13v08', 'h14v09']]
+        self.s3 = LocalS3(bucket=modis.bucket).start()
+        s3 = get_client()
+        # all but the third granule processed, the second since updated in CMR
+        stored = [dict(self.granules[0], identity=granule_identity(self.granules[0], checksum='1234')),
+                  dict(self.granules[1], updated='2016-06-01T00:00:00.000Z'), None, self.granules[3]]
+        for gran, meta in zip(self.granules, stored):
+            if meta is None:
+                continue
+            gid = modis.get_gid(gran)
+            path = modis.get_s3_path(gid)
+            for i in range(modis.expected_objects(self.product) - 1):
+                s3.put_object(Bucket=modis.bucket, Key='%s/file%s' % (path, i), Body=b'')
+            s3.put_object(Bucket=modis.bucket, Key='%s/%s_meta.json' % (path, gid), Body=json.dumps(meta).encode())
+
+    def tearDown(self):
+        delete_prefix('s3://%s/%s/' % (modis.bucket, self.product))
+        self.s3.stop()
+
+    def test_refresh_granules(self):
+        """ Granules changed or not yet processed are reprocessed, metadata without identity is compared as is """
+        todo, unchanged = modis.refresh_granules(self.granules)
+        self.assertEqual(todo, self.granules[1:3])
+        self.assertEqual(unchanged, [self.granules[0], self.granules[3]])
+
+    def test_stored_identity(self):
+        """ Identity stored with a granule on S3 """
+        identity = modis.stored_identity(modis.get_gid(self.granules[0]))
+        self.assertEqual(identity['checksum'], '1234')
+        self.assertEqual(identity['producer_granule_id'], self.granules[0]['producer_granule_id'])
+        self.assertEqual(modis.stored_identity(modis.get_gid(self.granules[2])), None)
+
+
+@requires_moto
+class TestPurge(unittest.TestCase):
+    """ Test deleting granules by date and tile """
+
+    product = 'MCD43A4.006'
+    tiles = ['h11v12', 'h12v07']
+
+    def setUp(self):
+        self.s3 = LocalS3(bucket=modis.bucket).start()
+        s3 = get_client()
+        for day in ['2016-01-01', '2016-01-02']:
+            metadata = []
+            for tile in self.tiles:
+                # scene list dates are 8 days after granule dates
+                date = (parse(day) - datetime.timedelta(8)).strftime('%Y%j')
+                gid = modis.get_gid(make_cmr_granule(self.product, date=date, tile=tile))
+                for i in range(3):
+                    s3.put_object(Bucket=modis.bucket, Key='%s/file%s' % (modis.get_s3_path(gid), i), Body=b'1234')
+                metadata.append(modis.granule_metadata(gid))
+            modis.push_scenes(self.product, day, metadata, outdir=os.path.dirname(__file__))
+
+    def tearDown(self):
+        delete_prefix('s3://%s/%s/' % (modis.bucket, self.product))
+        self.s3.stop()
+        for day in ['2016-01-01', '2016-01-02']:
+            os.remove(os.path.join(os.path.dirname(__file__), self.product, day + '_scenes.txt'))
+        os.rmdir(os.path.join(os.path.dirname(__file__), self.product))
+
+    def scenes(self, day):
+        data = get_client().get_object(Bucket=modis.bucket, Key='%s/%s_scenes.txt' % (self.product, day))['Body'].read()
+        lines = data.decode('utf-8').splitlines()
+        col = lines[0].split(',').index('gid')
+        return [line.split(',')[col] for line in lines[1:]]
+
+    def test_purge_tiles(self):
+        """ Granules of a tile on a date are deleted and removed from its scene list and index """
+        result = modis.purge(self.product, '2016-01-02', '2016-01-02', tiles=['h11v12'], dry_run=True)
+        self.assertEqual(result['granules'], 1)
+        self.assertEqual(result['objects'], 3)
+        self.assertEqual(result['bytes'], 12)
+        self.assertEqual(result['scene_lists'], {'2016-01-02': 1})
+        self.assertEqual(len(self.scenes('2016-01-02')), 2)
+        result = modis.purge(self.product, '2016-01-02', '2016-01-02', tiles=['h11v12'])
+        self.assertEqual(result['objects'], 3)
+        self.assertEqual(self.scenes('2016-01-02'), ['MCD43A4.A2015359.h12v07.006.2016174075640'])
+        self.assertEqual(len(self.scenes('2016-01-01')), 2)
+        self.assertEqual(len(s3_list('s3://%s/%s/11/12/' % (modis.bucket, self.product))), 3)
+        index = SceneIndex(modis.bucket, self.product)
+        self.assertEqual(len(index.lookup('2016-01-02', '2016-01-02')), 1)
+        self.assertEqual(index.lookup('2016-01-01', '2016-01-02', tile='h11v12')[0]['date'], '2016-01-01')
+
+    def test_purge_dates(self):
+        """ All granules of a date are deleted along with its scene list """
+        result = modis.purge(self.product, '2016-01-01', '2016-01-01')
+        self.assertEqual(result['granules'], 2)
+        self.assertEqual(result['scene_lists'], {'2016-01-01': 2})
+        keys = [k.split('/', 3)[-1] for k in s3_list('s3://%s/%s/' % (modis.bucket, self.product))]
+        self.assertFalse('2016-01-01_scenes.txt' in keys)
+        self.assertEqual(len(self.scenes('2016-01-02')), 2)
+        self.assertEqual(len([k for k in keys if k.startswith('MCD43A4.006/1')]), 6)
@@ -0,0 +1,53 @@
+import os
+import unittest
+import multiprocessing
+from modispds.memory import MemoryBudget, MemoryFile, budget, to_memory, filename, release
+
+
+def reserve(b, nbytes):
+    return b.reserve(nbytes)
+
+
+class TestMemory(unittest.TestCase):
+    """ Test in-memory files and memory budget """
+
+    def test_budget(self):
+        """ Reserve and release memory """
+        b = MemoryBudget(100)
+        self.assertTrue(b.reserve(60))
+        self.assertFalse(b.reserve(60))
+        b.release(60)
+        self.assertTrue(b.reserve(60))
+
+    def test_budget_processes(self):
+        """ Budget is shared with forked processes """
+        b = MemoryBudget(100)
+        procs = [multiprocessing.Process(target=reserve, args=(b, 30)) for i in range(5)]
+        for p in procs:
+            p.start()
+        for p in procs:
+            p.join()
+        self.assertEqual(b.used.value, 90)
+
+    def test_to_memory(self):
+        """ Data is kept in memory until the budget is exhausted """
+        limit = budget.limit
+        budget.limit = budget.used.value + 10
+        f = to_memory('test1.txt', b'0123456789')
+        self.assertTrue(isinstance(f, MemoryFile))
+        self.assertEqual(filename(f), 'test1.txt')
+        fname = to_memory('test2.txt', b'0123456789', outdir=os.path.dirname(__file__))
+        self.assertTrue(os.path.exists(fname))
+        self.assertEqual(filename(fname), 'test2.txt')
+        os.remove(fname)
+        budget.release(len(f))
+        budget.limit = limit
+
+    def test_release(self):
+        """ MemoryFiles are released once, however many times release is called """
+        used = budget.used.value
+        files = [to_memory('test1.txt', b'0123456789'), 'test2.txt']
+        self.assertEqual(budget.used.value, used + 10)
+        release(files)
+        release(files)
+        self.assertEqual(budget.used.value, used)
@@ -0,0 +1,100 @@
+import os
+import json
+import unittest
+import requests
+from concurrent.futures import ProcessPoolExecutor
+from modispds.metrics import Metrics, metrics, metrics_config, collect, serve
+from modispds.pipeline import Pipeline, Stage
+
+
+def record(x):
+    metrics.record('child', labels={'x': 'odd' if x % 2 else 'even'}, seconds=0.5)
+    return x
+
+
+class TestMetrics(unittest.TestCase):
+    """ Test metrics registry and output formats """
+
+    def setUp(self):
+        metrics.reset()
+
+    def test_record(self):
+        """ Sum events by name and labels """
+        m = Metrics()
+        m.record('download', labels={'host': 'a'}, bytes=100, seconds=0.5)
+        m.record('download', labels={'host': 'a'}, bytes=50, seconds=0.25)
+        with m.timer('convert_band', labels={'band': 'B01'}) as values:
+            values['bytes'] = 10
+        m.gauge('queue_depth', 3, labels={'stage': 'upload'})
+        self.assertEqual(m.totals[('download', (('host', 'a'),))], {'count': 2, 'bytes': 150, 'seconds': 0.75})
+        text = m.prometheus()
+        self.assertTrue('# TYPE modispds_download_bytes_total counter' in text)
+        self.assertTrue('modispds_download_bytes_total{host="a"} 150' in text)
+        self.assertTrue('modispds_download_count{host="a"} 2' in text)
+        self.assertTrue('modispds_convert_band_count{band="B01"} 1' in text)
+        self.assertTrue('# TYPE modispds_queue_depth gauge' in text)
+        self.assertTrue('modispds_queue_depth{stage="upload"} 3' in text)
+
+    def test_peak(self):
+        """ Peaks keep their maximum, and are gauges """
+        m = Metrics()
+        for peak in [300, 500, 200]:
+            m.record('profile_memory', labels={'stage': 'convert'}, peak_bytes=peak, seconds=1)
+        self.assertEqual(m.totals[('profile_memory', (('stage', 'convert'),))],
+                         {'count': 3, 'peak_bytes': 500, 'seconds': 3})
+        text = m.prometheus()
+        self.assertTrue('# TYPE modispds_profile_memory_peak_bytes gauge' in text)
+        self.assertTrue('modispds_profile_memory_peak_bytes{stage="convert"} 500' in text)
+        self.assertFalse('peak_bytes_total' in text)
+
+    def test_files(self):
+        """ Write JSON lines and Prometheus file """
+        config = dict(metrics_config)
+        fname = os.path.join(os.path.dirname(__file__), 'metrics.jsonl')
+        metrics_config.update({'file': fname, 'prometheus_file': fname.replace('.jsonl', '.prom')})
+        try:
+            m = Metrics()
+            m.record('s3_call', labels={'operation': 'PutObject'}, seconds=0.1, retries=0)
+            m.record('s3_call', labels={'operation': 'PutObject'}, seconds=0.2, retries=1)
+            # buffered until flushed
+            with open(fname) as f:
+                self.assertEqual(f.read(), '')
+            m.flush_events()
+            with open(fname) as f:
+                lines = [json.loads(line) for line in f]
+            self.assertEqual(len(lines), 2)
+            self.assertEqual(lines[1]['operation'], 'PutObject')
+            self.assertEqual(lines[1]['retries'], 1)
+            with open(m.flush()) as f:
+                self.assertTrue('modispds_s3_call_retries_total{operation="PutObject"} 1' in f.read())
+            m.file.close()
+        finally:
+            metrics_config.update(config)
+            os.remove(fname)
+            os.remove(fname.replace('.jsonl', '.prom'))
+
+    def test_processes(self):
+        """ Collect events recorded in worker processes """
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            for x, events in executor.map(collect, [record] * 3, range(3)):
+                metrics.replay(events)
+        self.assertEqual(metrics.totals[('child', (('x', 'even'),))]['count'], 2)
+        self.assertEqual(metrics.totals[('child', (('x', 'odd'),))]['seconds'], 0.5)
+
+    def test_pipeline(self):
+        """ Record stage timings and events from process stages of a pipeline """
+        Pipeline([Stage('first', record, workers=2, processes=True), Stage('second', abs)]).run(range(4))
+        self.assertEqual(metrics.totals[('child', (('x', 'odd'),))]['count'], 2)
+        self.assertEqual(metrics.totals[('stage', (('stage', 'first'),))]['count'], 4)
+        self.assertTrue(('queue_depth', (('stage', 'second'),)) in metrics.gauges)
+
+    def test_serve(self):
+        """ Serve metrics over HTTP """
+        metrics.record('download', bytes=10)
+        server = serve(0, host='127.0.0.1')
+        try:
+            resp = requests.get('http://127.0.0.1:%s/metrics' % server.server_port)
+            self.assertTrue('modispds_download_bytes_total 10' in resp.text)
+        finally:
+            server.shutdown()
+            server.server_close()
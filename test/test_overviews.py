@@ -0,0 +1,87 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy
+from modispds.overviews import average_pyramid, block_average, in_memory, write_overviews
+from modispds.testing import requires_gdal
+
+
+class TestOverviews(unittest.TestCase):
+    """ Test in-memory overviews """
+
+    nodata = 32767
+
+    def setUp(self):
+        rand = numpy.random.RandomState(0)
+        self.arr = rand.randint(-1000, 10000, (96, 80)).astype('int16')
+        self.arr[:16, :] = self.nodata
+        self.arr[40:43, 10:13] = self.nodata
+
+    def naive_average(self, arr, factor, nodata):
+        out = numpy.zeros((-(-arr.shape[0] // factor), -(-arr.shape[1] // factor)), dtype=arr.dtype)
+        for y in range(out.shape[0]):
+            for x in range(out.shape[1]):
+                block = arr[y * factor:(y + 1) * factor, x * factor:(x + 1) * factor]
+                valid = block[block != nodata]
+                out[y, x] = numpy.sign(valid.mean()) * numpy.floor(abs(valid.mean()) + 0.5) if valid.size else nodata
+        return out
+
+    def test_block_average(self):
+        """ Block average matches naive average, ignoring nodata """
+        for factor in [2, 3, 8]:
+            avg = block_average(self.arr, factor, nodata=self.nodata)
+            self.assertEqual(avg.dtype, self.arr.dtype)
+            self.assertTrue(numpy.array_equal(avg, self.naive_average(self.arr, factor, self.nodata)))
+
+    def test_pyramid(self):
+        """ Pyramid has a level per overview """
+        pyramid = average_pyramid(self.arr.astype('float32'), levels=[2, 4, 8])
+        self.assertEqual([p.shape for p in pyramid], [(48, 40), (24, 20), (12, 10)])
+        self.assertAlmostEqual(pyramid[2].mean(), self.arr.astype('float32').mean(), places=2)
+
+    def test_in_memory(self):
+        """ Overviews are computed in memory for integer arrays whose sides are multiples of the levels """
+        self.assertTrue(in_memory(self.arr, levels=[2, 4, 8]))
+        self.assertTrue(in_memory(numpy.zeros((2400, 2400), dtype='uint8')))
+        self.assertFalse(in_memory(self.arr[:, :77]))
+        self.assertFalse(in_memory(self.arr[:95, :]))
+        self.assertFalse(in_memory(self.arr.astype('float32')))
+
+    @requires_gdal
+    def test_gdaladdo(self):
+        """ Overviews are the same as those of gdaladdo average resampling """
+        from osgeo import gdal
+        rand = numpy.random.RandomState(1)
+        # sides not multiples of the levels, so built by GDAL
+        odd = rand.randint(0, 10000, (99, 77)).astype('int16')
+        odd[rand.rand(99, 77) < 0.2] = self.nodata
+        for arr in [self.arr, odd]:
+            tmpdir = tempfile.mkdtemp()
+            fnames = []
+            for name in ['gdaladdo', 'modispds']:
+                fname = os.path.join(tmpdir, name + '.tif')
+                ds = gdal.GetDriverByName('GTiff').Create(fname, arr.shape[1], arr.shape[0], 1, gdal.GDT_Int16,
+                                                          ['COMPRESS=DEFLATE'])
+                ds.GetRasterBand(1).SetNoDataValue(self.nodata)
+                ds.GetRasterBand(1).WriteArray(arr)
+                ds = None
+                fnames.append(fname)
+            gdal.SetConfigOption('COMPRESS_OVERVIEW', 'DEFLATE')
+            ds = gdal.Open(fnames[0])
+            ds.BuildOverviews('AVERAGE', [2, 4, 8])
+            ds = None
+            gdal.SetConfigOption('COMPRESS_OVERVIEW', None)
+            ovr = write_overviews(fnames[1], arr, nodata=self.nodata)
+            self.assertTrue(os.path.exists(ovr))
+
+            bands = [gdal.Open(f).GetRasterBand(1) for f in fnames]
+            self.assertEqual(bands[1].GetOverviewCount(), 3)
+            for i in range(3):
+                truth = bands[0].GetOverview(i).ReadAsArray()
+                data = bands[1].GetOverview(i).ReadAsArray()
+                self.assertTrue(numpy.array_equal(truth, data))
+            meta = gdal.Info(ovr, format='json')['metadata']['IMAGE_STRUCTURE']
+            self.assertEqual(meta['COMPRESSION'], 'DEFLATE')
+            bands = None
+            shutil.rmtree(tmpdir)
@@ -1,6 +1,9 @@
 import os
 import unittest
-from modispds.pds import push_to_s3, exists, s3_list, del_from_s3, make_index, make_scene_list
+from modispds.pds import push_to_s3, exists, s3_list, del_from_s3, make_index, make_scene_list, get_client, configure_s3
+from modispds.pds import delete_keys, delete_prefix
+from modispds.testing import LocalS3, requires_moto
+from modispds.metrics import metrics
 
 
 class TestPDS(unittest.TestCase):
@@ -45,3 +48,73 @@ class TestPDS(unittest.TestCase):
         url = push_to_s3(__file__, 'modis-pds', 'testing')
         self.assertTrue(exists(url))
         del_from_s3(url)
+
+
+@requires_moto
+class TestS3Client(unittest.TestCase):
+    """ Test shared S3 client and transfers against a local S3 """
+
+    @classmethod
+    def setUpClass(self):
+        self.s3 = LocalS3(bucket='testing-bucket').start()
+
+    @classmethod
+    def tearDownClass(self):
+        self.s3.stop()
+
+    def test_shared_client(self):
+        """ Same client is returned until settings change """
+        client = get_client()
+        self.assertTrue(get_client() is client)
+        configure_s3(max_pool_connections=20)
+        self.assertFalse(get_client() is client)
+        self.assertEqual(get_client().meta.config.max_pool_connections, 20)
+
+    def test_push_data(self):
+        """ Upload data from memory """
+        url = push_to_s3('index.html', 'testing-bucket', 'testing', data=b'<html></html>')
+        obj = get_client().get_object(Bucket='testing-bucket', Key='testing/index.html')
+        self.assertEqual(obj['Body'].read(), b'<html></html>')
+        self.assertEqual(obj['ContentType'], 'text/html')
+        del_from_s3(url)
+
+    def test_delete_prefix(self):
+        """ Delete everything under a prefix in batches of 1000 keys """
+        s3 = get_client()
+        for i in range(1500):
+            s3.put_object(Bucket='testing-bucket', Key='testing/purge/%04d.txt' % i, Body=b'12')
+        self.assertEqual(delete_prefix('s3://testing-bucket/testing/purge/', dry_run=True), (1500, 3000))
+        self.assertEqual(len(s3_list('s3://testing-bucket/testing/purge/')), 1500)
+        metrics.reset()
+        self.assertEqual(delete_prefix('s3://testing-bucket/testing/purge/', workers=2), (1500, 3000))
+        self.assertEqual(metrics.totals[('s3_delete', ())]['count'], 2)
+        self.assertEqual(metrics.totals[('s3_delete', ())]['keys'], 1500)
+        self.assertEqual(len(s3_list('s3://testing-bucket/testing/purge/')), 0)
+        self.assertEqual(delete_keys('testing-bucket', []), 0)
+
+    def test_configure_unknown(self):
+        """ Unknown settings are rejected """
+        with self.assertRaises(ValueError):
+            configure_s3(pool_size=10)
+
+    def test_multipart_upload(self):
+        """ Large files are uploaded in parts with public-read ACL and content type """
+        configure_s3(multipart_threshold=5 * 1024 * 1024, multipart_chunksize=5 * 1024 * 1024)
+        fname = os.path.join(os.path.dirname(__file__), 'multipart.json')
+        with open(fname, 'wb') as f:
+            f.write(os.urandom(11 * 1024 * 1024))
+        metrics.reset()
+        url = push_to_s3(fname, 'testing-bucket', 'testing')
+        os.remove(fname)
+        self.assertEqual(metrics.totals[('s3_upload', ())]['bytes'], 11 * 1024 * 1024)
+        self.assertEqual(metrics.totals[('s3_call', (('operation', 'UploadPart'),))]['count'], 3)
+        obj = get_client().head_object(Bucket='testing-bucket', Key='testing/multipart.json')
+        self.assertEqual(obj['ContentLength'], 11 * 1024 * 1024)
+        self.assertEqual(obj['ContentType'], 'application/json')
+        # multipart uploads have an ETag suffixed with the number of parts
+        self.assertTrue(obj['ETag'].strip('"').endswith('-3'))
+        acl = get_client().get_object_acl(Bucket='testing-bucket', Key='testing/multipart.json')
+        self.assertTrue(any(g['Permission'] == 'READ' for g in acl['Grants']))
+        self.assertTrue(exists(url))
+        del_from_s3(url)
+        self.assertFalse(exists(url))
@@ -0,0 +1,81 @@
+import time
+import random
+import threading
+import unittest
+from modispds.pipeline import Pipeline, Stage
+
+
+def square(x):
+    return x * x
+
+
+def fail_on_three(x):
+    if x == 3:
+        raise RuntimeError('bad item')
+    return x
+
+
+def jitter(x):
+    time.sleep(random.random() * 0.01)
+    return x
+
+
+class TestPipeline(unittest.TestCase):
+    """ Test concurrent pipeline stages """
+
+    def test_run(self):
+        """ Run items through thread and process stages, preserving order """
+        pipeline = Pipeline([
+            Stage('first', jitter, workers=4),
+            Stage('second', square, workers=2, processes=True),
+            Stage('third', jitter, workers=3),
+        ])
+        tasks = pipeline.run(range(20))
+        self.assertEqual([t.value for t in tasks], [i * i for i in range(20)])
+        self.assertTrue(all(t.error is None for t in tasks))
+
+    def test_errors(self):
+        """ Failed items are reported and skip later stages """
+        pipeline = Pipeline([Stage('check', fail_on_three, workers=2), Stage('square', square)])
+        tasks = pipeline.run(range(5))
+        self.assertEqual(len(tasks), 5)
+        self.assertEqual(tasks[3].stage, 'check')
+        self.assertTrue(isinstance(tasks[3].error, RuntimeError))
+        self.assertEqual(tasks[4].value, 16)
+
+    def test_callback(self):
+        """ Callback is called once per completed task """
+        done = []
+        pipeline = Pipeline([Stage('jitter', jitter, workers=3)])
+        pipeline.run(range(10), callback=lambda t: done.append(t.index))
+        self.assertEqual(sorted(done), list(range(10)))
+
+    def test_cleanup(self):
+        """ Cleanup is called for every task, including failed ones """
+        cleaned = []
+        pipeline = Pipeline([Stage('check', fail_on_three, workers=2)], cleanup=lambda t: cleaned.append(t.item))
+        pipeline.run(range(5))
+        self.assertEqual(sorted(cleaned), list(range(5)))
+
+    def test_bounded(self):
+        """ Input is only consumed as fast as the stages allow """
+        lock = threading.Lock()
+        state = {'fed': 0, 'max_ahead': 0, 'processed': 0}
+
+        def items():
+            for i in range(30):
+                with lock:
+                    state['fed'] += 1
+                    state['max_ahead'] = max(state['max_ahead'], state['fed'] - state['processed'])
+                yield i
+
+        def slow(x):
+            time.sleep(0.005)
+            with lock:
+                state['processed'] += 1
+            return x
+
+        pipeline = Pipeline([Stage('slow', slow, workers=1)], maxsize=2)
+        pipeline.run(items())
+        # queue of 2, one item in the worker, one blocked in put
+        self.assertTrue(state['max_ahead'] <= 4)
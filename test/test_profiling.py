@@ -0,0 +1,72 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+import modispds.profiling as profiling
+from modispds.profiling import profiled, profile_stage, summarize, profile_config, PEAKS
+
+gid = 'MCD43A4.A2016001.h11v12.006.2016174075640'
+
+
+class TestProfiling(unittest.TestCase):
+    """ Test profiling of granule stages """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.config = dict(profile_config)
+        profile_config.update({'dir': self.tmpdir, 'memory': True, 'top': 5})
+
+    def tearDown(self):
+        profile_config.update(self.config)
+        shutil.rmtree(self.tmpdir)
+
+    def peaks(self):
+        with open(os.path.join(self.tmpdir, PEAKS)) as f:
+            return [json.loads(line) for line in f]
+
+    def test_profiled(self):
+        """ Write a pstats file and peak memory of a stage """
+        with profiled('convert', gid):
+            data = bytearray(4 * 1024 * 1024)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, '%s.convert.pstats' % gid)))
+        peaks = self.peaks()
+        self.assertEqual(len(peaks), 1)
+        self.assertEqual((peaks[0]['gid'], peaks[0]['stage']), (gid, 'convert'))
+        self.assertGreaterEqual(peaks[0]['peak_bytes'], len(data))
+
+    def test_profile_stage(self):
+        """ Profile a stage function, only when profiling is enabled """
+        @profile_stage('download', lambda gran: gran['gid'])
+        def download(gran):
+            return gran['gid']
+        self.assertEqual(download({'gid': gid}), gid)
+        self.assertEqual(download.__name__, 'download')
+        profile_config['dir'] = ''
+        self.assertEqual(download({'gid': 'other'}), 'other')
+        self.assertEqual(sorted(os.listdir(self.tmpdir)), sorted(['%s.download.pstats' % gid, PEAKS]))
+        self.assertEqual(len(self.peaks()), 1)
+
+    def test_summary_stream(self):
+        """ The summary is written to a stream taking native str, as pstats writes """
+        out = profiling.StringIO()
+        out.write(str('native'))
+        out.write(u' text')
+        self.assertEqual(out.getvalue(), 'native text')
+
+    def test_summarize(self):
+        """ Summarize the profiles of a run """
+        self.assertEqual(summarize(), None)
+        for stage in ['download', 'convert']:
+            with profiled(stage, gid):
+                sorted(range(1000))
+        fname = summarize()
+        with open(fname) as f:
+            summary = f.read()
+        self.assertIn('Profiles of 2 granule stages', summary)
+        self.assertIn('Top 5 functions by cumulative time', summary)
+        self.assertIn('convert', summary)
+        # the functions listed by pstats
+        self.assertIn('sorted', summary)
+        self.assertIn('ncalls', summary)
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, 'all.pstats')))
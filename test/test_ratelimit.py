@@ -0,0 +1,82 @@
+import time
+import threading
+import unittest
+from modispds.ratelimit import TokenBucket, Limiter, outcome, backoff, OK, THROTTLED, ERROR
+
+
+class TestRateLimit(unittest.TestCase):
+    """ Test token buckets, adaptive concurrency and circuit breaking """
+
+    def test_token_bucket(self):
+        """ Space requests out to the rate after a burst """
+        bucket = TokenBucket(rate=100, burst=5)
+        start = time.time()
+        for i in range(15):
+            bucket.take()
+        self.assertGreaterEqual(time.time() - start, 0.09)
+        self.assertEqual(TokenBucket().take(), 0)
+
+    def test_aimd(self):
+        """ Halve the limit when throttled, then regain it a request at a time """
+        lim = Limiter('test', concurrency=8, failures=100)
+        lim.acquire()
+        lim.release(THROTTLED)
+        self.assertEqual(lim.limit, 4)
+        # at most one decrease a second
+        lim.acquire()
+        lim.release(THROTTLED)
+        self.assertEqual(lim.limit, 4)
+        for i in range(4):
+            lim.acquire()
+            lim.release(OK)
+        self.assertGreater(lim.limit, 4.9)
+        for i in range(100):
+            lim.acquire()
+            lim.release(OK)
+        self.assertEqual(lim.limit, 8)
+
+    def test_concurrency(self):
+        """ Wait for a slot when the limit of requests are in flight """
+        lim = Limiter('test', concurrency=1)
+        lim.acquire()
+        threading.Timer(0.1, lim.release).start()
+        self.assertGreaterEqual(lim.acquire(), 0.05)
+        lim.release()
+        self.assertEqual(lim.in_flight, 0)
+
+    def test_breaker(self):
+        """ Pause requests after consecutive failures, until one succeeds """
+        lim = Limiter('test', concurrency=4, failures=3, cooldown=0.2)
+        for i in range(3):
+            with self.assertRaises(IOError):
+                with lim.request():
+                    raise IOError('Connection refused')
+        self.assertEqual(lim.state, 'open')
+        # requests wait out the cooldown, then one at a time is let through
+        self.assertGreaterEqual(lim.acquire(), 0.1)
+        self.assertEqual(lim.state, 'half-open')
+        # a failure while half-open opens it again for longer
+        lim.release(ERROR)
+        self.assertEqual(lim.state, 'open')
+        self.assertGreater(lim.open_until - time.time(), 0.3)
+        self.assertGreaterEqual(lim.acquire(), 0.3)
+        lim.release(OK)
+        self.assertEqual(lim.state, 'closed')
+
+    def test_outcome(self):
+        """ Classify responses """
+        self.assertEqual(outcome(200), OK)
+        self.assertEqual(outcome(404), OK)
+        self.assertEqual(outcome(429), THROTTLED)
+        self.assertEqual(outcome(503, 'SlowDown'), THROTTLED)
+        self.assertEqual(outcome(400, 'SlowDown'), THROTTLED)
+        self.assertEqual(outcome(500), ERROR)
+        self.assertEqual(outcome(), ERROR)
+
+    def test_backoff(self):
+        """ Jittered exponential backoff, or Retry-After """
+        delays = [backoff(3) for i in range(20)]
+        self.assertTrue(all(0 <= d <= 8 for d in delays))
+        self.assertGreater(len(set(delays)), 1)
+        self.assertEqual(backoff(3, retry_after='2'), 2)
+        self.assertEqual(backoff(3, retry_after='1000'), 60)
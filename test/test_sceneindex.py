@@ -0,0 +1,132 @@
+import datetime
+import unittest
+from modispds.pds import get_client
+import modispds.sceneindex as sceneindex
+from modispds.sceneindex import SceneIndex, _periods, read_rows, write_rows
+from modispds.testing import LocalS3, requires_moto
+
+
+def metadata(day, tiles):
+    gids = ['MCD43A4.A%s.%s.006.2016174075640' % (day.strftime('%Y%j'), t) for t in tiles]
+    return [{'gid': gid, 'date': datetime.datetime(day.year, day.month, day.day),
+             'download_url': 'https://testing-bucket.s3.amazonaws.com/%s/index.html' % gid} for gid in gids]
+
+
+@requires_moto
+class TestSceneIndex(unittest.TestCase):
+    """ Test incremental, partitioned scene index """
+
+    product = 'MCD43A4.006'
+    day1 = datetime.date(2016, 1, 31)
+    day2 = datetime.date(2016, 2, 1)
+
+    @classmethod
+    def setUpClass(self):
+        self.s3 = LocalS3(bucket='testing-bucket').start()
+
+    @classmethod
+    def tearDownClass(self):
+        self.s3.stop()
+
+    def setUp(self):
+        self.index = SceneIndex('testing-bucket', self.product)
+
+    def tearDown(self):
+        for key in self.keys():
+            get_client().delete_object(Bucket='testing-bucket', Key=key)
+
+    def keys(self):
+        resp = get_client().list_objects_v2(Bucket='testing-bucket', Prefix=self.product + '/index/')
+        return sorted(obj['Key'] for obj in resp.get('Contents', []))
+
+    def test_update(self):
+        """ Merge days into monthly and per-tile partitions """
+        self.index.update(self.day2, metadata(self.day2, ['h12v07', 'h11v12']))
+        self.index.update(self.day1, metadata(self.day1, ['h11v12']))
+        self.assertEqual(self.keys(), ['MCD43A4.006/index/2016-01.csv.gz', 'MCD43A4.006/index/2016-02.csv.gz',
+                                       'MCD43A4.006/index/tiles/h11v12/2016.csv.gz',
+                                       'MCD43A4.006/index/tiles/h12v07/2016.csv.gz'])
+        rows, etag = self.index.read('MCD43A4.006/index/tiles/h11v12/2016.csv.gz')
+        self.assertEqual([r['date'] for r in rows], ['2016-01-31', '2016-02-01'])
+        rows = self.index.read('MCD43A4.006/index/2016-02.csv.gz')[0]
+        # sorted by date, then tile
+        self.assertEqual([r['tile'] for r in rows], ['h11v12', 'h12v07'])
+        self.assertEqual(list(rows[0].keys()), ['date', 'tile', 'gid', 'download_url'])
+
+    def test_unsupported(self):
+        """ The index is written unconditionally without conditional writes """
+        supported = sceneindex.conditional_writes
+        sceneindex.conditional_writes = lambda: False
+        try:
+            self.index.update(self.day1, metadata(self.day1, ['h11v12']))
+            keys = self.index.update(self.day1, metadata(self.day1, ['h11v12', 'h12v07']))
+        finally:
+            sceneindex.conditional_writes = supported
+        self.assertEqual(keys, self.keys())
+        rows = self.index.read(self.index.period_key(self.day1))[0]
+        self.assertEqual([r['tile'] for r in rows], ['h11v12', 'h12v07'])
+
+    def test_public(self):
+        """ Partitions are public, like every other object in the bucket """
+        self.index.update(self.day1, metadata(self.day1, ['h11v12']))
+        grants = get_client().get_object_acl(Bucket='testing-bucket', Key=self.index.period_key(self.day1))['Grants']
+        self.assertTrue(any(g['Grantee'].get('URI', '').endswith('/global/AllUsers') and g['Permission'] == 'READ'
+                            for g in grants))
+
+    def test_replace_day(self):
+        """ Updating a day again replaces its scenes """
+        self.index.update(self.day1, metadata(self.day1, ['h11v12', 'h12v07']))
+        self.index.update(self.day1, metadata(self.day1, ['h12v07']))
+        rows = self.index.read(self.index.period_key(self.day1))[0]
+        self.assertEqual([r['tile'] for r in rows], ['h12v07'])
+
+    def test_conflict(self):
+        """ Merge again when another writer changed a partition """
+        key = self.index.period_key(self.day1)
+        self.index.update(self.day1, metadata(self.day1, ['h11v12']))
+        read = self.index.read
+        calls = []
+
+        def stale_read(k):
+            result = read(k)
+            if len(calls) == 0:
+                calls.append(k)
+                # another writer adds a day after this one read the partition
+                self.index.merge(key, '2016-01-30', [{'date': '2016-01-30', 'tile': 'h12v07', 'gid': 'x'}])
+            return result
+
+        self.index.read = stale_read
+        self.index.merge(key, str(self.day1), [{'date': str(self.day1), 'tile': 'h12v07', 'gid': 'y'}])
+        self.index.read = read
+        rows = self.index.read(key)[0]
+        self.assertEqual([r['gid'] for r in rows], ['x', 'y'])
+
+    def test_lookup(self):
+        """ Look up scenes in a range of dates, of all tiles or one tile """
+        for day in [self.day1, self.day2, datetime.date(2016, 3, 1)]:
+            self.index.update(day, metadata(day, ['h11v12', 'h12v07']))
+        scenes = self.index.lookup('2016-01-31', '2016-02-15')
+        self.assertEqual(len(scenes), 4)
+        scenes = self.index.lookup('2016-02-01', '2016-12-31', tile='h12v07')
+        self.assertEqual([s['date'] for s in scenes], ['2016-02-01', '2016-03-01'])
+        self.assertEqual(self.index.lookup('2015-01-01', '2015-12-31'), [])
+
+    def test_periods(self):
+        """ Partitions covering a range of dates """
+        self.assertEqual(_periods('2015-11-15', '2016-02-01', 'month'),
+                         ['2015-11-01', '2015-12-01', '2016-01-01', '2016-02-01'])
+        self.assertEqual(_periods('2015-11-15', '2016-02-01', 'year'), ['2015-01-01', '2016-01-01'])
+        yearly = SceneIndex('testing-bucket', self.product, period='year')
+        self.assertEqual(yearly.period_key(self.day1), 'MCD43A4.006/index/2016.csv.gz')
+
+
+class TestRows(unittest.TestCase):
+    """ Test reading and writing index partitions """
+
+    def test_rows(self):
+        """ Write rows to gzipped CSV and read them back """
+        rows = [{'date': '2016-01-31', 'tile': 'h11v12', 'gid': 'gid1', 'download_url': 'url1'},
+                {'date': '2016-01-31', 'tile': 'h12v07', 'gid': 'gid2'}]
+        data = write_rows(rows)
+        self.assertEqual(write_rows(rows), data)
+        self.assertEqual(read_rows(data), [rows[0], dict(rows[1], download_url='')])
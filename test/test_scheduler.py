@@ -0,0 +1,96 @@
+import datetime
+import unittest
+from modispds.pipeline import Pipeline, Stage
+from modispds.scheduler import Scheduler, Progress, order_jobs
+
+
+def square(x):
+    if x < 0:
+        raise ValueError('negative')
+    return x * x
+
+
+class TestScheduler(unittest.TestCase):
+    """ Test scheduling of many products and days through a pipeline """
+
+    day1 = datetime.date(2016, 1, 1)
+    day2 = datetime.date(2016, 1, 2)
+
+    def test_order_jobs(self):
+        """ Order jobs by date or product """
+        days = {'A': [self.day1, self.day2], 'B': [self.day1]}
+        jobs = order_jobs(['A', 'B'], days)
+        self.assertEqual(jobs, [('A', self.day2), ('A', self.day1), ('B', self.day1)])
+        jobs = order_jobs(['B', 'A'], days, order='oldest')
+        self.assertEqual(jobs, [('B', self.day1), ('A', self.day1), ('A', self.day2)])
+        jobs = order_jobs(['B', 'A'], days, order='product')
+        self.assertEqual(jobs, [('B', self.day1), ('A', self.day1), ('A', self.day2)])
+        with self.assertRaises(ValueError):
+            order_jobs(['A'], days, order='random')
+
+    def test_progress(self):
+        """ Estimate total granules and time remaining """
+        progress = Progress(4)
+        self.assertEqual(progress.eta(), None)
+        progress.add_day(10)
+        progress.add_day(20)
+        self.assertEqual(progress.total(), 60)
+        progress.add_done()
+        progress.add_done(failed=True)
+        self.assertTrue(progress.eta() > 0)
+        self.assertTrue('2/60 granules (1 failed)' in progress.report())
+
+    def test_run(self):
+        """ Run jobs of several products through one pipeline """
+        granules = {
+            ('A', self.day1): [1, 2, 3],
+            ('A', self.day2): [],
+            ('B', self.day1): [4, -5],
+        }
+        queries = []
+        finalized = {}
+
+        def query(product, days):
+            queries.append((product, days))
+            for day in days:
+                yield day, granules[(product, day)]
+
+        def finalize(product, day, tasks):
+            # other threads are not held up while a day is published
+            locked.append(scheduler.lock.locked())
+            finalized[(product, day)] = [t.value if t.error is None else None for t in tasks]
+
+        pipeline = Pipeline([Stage('square', square, workers=2)])
+        jobs = order_jobs(['A', 'B'], {'A': [self.day1, self.day2], 'B': [self.day1]})
+        scheduler = Scheduler(pipeline, query, finalize)
+        locked = []
+        progress = scheduler.run(jobs)
+        self.assertEqual(locked, [False] * 3)
+        # one query per product
+        self.assertEqual(queries, [('A', [self.day2, self.day1]), ('B', [self.day1])])
+        self.assertEqual(finalized, {
+            ('A', self.day1): [1, 4, 9],
+            ('A', self.day2): [],
+            ('B', self.day1): [16, None],
+        })
+        self.assertEqual(progress.days_done, 3)
+        self.assertEqual(progress.done, 5)
+        self.assertEqual(progress.failed, 1)
+
+    def test_skipped_days(self):
+        """ Days a query leaves out are not queried again """
+        queries = []
+        finalized = []
+
+        def query(product, days):
+            queries.append((product, days))
+            return iter([])
+
+        days = [self.day1 + datetime.timedelta(n) for n in range(5)]
+        jobs = order_jobs(['A'], {'A': days}, order='oldest')
+        pipeline = Pipeline([Stage('square', square)])
+        progress = Scheduler(pipeline, query, lambda p, d, tasks: finalized.append(d), days=2).run(jobs)
+        # one query per chunk of days
+        self.assertEqual(queries, [('A', days[0:2]), ('A', days[2:4]), ('A', days[4:])])
+        self.assertEqual(finalized, days)
+        self.assertEqual(progress.days_done, 5)
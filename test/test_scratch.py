@@ -0,0 +1,91 @@
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from modispds.scratch import DiskBudget, Scratch, scratch_config, estimate
+
+
+class TestScratch(unittest.TestCase):
+    """ Test granule working directories and disk budget """
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_budget(self):
+        """ Reserving waits until enough space is released """
+        b = DiskBudget(100)
+        b.reserve(60)
+        waited = []
+        t = threading.Thread(target=lambda: waited.append(b.reserve(60)))
+        t.start()
+        time.sleep(0.2)
+        self.assertEqual(b.used.value, 60)
+        b.release(60)
+        t.join()
+        self.assertTrue(waited[0] >= 0.2)
+        self.assertEqual(b.used.value, 60)
+
+    def test_budget_oversized(self):
+        """ A reservation larger than the limit goes ahead when nothing else is reserved """
+        b = DiskBudget(100)
+        b.reserve(500)
+        self.assertEqual(b.used.value, 500)
+
+    def test_workdir(self):
+        """ Working directory is removed when done, and kept with its space released if processing fails """
+        s = Scratch(1000)
+        gid = 'MCD43A4.A2016001.h11v12.006.2016174075640'
+        with self.assertRaises(RuntimeError):
+            with s.workdir(gid, nbytes=400, root=self.root) as path:
+                self.assertEqual(path, os.path.join(self.root, gid))
+                self.assertEqual(s.budget.used.value, 400)
+                with open(os.path.join(path, 'test.hdf.part'), 'w') as f:
+                    f.write('test')
+                raise RuntimeError('bad granule')
+        self.assertTrue(os.path.exists(os.path.join(path, 'test.hdf.part')))
+        self.assertEqual(s.budget.used.value, 0)
+        self.assertFalse(s.remove(gid))
+        # the next attempt gets the same directory, with the files left in it
+        with s.workdir(gid, nbytes=400, root=self.root) as path2:
+            self.assertEqual(path2, path)
+            self.assertTrue(os.path.exists(os.path.join(path, 'test.hdf.part')))
+        self.assertFalse(os.path.exists(path))
+        self.assertEqual(s.budget.used.value, 0)
+
+    def test_purge(self):
+        """ Working directories left by failed granules are purged, except those in use """
+        s = Scratch()
+        gids = ['MCD43A4.A2016001.h11v12.006.2016174075640', 'MCD43A4.A2016001.h12v07.006.2016174075640']
+        for gid in gids:
+            s.create(gid, root=self.root)
+        s.release(gids[0])
+        os.makedirs(os.path.join(self.root, 'other'))
+        self.assertEqual(s.purge(root=self.root, dry_run=True), [os.path.join(self.root, gids[0])])
+        self.assertTrue(os.path.exists(os.path.join(self.root, gids[0])))
+        self.assertEqual(s.purge(root=self.root), [os.path.join(self.root, gids[0])])
+        self.assertEqual(sorted(os.listdir(self.root)), [gids[1], 'other'])
+        self.assertTrue(s.remove(gids[1]))
+
+    def test_scratch_dir(self):
+        """ Working directories are made in the configured scratch directory """
+        s = Scratch()
+        scratch_config['dir'] = os.path.join(self.root, 'scratch')
+        try:
+            path = s.create('granule1', root='other')
+        finally:
+            scratch_config['dir'] = ''
+        self.assertEqual(os.path.dirname(path), os.path.join(self.root, 'scratch'))
+        # a second directory for the same granule replaces the first
+        s.create('granule1', root=self.root)
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(s.remove('granule1'))
+
+    def test_estimate(self):
+        """ Estimate disk space of a granule from its CMR size """
+        self.assertEqual(estimate({'granule_size': '1.0'}), 1024 * 1024 * scratch_config['factor'])
+        self.assertEqual(estimate({}), 0)
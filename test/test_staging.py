@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import unittest
+from modispds.pds import get_client
+from modispds.memory import MemoryFile, budget
+from modispds.staging import Staging, Uploader
+from modispds.testing import LocalS3, requires_moto
+
+gid1 = 'MCD43A4.A2016001.h11v12.006.2016174075640'
+gid2 = 'MCD43A4.A2016001.h12v07.006.2016174075640'
+
+
+@requires_moto
+class TestStaging(unittest.TestCase):
+    """ Test staging area and uploader """
+
+    @classmethod
+    def setUpClass(self):
+        self.s3 = LocalS3(bucket='testing-bucket').start()
+
+    @classmethod
+    def tearDownClass(self):
+        self.s3.stop()
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.staging = Staging(os.path.join(self.tmpdir, 'staging'))
+        self.published = []
+
+    def tearDown(self):
+        for key in self.keys():
+            get_client().delete_object(Bucket='testing-bucket', Key=key)
+        shutil.rmtree(self.tmpdir)
+
+    def keys(self):
+        resp = get_client().list_objects_v2(Bucket='testing-bucket', Prefix='testing/')
+        return sorted(obj['Key'] for obj in resp.get('Contents', []))
+
+    def make_files(self, gid, names):
+        fnames = []
+        for name in names:
+            fname = os.path.join(self.tmpdir, name)
+            with open(fname, 'w') as f:
+                f.write(gid)
+            fnames.append(fname)
+        return fnames
+
+    def stage(self, gid, names):
+        return self.staging.stage('testing-bucket', 'testing/' + gid, gid, self.make_files(gid, names))
+
+    def publish(self, product, date, metadata):
+        self.published.append((product, date, [md['gid'] for md in metadata]))
+
+    def test_stage(self):
+        """ Stage files and MemoryFiles of a granule """
+        budget.reserve(4)
+        urls = self.staging.stage('testing-bucket', 'testing/' + gid1, gid1,
+                                  self.make_files(gid1, ['B01.TIF']) + [MemoryFile('index.html', b'test')])
+        self.assertEqual(urls, ['s3://testing-bucket/testing/%s/B01.TIF' % gid1,
+                                's3://testing-bucket/testing/%s/index.html' % gid1])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.staging.root, gid1))), ['B01.TIF', 'index.html'])
+        self.assertFalse(os.path.exists(os.path.join(self.tmpdir, 'B01.TIF')))
+        self.assertEqual(self.staging.counts(), {'staged': 2, 'days': 0})
+
+    def test_sync(self):
+        """ Upload staged objects, then publish the day once all its granules are uploaded """
+        self.stage(gid1, ['B01.TIF', 'index.html'])
+        self.stage(gid2, ['B01.TIF'])
+        self.staging.add_day('MCD43A4.006', '2016-01-09', [{'gid': gid1}, {'gid': gid2}])
+        self.assertEqual(self.staging.ready_days(), [])
+        promoted = []
+        uploader = Uploader(self.staging, self.publish, workers=2, promoted=promoted.append)
+        self.assertEqual(self.staging.waiting(gid1), 2)
+        self.assertEqual(uploader.sync(), 3)
+        # each granule is promoted once all of its objects are uploaded
+        self.assertEqual(sorted(set(promoted)), [gid1, gid2])
+        self.assertEqual(self.staging.waiting(gid1), 0)
+        self.assertEqual(self.staging.waiting('MCD43A4.A2016001.h13v07.006.2016174075640'), None)
+        self.assertEqual(self.keys(), ['testing/%s/B01.TIF' % gid1, 'testing/%s/index.html' % gid1,
+                                       'testing/%s/B01.TIF' % gid2])
+        # staged files are removed once uploaded
+        self.assertEqual(os.listdir(self.staging.root), ['manifest.sqlite'])
+        self.assertEqual(self.published, [('MCD43A4.006', '2016-01-09', [gid1, gid2])])
+        # nothing is uploaded or published twice
+        self.assertEqual(uploader.sync(), 0)
+        self.assertEqual(len(self.published), 1)
+        self.assertEqual(self.staging.counts(), {'uploaded': 3, 'days': 0})
+
+    def test_replay(self):
+        """ Objects claimed by an uploader that stopped are uploaded by the next one """
+        self.stage(gid1, ['B01.TIF', 'B02.TIF'])
+        obj = self.staging.claim(visibility=-1)
+        self.assertEqual(obj['key'], 'testing/%s/B01.TIF' % gid1)
+        uploader = Uploader(self.staging, self.publish, workers=1)
+        self.assertEqual(uploader.sync(), 2)
+        # the lost claim can no longer be marked done
+        self.assertFalse(self.staging.done(obj))
+
+    def test_failed(self):
+        """ Objects that fail to upload are left for a later sync """
+        fname = self.stage(gid1, ['B01.TIF'])[0]
+        os.remove(os.path.join(self.staging.root, gid1, 'B01.TIF'))
+        self.staging.add_day('MCD43A4.006', '2016-01-09', [{'gid': gid1}])
+        uploader = Uploader(self.staging, self.publish, workers=1, attempts=1)
+        self.assertEqual(uploader.sync(), 0)
+        self.assertEqual(self.staging.counts(), {'failed': 1, 'days': 1})
+        self.assertEqual(self.published, [])
+        self.make_files(gid1, ['B01.TIF'])
+        shutil.move(os.path.join(self.tmpdir, 'B01.TIF'), os.path.join(self.staging.root, gid1, 'B01.TIF'))
+        self.assertEqual(self.staging.reset(), 1)
+        self.assertEqual(uploader.sync(), 1)
+        self.assertEqual(self.keys(), [fname.replace('s3://testing-bucket/', '')])
+        self.assertEqual(len(self.published), 1)
+
+    def test_background(self):
+        """ Upload in the background until stopped """
+        uploader = Uploader(self.staging, self.publish, workers=2, interval=0.05).start()
+        self.stage(gid1, ['B01.TIF'])
+        self.staging.add_day('MCD43A4.006', '2016-01-09', [{'gid': gid1}])
+        counts = uploader.stop()
+        self.assertEqual(counts, {'uploaded': 1, 'days': 0})
+        self.assertEqual(len(self.published), 1)
@@ -0,0 +1,117 @@
+import os
+import time
+import datetime
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from modispds.workqueue import WorkQueue, SQLiteQueue, Heartbeat, open_queue
+
+
+def make_tasks(product='MCD43A4.006', date=datetime.date(2016, 1, 1), n=3):
+    name, version = product.split('.')
+    gids = ['%s.A%s.h%02dv00.%s.2016174075640' % (name, date.strftime('%Y%j'), i, version) for i in range(n)]
+    return [{'product': product, 'date': date, 'gid': gid, 'granule': {'id': gid}} for gid in gids]
+
+
+class TestWorkQueue(unittest.TestCase):
+    """ Test SQLite work queue """
+
+    def setUp(self):
+        self.fname = os.path.join(os.path.dirname(__file__), 'queue.sqlite')
+        self.queue = SQLiteQueue(self.fname, max_attempts=2)
+
+    def tearDown(self):
+        os.remove(self.fname)
+
+    def test_put(self):
+        """ Add tasks once """
+        self.assertEqual(self.queue.put(make_tasks()), 3)
+        self.assertEqual(self.queue.put(make_tasks()), 0)
+        self.assertEqual(self.queue.counts(), {'ready': 3})
+        self.assertEqual(self.queue.put(make_tasks(), overwrite=True), 3)
+        self.assertEqual(self.queue.counts(), {'ready': 3})
+
+    def test_finalize(self):
+        """ Last task of a day to finish finalizes it """
+        tasks = make_tasks()
+        tasks[0]['result'] = {'gid': tasks[0]['gid']}
+        self.queue.put(tasks)
+        self.queue.put(make_tasks(date=datetime.date(2016, 1, 2), n=1))
+        leases = [self.queue.get() for i in range(3)]
+        self.assertEqual(self.queue.get(), None)
+        # newest first
+        self.assertEqual(leases[0].date, '2016-01-02')
+        self.assertTrue(self.queue.ack(leases[0], {'gid': leases[0].gid}))
+        self.assertFalse(self.queue.ack(leases[1], {'gid': leases[1].gid}))
+        self.assertTrue(self.queue.ack(leases[2], {'gid': leases[2].gid}))
+        results = self.queue.results('MCD43A4.006', '2016-01-01')
+        self.assertEqual([r['gid'] for r in results], [t['gid'] for t in tasks])
+
+    def test_visibility(self):
+        """ Expired leases are given to another worker """
+        self.queue.put(make_tasks(n=1))
+        lease = self.queue.get(visibility=0)
+        time.sleep(0.01)
+        lease2 = self.queue.get(visibility=60)
+        self.assertEqual(lease2.gid, lease.gid)
+        self.assertEqual(lease2.attempts, 2)
+        # the first worker has lost the lease
+        self.assertFalse(self.queue.extend(lease))
+        self.assertFalse(self.queue.ack(lease, {}))
+        self.assertTrue(self.queue.ack(lease2, {}))
+
+    def test_nack(self):
+        """ Failed tasks are retried until out of attempts """
+        self.queue.put(make_tasks(n=1))
+        self.queue.nack(self.queue.get(), 'error')
+        self.assertEqual(self.queue.counts(), {'ready': 1})
+        self.queue.nack(self.queue.get(), 'error')
+        self.assertEqual(self.queue.counts(), {'failed': 1})
+        self.assertEqual(self.queue.get(), None)
+
+    def test_put_failed(self):
+        """ Tasks that failed for good are tried again when queued again, and finalize their day """
+        tasks = make_tasks(n=2)
+        self.queue.put(tasks)
+        lease = self.queue.get()
+        self.assertFalse(self.queue.ack(lease, {'gid': lease.gid}))
+        for i in range(2):
+            self.queue.nack(self.queue.get(), 'error')
+        self.assertEqual(self.queue.counts(), {'done': 1, 'failed': 1})
+        self.assertEqual(self.queue.put(tasks), 1)
+        self.assertEqual(self.queue.counts(), {'done': 1, 'ready': 1})
+        lease = self.queue.get()
+        self.assertEqual(lease.attempts, 1)
+        self.assertTrue(self.queue.ack(lease, {'gid': lease.gid}))
+        self.assertEqual(len(self.queue.results('MCD43A4.006', '2016-01-01')), 2)
+
+    def test_concurrent(self):
+        """ Each task is leased by one worker """
+        self.queue.put(make_tasks(n=20))
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            leases = list(executor.map(lambda i: self.queue.get(), range(24)))
+        gids = [lease.gid for lease in leases if lease is not None]
+        self.assertEqual(len(gids), 20)
+        self.assertEqual(len(set(gids)), 20)
+
+    def test_heartbeat(self):
+        """ Heartbeat keeps leases from expiring """
+        self.queue.put(make_tasks(n=1))
+        lease = self.queue.get(visibility=0.3)
+        heartbeat = Heartbeat(self.queue, visibility=0.3).start()
+        heartbeat.add(lease)
+        time.sleep(0.5)
+        self.assertEqual(self.queue.get(), None)
+        heartbeat.stop()
+
+    def test_interface(self):
+        """ Queues implement the whole work queue interface """
+        with self.assertRaises(TypeError):
+            WorkQueue()
+        self.assertTrue(isinstance(self.queue, WorkQueue))
+
+    def test_open_queue(self):
+        """ Open queue from URL """
+        self.assertTrue(isinstance(open_queue('sqlite://' + self.fname), SQLiteQueue))
+        self.assertTrue(isinstance(open_queue(self.fname), SQLiteQueue))
+        with self.assertRaises(ValueError):
+            open_queue('sqs://queue')